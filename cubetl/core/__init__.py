@@ -50,6 +50,24 @@ class Component(object):
         #self.ctx = None
         self._initialized = False
 
+    def after_fork(self, ctx):
+        """
+        Called in worker processes (see :class:`cubetl.flow.Parallel`) for
+        components that had already been initialized by the parent process.
+        Components holding resources which cannot be shared across processes
+        (like database connections) shall reset them here.
+        """
+        pass
+
+    def before_job(self, ctx):
+        """
+        Called before each job when running as a service (see :mod:`cubetl.core.service`),
+        for components that are already initialized. Components keeping state
+        for a single run (like counters) shall reset it here, while caches and
+        connections are kept across jobs.
+        """
+        pass
+
     def __str__(self, *args, **kwargs):
         return "%s(%s)" % (self.__class__.__name__, self.urn)
 
@@ -89,11 +107,60 @@ class Node(Component):
 
     These must implement a process(ctx, m) method that
     accepts and yield messages.
+
+    Nodes that produce exactly one message (`CARDINALITY_MAP`) or at most one
+    message (`CARDINALITY_FILTER`) for each input message can instead declare
+    their cardinality and implement a `process_message(ctx, m)` method,
+    which returns the resulting message (or None if the message is filtered out).
+    Chains can then call these nodes directly (see :mod:`cubetl.flow.fusion`).
+
+    Nodes can also process several messages at once through `process_batch(ctx, messages)`,
+    which is used by chains running in batch mode. The default implementation
+    calls `process` for each message, but nodes that can amortize work across
+    messages (like database or file writers) provide their own implementation.
+
+    Nodes can declare the message fields they read and assign through
+    `live_fields(ctx, live)`, so chains can drop fields that are not used
+    anymore (see :mod:`cubetl.core.liveness`).
+
+    Nodes without side effects (sources and transformations) set `cancellable`
+    to True, meaning that they can be closed before they have received or
+    produced all messages when a following node is cancelled (see
+    :class:`cubetl.core.exceptions.ETLCancelException`).
     """
 
+    CARDINALITY_MANY = "many"
+    CARDINALITY_FILTER = "filter"
+    CARDINALITY_MAP = "map"
+
+    cardinality = CARDINALITY_MANY
+
+    cancellable = False
+
+    def process_message(self, ctx, m):
+        return m
+
     def process(self, ctx, m):
 
-        yield m
+        m = self.process_message(ctx, m)
+        if m is not None:
+            yield m
+
+    def process_batch(self, ctx, messages):
+        """
+        Processes a list of messages, yielding the resulting messages.
+        """
+        for m in messages:
+            for m2 in self.process(ctx, m):
+                yield m2
+
+    def live_fields(self, ctx, live):
+        """
+        Returns the set of fields of the input messages that are needed by this
+        node and the following ones, given the set of fields needed after it
+        (`live`). Returns None if the node may read any field (the default).
+        """
+        return None
 
 
 class ContextProperties(Component):
@@ -29,15 +29,14 @@ import pprint
 import sys
 import traceback
 
-from cubetl import APP_NAME_VERSION, util, flow, olap
+from cubetl import APP_NAME_VERSION
 from cubetl.core import ContextProperties
+from cubetl.core.checkpoint import Checkpoint
+from cubetl.core.exceptions import ETLException
+from cubetl.core.scheduler import Scheduler
+from cubetl.core.service import Service
 from cubetl.core.context import Context
 import cubetl
-from cubetl.util import config, log
-from cubetl.olap import sqlschema
-from cubetl.sql import schemaimport
-from cubetl.sql.sql import Connection
-from cubetl.cubes import cubes10
 
 
 # Get an instance of a logger
@@ -64,13 +63,21 @@ class Bootstrap:
         #logging.config.fileConfig('logging.conf')
 
     def usage(self):
-        sys.stderr.write("cubetl [-dd] [-q] [-h] [-r filename] [-p property=value] [-m attribute=value] [config.py ...] <start-node>\n")
+        sys.stderr.write("cubetl [-dd] [-q] [-h] [-r filename] [--sample=filename] [--stats] [--memory] [--checkpoint=filename [--resume]] [-j jobs] [--depends=node=node,...] [--serve=-|socket] [-p property=value] [-m attribute=value] [config.py ...] <start-node>\n")
         sys.stderr.write("\n")
         sys.stderr.write("    -p   set a context property\n")
         sys.stderr.write("    -m   set an attribute for the start item\n")
         sys.stderr.write("    -d   debug mode (can be used twice for extra debug)\n")
         sys.stderr.write("    -q   quiet mode (bypass print nodes)\n")
         sys.stderr.write("    -r   profile execution writing results to filename\n")
+        sys.stderr.write("    --sample  sample the execution profile by component, saving folded stacks (for flame graphs) to filename\n")
+        sys.stderr.write("    --stats  print execution statistics for each component\n")
+        sys.stderr.write("    --memory  trace memory allocations and report memory usage by component\n")
+        sys.stderr.write("    --checkpoint  save the positions of sources to the given state file\n")
+        sys.stderr.write("    --resume  resume from the positions saved in the checkpoint state file\n")
+        sys.stderr.write("    -j   run up to the given number of start nodes at the same time (each on its own process)\n")
+        sys.stderr.write("    --depends  declare the start nodes that must finish before a start node is run\n")
+        sys.stderr.write("    --serve  keep running, reading jobs (JSON start item attributes) from stdin ('-') or a UNIX socket\n")
         sys.stderr.write("    -l   list config nodes ('cubetl.config.list' as start-node)\n")
         sys.stderr.write("    -h   show this help and exit\n")
         sys.stderr.write("    -v   print version and exit\n")
@@ -91,13 +98,15 @@ class Bootstrap:
     def parse_args(self, ctx):
 
         try:
-            opts, arguments = getopt.gnu_getopt(ctx.argv, "p:m:r:dqhvl", [ "help", "version"])
+            opts, arguments = getopt.gnu_getopt(ctx.argv, "p:m:r:j:dqhvl", [ "help", "version", "sample=", "stats", "memory", "checkpoint=", "resume", "jobs=", "depends=", "serve="])
         except getopt.GetoptError as err:
             print(str(err))
             self.usage()
             sys.exit(2)
 
         list_nodes = False
+        checkpoint_path = None
+        resume = False
         for o, a in opts:
             if o in ("-h", "--help"):
                 self.usage()
@@ -114,6 +123,32 @@ class Bootstrap:
                 ctx.quiet = True
             elif o == "-r":
                 ctx.profile = a
+            elif o == "--sample":
+                ctx.sample = a
+            elif o == "--stats":
+                ctx.stats = True
+            elif o == "--memory":
+                ctx.memory = True
+            elif o == "--checkpoint":
+                checkpoint_path = a
+            elif o == "--resume":
+                resume = True
+            elif o in ("-j", "--jobs"):
+                try:
+                    ctx.jobs = int(a)
+                except ValueError:
+                    print("Invalid number of jobs (%s)" % (a))
+                    self.usage()
+                    sys.exit(2)
+            elif o == "--depends":
+                (key, value) = self._split_keyvalue(a)
+                if (key == None):
+                    print("Invalid dependencies node=node,... definition (%s)" % (value))
+                    self.usage()
+                    sys.exit(2)
+                ctx.dependencies[key] = [node.strip() for node in value.split(",") if node.strip()]
+            elif o == "--serve":
+                ctx.serve = a
             elif o == "-l":
                 list_nodes = True
             elif o == "-p":
@@ -142,6 +177,13 @@ class Bootstrap:
         if list_nodes:
             ctx.start_nodes.append("cubetl.config.list")
 
+        if resume and not checkpoint_path:
+            print("Option --resume requires a checkpoint state file (--checkpoint).")
+            self.usage()
+            sys.exit(2)
+        if checkpoint_path:
+            ctx.checkpoint = Checkpoint(checkpoint_path, resume=resume)
+
         if not ctx.start_nodes:
             print("One starting node must be specified, but none found.")
             self.usage()
@@ -202,35 +244,54 @@ class Bootstrap:
                 print("Start node '%s' not found in config." % start_node_name)
                 sys.exit(1)
 
-        for start_node in start_nodes:
-            ctx.run(start_node)
+        scheduler = Scheduler(ctx, ctx.start_nodes, ctx.dependencies, ctx.jobs)
+        if ctx.serve:
+            service = Service(ctx, [start_nodes[ctx.start_nodes.index(name)] for name in scheduler.order()])
+            service.serve(ctx.serve)
+        elif ctx.jobs > 1:
+            try:
+                scheduler.run()
+            except ETLException as e:
+                logger.error(str(e))
+                sys.exit(1)
+        else:
+            for start_node_name in scheduler.order():
+                ctx.run(start_nodes[ctx.start_nodes.index(start_node_name)])
 
     def default_config(self, ctx):
+        """
+        Adds the default components. These are added as factories, so their
+        modules (and dependencies like SQLAlchemy) are only imported if used.
+        """
+
+        config = lambda: importlib.import_module("cubetl.util.config")
 
-        ctx.add('cubetl.config.print', config.PrintConfig(),
+        ctx.add('cubetl.config.print', lambda: config().PrintConfig(),
                 description="Prints current CubETL configuration.")
-        ctx.add('cubetl.config.list', config.ListConfig(),
+        ctx.add('cubetl.config.list', lambda: config().ListConfig(),
                 description="List available CubETL nodes (same as: cubetl -l).")
-        ctx.add('cubetl.config.new', config.CreateTemplateConfig(
+        ctx.add('cubetl.config.new', lambda: config().CreateTemplateConfig(
             config_name="${ ctx.props.get('config.name', 'myproject') }",
             config_path="${ ctx.props.get('config.path', ctx.props.get('config.name', 'myproject') + '.py') }"),
             description="Creates a cubetl blank configuration file from a template.")
-        ctx.add('cubetl.util.print', util.PrettyPrint(),
+        ctx.add('cubetl.util.print', lambda: importlib.import_module("cubetl.util").PrettyPrint(),
                 description="Prints the current message.")
 
         ctx.add('cubetl.sql.db2sql',
-                schemaimport.DBToSQL(connection=Connection(url="${ ctx.props['db2sql.db_url'] }")),  #, connect_args={'sslmode': 'disable'})),
+                lambda: importlib.import_module("cubetl.sql.schemaimport").DBToSQL(
+                    connection=importlib.import_module("cubetl.sql.sql").Connection(url="${ ctx.props['db2sql.db_url'] }")),  #, connect_args={'sslmode': 'disable'})),
                 description="Generate SQL schema from existing database.")
 
-        ctx.add('cubetl.olap.sql2olap', sqlschema.SQLToOLAP(),
+        ctx.add('cubetl.olap.sql2olap', lambda: importlib.import_module("cubetl.olap.sqlschema").SQLToOLAP(),
                 description="Generate OLAP schema from SQL schema.")
-        ctx.add('cubetl.olap.mappings', olap.PrintMappings(olapmapper="${ ctx.find(cubetl.olap.OlapMapper)[0] }"),
+        ctx.add('cubetl.olap.mappings', lambda: importlib.import_module("cubetl.olap").PrintMappings(olapmapper="${ ctx.find(cubetl.olap.OlapMapper)[0] }"),
                 description="Show configured OLAP entities and mappings.")
 
         ctx.add('cubetl.cubes.olap2cubes',
-                cubes10.Cubes10ModelWriter(olapmapper="${ ctx.get('sql2olap.olapmapper') }",
-                                           model_path="${ ctx.props.get('olap2cubes.cubes_model', None) }",
-                                           config_path="${ ctx.props.get('olap2cubes.cubes_config', None) }"),
+                lambda: importlib.import_module("cubetl.cubes.cubes10").Cubes10ModelWriter(
+                    olapmapper="${ ctx.get('sql2olap.olapmapper') }",
+                    model_path="${ ctx.props.get('olap2cubes.cubes_model', None) }",
+                    config_path="${ ctx.props.get('olap2cubes.cubes_config', None) }"),
                 description="Generate OLAP schema from SQL schema.")
 
 
@@ -0,0 +1,177 @@
+# CubETL
+# Copyright (c) 2013-2019 Jose Juan Montes
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import json
+import logging
+import os
+import time
+
+from cubetl.core.exceptions import ETLConfigurationException, ETLException
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint():
+    """
+    Keeps the positions reached by source nodes (ie. the number of lines
+    read from a file, the files listed from a directory, or the last key
+    value of a query), and saves them to a state file so an interrupted
+    process can be resumed (see the `--checkpoint` and `--resume` options).
+
+    Sources update their position once each message they produce has been
+    processed by the rest of the flow, and check the position saved by the
+    previous run when they start (see :meth:`resume_position`). Positions
+    are keyed by component URN, so checkpointed sources must be named (added
+    to the context), and keep their positions if the configuration changes.
+
+    While a database transaction is open (see `sql.Transaction`), positions
+    are only saved when it is committed: the state file is written before
+    the commit, and replaces the previous state file after the commit.
+    Transactions also store the positions in the database, as part of the
+    commit, and restore them when resuming (see :meth:`restore`), so positions
+    are consistent with the data committed even if the process is
+    interrupted between the commit and the replacement of the state file.
+    Transactions committed periodically are committed from :meth:`update`
+    (see `listeners`), when the positions correspond to the data written.
+    Otherwise, positions are saved every `interval` seconds and when the
+    process finishes.
+    """
+
+    def __init__(self, path, resume=False, interval=30):
+        self.path = path
+        self.resume = resume
+        self.interval = interval
+
+        self.positions = {}
+        self.resumed = {}
+        self.transactions = 0
+        self.listeners = []
+
+        self._last_save = time.monotonic()
+        self._loaded = False
+        self._restored = False
+
+    @property
+    def pending_path(self):
+        return self.path + ".pending"
+
+    def load(self):
+        """
+        Loads the positions saved by a previous run (called on first use
+        when resuming).
+        """
+        self._loaded = True
+
+        if os.path.exists(self.pending_path):
+            logger.warning("Checkpoint state file %s was not committed (the process was interrupted during "
+                           "a transaction commit), resuming from last committed state (positions committed "
+                           "to the database, if any, or the last state file)" % self.pending_path)
+
+        if not os.path.exists(self.path):
+            logger.warning("Checkpoint state file %s not found, nothing to resume" % self.path)
+            return
+
+        try:
+            with open(self.path, "r") as statefile:
+                self.resumed = json.load(statefile)["positions"]
+        except (ValueError, KeyError) as e:
+            raise ETLException("Invalid checkpoint state file %s: %s" % (self.path, e))
+
+        # Keep positions of sources that are not run again
+        self.positions = dict(self.resumed)
+
+        logger.info("Resuming from checkpoint %s (%d positions)" % (self.path, len(self.resumed)))
+
+    def key(self, comp):
+        if not comp.urn:
+            raise ETLConfigurationException("Cannot checkpoint %s: checkpointed sources must be named "
+                                            "(added to the context with ctx.add)" % comp)
+        return comp.urn
+
+    def restore(self, positions):
+        """
+        Sets the positions to resume from, as committed to a database together
+        with the data (see `sql.Transaction`), which take precedence over the
+        positions in the state file. Must be called before sources resume.
+        """
+        if not self.resume or self._restored:
+            return
+        if not self._loaded:
+            self.load()
+        self._restored = True
+        self.resumed = dict(positions)
+        self.positions = dict(positions)
+        logger.info("Resuming from positions committed to the database (%d positions)" % len(self.resumed))
+
+    def resume_position(self, comp):
+        """
+        Returns the position saved for a component by the resumed run, or None.
+        The position is returned only once, so sources called several times
+        in a run only resume the first time.
+        """
+        if self.resume and not self._loaded:
+            self.load()
+        return self.resumed.pop(self.key(comp), None)
+
+    def update(self, comp, position):
+        """
+        Sets the position of a component. Positions must be JSON serializable.
+        """
+        if self.resume and not self._loaded:
+            self.load()
+
+        self.positions[self.key(comp)] = position
+
+        # Messages up to this position have been fully processed
+        for listener in list(self.listeners):
+            listener()
+
+        if not self.transactions and time.monotonic() - self._last_save > self.interval:
+            self.save()
+
+    def prepare(self, positions=None):
+        """
+        Writes the current positions (or the given positions) to the pending
+        state file (called before a transaction is committed).
+        """
+        if self.resume and not self._loaded:
+            self.load()
+
+        state = {"positions": self.positions if positions is None else positions}
+        with open(self.pending_path, "w") as statefile:
+            json.dump(state, statefile, default=str)
+
+    def commit(self):
+        """
+        Replaces the state file with the pending state file (called after
+        a transaction is committed).
+        """
+        os.replace(self.pending_path, self.path)
+        self._last_save = time.monotonic()
+        logger.debug("Saved checkpoint state to %s" % self.path)
+
+    def save(self):
+        self.prepare()
+        self.commit()
+
@@ -21,7 +21,9 @@
 
 
 import logging
+import time
 
+from cubetl.core import Component
 from cubetl.core.exceptions import ETLConfigurationException
 
 
@@ -33,6 +35,32 @@ class ComponentDescriptor():
     pass
 
 
+class ComponentStats():
+    """
+    Execution statistics of a component (collected when `ctx.stats` is enabled).
+
+    Times are cumulative and include the time spent in the components called
+    by the component (ie. the steps of a Chain). Latency is the longest time
+    taken to produce a single message (or to finish processing a message).
+    """
+
+    __slots__ = ('messages_in', 'messages_out', 'wall', 'cpu', 'max_latency')
+
+    def __init__(self):
+        self.messages_in = 0
+        self.messages_out = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max_latency = 0.0
+
+    def record(self, wall_start, cpu_start):
+        wall = time.perf_counter() - wall_start
+        self.wall += wall
+        self.cpu += time.thread_time() - cpu_start
+        if wall > self.max_latency:
+            self.max_latency = wall
+
+
 class Components():
 
     def __init__(self, context):
@@ -47,6 +75,7 @@ class Components():
             self.components[comp].comp = comp
             self.components[comp].initialized = False
             self.components[comp].finalized = False
+            self.components[comp].stats = ComponentStats()
 
         return self.components[comp]
 
@@ -78,12 +107,102 @@ class Components():
             comp.finalize(self.ctx)
 
     def process(self, comp, m):
-        if (not self.is_initialized(comp)):
+        desc = self.components.get(comp, None)
+        if (desc is None or not desc.initialized):
             raise Exception("Sent message to a non initialized component: %s" % comp)
-        if (self.is_finalized(comp)):
+        if (desc.finalized):
             raise Exception("Message to a finalized component: %s" % comp)
+        if self.ctx.stats:
+            return self._process_stats(desc.stats, comp, m)
         return comp.process(self.ctx, m)
 
+    def _process_stats(self, stats, comp, m, batch=False):
+        stats.messages_in += len(m) if batch else 1
+        iterator = None
+        try:
+            while True:
+                wall_start = time.perf_counter()
+                cpu_start = time.thread_time()
+                try:
+                    if iterator is None:
+                        iterator = iter(comp.process_batch(self.ctx, m) if batch else comp.process(self.ctx, m))
+                    m2 = next(iterator)
+                except StopIteration:
+                    stats.record(wall_start, cpu_start)
+                    return
+                stats.record(wall_start, cpu_start)
+                stats.messages_out += 1
+                yield m2
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    def process_batch(self, comp, messages):
+        desc = self.components.get(comp, None)
+        if (desc is None or not desc.initialized):
+            raise Exception("Sent messages to a non initialized component: %s" % comp)
+        if (desc.finalized):
+            raise Exception("Messages to a finalized component: %s" % comp)
+        if self.ctx.stats:
+            return self._process_stats(desc.stats, comp, messages, True)
+        return comp.process_batch(self.ctx, messages)
+
+    def instrument(self, comp, function):
+        """
+        Returns a wrapper for a `function(ctx, m)` which processes a message
+        on behalf of `comp` without going through :meth:`process` (such as
+        the `process_message` method of fused chain steps, see
+        :mod:`cubetl.flow.fusion`), recording statistics for the component.
+        The function may return None to filter the message out.
+        """
+        stats = self.component_desc(comp).stats
+
+        def instrumented(ctx, m):
+            stats.messages_in += 1
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            m = function(ctx, m)
+            stats.record(wall_start, cpu_start)
+            if m is not None:
+                stats.messages_out += 1
+            return m
+
+        return instrumented
+
+    def _children(self, comp):
+        children = []
+        for value in vars(comp).values():
+            values = value if isinstance(value, (list, tuple)) else [value]
+            for child in values:
+                if isinstance(child, Component) and child in self.components and child is not comp and child not in children:
+                    children.append(child)
+        return children
+
+    def _stats_lines(self, comp, depth, visited):
+        visited.add(comp)
+        lines = []
+        for child in self._children(comp):
+            if child not in visited:
+                lines.extend(self._stats_lines(child, depth + 1, visited))
+
+        stats = self.components[comp].stats
+        if stats.messages_in or lines:
+            label = ("  " * depth + str(comp))[:60]
+            lines.insert(0, "%-60s %10d %10d %10.3f %10.3f %10.3f" % (
+                label, stats.messages_in, stats.messages_out,
+                stats.wall, stats.cpu, stats.max_latency * 1000.0))
+        return lines
+
+    def stats_report(self, comp):
+        """
+        Returns a text report of the execution statistics of a component and
+        the components it references (ie. Chain steps), as a tree.
+        """
+        lines = ["%-60s %10s %10s %10s %10s %10s" % ("Component", "In", "Out", "Wall (s)", "CPU (s)", "Max (ms)")]
+        if comp in self.components:
+            lines.extend(self._stats_lines(comp, 0, set()))
+        return "\n".join(lines)
+
     def cleanup(self):
         for comp_desc in self.components.values():
             if (not comp_desc.finalized):
@@ -23,7 +23,6 @@
 from inspect import isclass
 from repoze.lru import LRUCache
 import cProfile
-import copy
 import datetime
 import inspect
 import logging
@@ -36,10 +35,13 @@ import urllib
 
 from cubetl.core import Component
 from cubetl.core.components import Components
-from cubetl.core.exceptions import ETLException, ETLConfigurationException
+from cubetl.core.exceptions import ETLCancelException, ETLException, ETLConfigurationException
+from cubetl.core.expressions import Expression, compile_expression, resolve_callable
+from cubetl.core.memory import MemoryTracker
+from cubetl.core.message import Message
+from cubetl.core.profiler import SamplingProfiler
 from cubetl.text import functions
 from cubetl.xml import functions as xmlfunctions
-import cubetl
 from collections import OrderedDict
 import importlib
 
@@ -48,6 +50,55 @@ import importlib
 logger = logging.getLogger(__name__)
 
 
+class Properties(dict):
+    """
+    Dictionary for context properties, which keeps a version number that
+    changes whenever properties are modified. This is used to invalidate
+    the values of constant expressions (see :meth:`Context.compile`).
+    """
+
+    version = 0
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.version += 1
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.version += 1
+
+    def setdefault(self, key, default=None):
+        self.version += 1
+        return super().setdefault(key, default)
+
+    def pop(self, *args):
+        self.version += 1
+        return super().pop(*args)
+
+    def popitem(self):
+        self.version += 1
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self.version += 1
+
+
+class LazyComponent():
+    """
+    A component registered in the context as a factory (see :meth:`Context.add`),
+    which is created (importing any modules it needs) the first time it is used.
+    """
+
+    def __init__(self, factory, description=None):
+        self.factory = factory
+        self.description = description
+
+
 class Context():
 
     def __init__(self):
@@ -61,6 +112,16 @@ class Context():
         self.quiet = False
 
         self.profile = False
+        self.sample = None
+        self.stats = False
+        self.memory = False
+        self.memory_tracker = None
+        self.checkpoint = None
+
+        self.jobs = 1
+        self.dependencies = {}
+
+        self.serve = None
 
         self.components = OrderedDict()
 
@@ -69,7 +130,7 @@ class Context():
         self.config_files = []
         self.included_files = []
 
-        self.props = {}
+        self.props = Properties()
         self.properties = self.props
 
         self.var = {}
@@ -114,6 +175,8 @@ class Context():
             raise ETLException("Cannot retrieve component with id None.")
 
         comp = self.components.get(uid, None)
+        if comp.__class__ is LazyComponent:
+            comp = self._create(uid)
 
         if comp is None and fail:
             raise ETLException("Component not found with id '%s'" % uid)
@@ -127,6 +190,7 @@ class Context():
         return None
 
     def find(self, type):
+        self.create_all()
         result = []
         for comp in self.components.values():
             if isinstance(comp, type):
@@ -134,6 +198,15 @@ class Context():
         return result
 
     def add(self, urn, component, description=None):
+        """
+        Adds a component to the context with the given URN.
+
+        Instead of a component, a factory (a function or class which takes no
+        arguments and returns the component) can be given, so the component
+        is only created (and the modules it needs imported) when it is first
+        retrieved with :meth:`get` (or when components are listed, see
+        :meth:`create_all`).
+        """
 
         # FIXME: TODO: Allow anonymous components? these would be exported in-line with their parents.
         # This assumes that components are initialized completely (possibly better for config comprehension)
@@ -143,10 +216,13 @@ class Context():
             raise Exception('Tried to add an object with no URN')
         if component is None:
             raise Exception('Tried to add a null object')
-        if not isinstance(component, Component):
-            raise Exception('Tried to add a non Component object: %s' % component)
         if self.components.get(urn, None) is not None:
             raise Exception("Tried to add an already existing URN: %s" % urn)
+        if not isinstance(component, Component):
+            if not callable(component):
+                raise Exception('Tried to add a non Component object: %s' % component)
+            self.components[urn] = LazyComponent(component, description)
+            return None
 
         component.ctx = self
         component.urn = urn
@@ -155,6 +231,50 @@ class Context():
         self.components[urn] = component
         return component
 
+    def _create(self, urn):
+        lazy = self.components[urn]
+        logger.debug("Creating component: %s" % urn)
+        component = lazy.factory()
+        if not isinstance(component, Component):
+            raise Exception('Factory for %s returned a non Component object: %s' % (urn, component))
+
+        component.ctx = self
+        component.urn = urn
+        component.description = lazy.description
+
+        self.components[urn] = component
+        return component
+
+    def create_all(self):
+        """
+        Creates all components registered as factories (see :meth:`add`).
+        """
+        for urn, comp in list(self.components.items()):
+            if comp.__class__ is LazyComponent:
+                self._create(urn)
+
+    def compile(self, value):
+        """
+        Compiles a value (usually an expression template) into an
+        :class:`~cubetl.core.expressions.Expression`, which can be later
+        called as `expression(ctx, m)` to resolve it. Compiled string
+        templates are cached.
+
+        Nodes should compile their interpolated attributes on initialization,
+        in order to avoid parsing them again on every message.
+
+        Expressions that do not depend on the message are evaluated once,
+        and only evaluated again if context properties change.
+        """
+        if not isinstance(value, str):
+            return compile_expression(value)
+
+        compiled = self._compiled.get(value)
+        if compiled is None:
+            compiled = compile_expression(value)
+            self._compiled.put(value, compiled)
+        return compiled
+
     def interpolate(self, value, m=None, data=None):
         """
         Resolves expressions `${ ... }`, lambdas and functions in a value,
@@ -170,109 +290,105 @@ class Context():
         if value is None:
             return None
 
-        # If the value is a callable (function or lambda), inspect
-        # its parameters. Acceptable signatures are:
+        # Already compiled values
+        if isinstance(value, Expression):
+            return value(self, m, data)
+
+        # If the value is a callable (function or lambda), call it
+        # according to its signature. Acceptable signatures are:
         # (ctx), (m), (ctx, m)
         if callable(value):
-            sig = inspect.signature(value)
-            paramnames = list(sig.parameters.keys())
-            if len(sig.parameters) == 1 and paramnames[0] == 'ctx':
-                value = value(self)
-            elif len(sig.parameters) == 1 and paramnames[0] == 'm':
-                value = value(m)
-            elif len(sig.parameters) == 2 and paramnames[0] == 'ctx' and paramnames[1] == 'm':
-                value = value(self, m)
-            else:
-                raise ETLConfigurationException("Invalid lambda expression signature: %s" % sig)
+            value = resolve_callable(value)(self, m)
 
         # If the value is not a string, it is immediately returned
         if not isinstance(value, str):
             return value
 
         # Process string values
+        return self.compile(value)(self, m, data)
 
-        value = value.strip()
-
-        pos = -1
-        result = str(value)
-
-        for dstart, dend in (('${|', '|}'), ('${', '}')):
-            if (pos >= -1):
-                pos = result.find(dstart)
-            while (pos >= 0):
-                pos_end = result.find(dend)
-                expr = result[pos + len(dstart):pos_end].strip()
-
-                compiled = self._compiled.get(expr)
-                try:
-                    if (not compiled):
-                        compiled = compile(expr, '', 'eval')
-                        self._compiled.put(expr, compiled)
-
-                    c_locals = {"m": m, "ctx": self, "f": self.f, "props": self.props, "var": self.var, "cubetl": cubetl}
-                    if data:
-                        c_locals.update(data)
-                    res = eval(compiled, self._globals, c_locals)
-
-                    if (self.debug2):
-                        if (isinstance(res, str)):
-                            logger.debug('Evaluated: %s = %r' % (expr, res if (len(res) < 100) else res[:100] + ".."))
-                        else:
-                            logger.debug('Evaluated: %s = %r' % (expr, res))
-
-                except (Exception) as e:
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-
-                    caller_component = None
-                    frame = inspect.currentframe()
-                    for caller in inspect.getouterframes(frame):
-                        fc = Context._class_from_frame(caller[0])
-                        if (isclass(fc) and issubclass(fc, Component)):
-                            caller_component = caller[0].f_locals['self']
-                            break
-
-                    #logger.error("Error evaluating expression %s on data: %s" % (expr, m))
-                    self._eval_error_message = m
-
-                    logger.error('Error evaluating expression "%s" called from %s:\n%s' % (expr, caller_component, ("".join(traceback.format_exception_only(exc_type, exc_value)))))
-                    raise
-
-                if (pos > 0) or (pos_end < len(result) - (len(dend))):
-                    result = result[0:pos] + str(res) + result[pos_end + (len(dend)):]
-                    pos = result.find(dstart)
-                else:
-                    # Keep type of non-string types
-                    result = res
-                    pos = -2
+    def _log_eval_error(self, expr, m):
 
-        return result
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+
+        caller_component = None
+        frame = inspect.currentframe()
+        for caller in inspect.getouterframes(frame):
+            fc = Context._class_from_frame(caller[0])
+            if (isclass(fc) and issubclass(fc, Component)):
+                caller_component = caller[0].f_locals['self']
+                break
+
+        #logger.error("Error evaluating expression %s on data: %s" % (expr, m))
+        self._eval_error_message = m
+
+        logger.error('Error evaluating expression "%s" called from %s:\n%s' % (expr, caller_component, ("".join(traceback.format_exception_only(exc_type, exc_value)))))
 
     def copy_message(self, m):
-        # TODO: Create a copy-on-write message instead of actually copying (?)
+        """
+        Returns a copy of a message. Copies are copy-on-write :class:`Message`
+        objects, so the fields of the original message are not copied (plain
+        dictionaries are copied once).
+        """
         if m is None:
-            return {}
+            return Message()
+        elif isinstance(m, Message):
+            return m.copy()
         else:
-            return copy.copy(m)
+            return Message(m)
 
-    def _do_process(self, process, ctx, multiple):
+    def _do_process(self, process, ctx, multiple, start_item=None):
         # TODO: When using multiple, this should allow to yield,
         # TODO: Also, this method shall be called "consume" or something, and public
 
+        if start_item is None:
+            start_item = ctx.start_item
+
         # Reduce the OrderedDict to a dict, but interpolate its attributes in order
-        item = {}
-        for k in ctx.start_item.keys():
-            item[k] = ctx.interpolate(ctx.start_item[k], item)
+        item = Message()
+        for k in start_item.keys():
+            item[k] = ctx.interpolate(start_item[k], item)
         msgs = ctx.comp.process(process, item)
         count = 0
         result = [] if multiple else None
-        for m in msgs:
-            count = count + 1
-            if multiple:
-                result.append(m)
-            else:
-                result = m
+        try:
+            for m in msgs:
+                count = count + 1
+                if multiple:
+                    result.append(m)
+                else:
+                    result = m
+        except ETLCancelException:
+            logger.debug("Process cancelled after %d items" % count)
         return (result, count)
 
+    def _finish(self, start_nodes):
+        """
+        Finalizes the given start nodes once they have been run (or when a
+        service stops, see :mod:`cubetl.core.service`), saves the checkpoint
+        and reports execution statistics and memory usage.
+        """
+        ctx = self
+
+        logger.debug("Finalizing components")
+        for node in start_nodes:
+            ctx.comp.finalize(node)
+
+        if ctx.checkpoint:
+            ctx.checkpoint.save()
+
+        if ctx.stats:
+            for node in start_nodes:
+                logger.info("Execution statistics for %s:\n%s" % (node, ctx.comp.stats_report(node)))
+
+        if ctx.memory_tracker:
+            logger.info("Memory usage by component for %s:\n%s" % (", ".join([str(node) for node in start_nodes]),
+                                                                     ctx.memory_tracker.report()))
+            ctx.memory_tracker.stop()
+            ctx.memory_tracker = None
+
+        ctx.comp.cleanup()
+
     def run(self, start_node, multiple=False):
 
         ctx = self
@@ -295,23 +411,34 @@ class Context():
 
         # Launch process and consume items
         try:
+            if ctx.memory and not ctx.memory_tracker:
+                logger.warning("Tracing memory allocations by component (WARNING this is SLOW)")
+                ctx.memory_tracker = MemoryTracker(ctx)
+                ctx.memory_tracker.start()
+
             logger.debug("Initializing components")
             ctx.comp.initialize(start_node_comp)
 
             logger.info("Processing %s" % start_node_comp)
 
-            if ctx.profile:
-                logger.warning("Profiling execution (WARNING this is SLOW) and saving results to: %s" % ctx.profile)
-                cProfile.runctx("(result, processed) = self._do_process(start_node_comp, ctx, multiple=multiple)", globals(), locals(), ctx.profile)
-            else:
-                (result, processed) = self._do_process(start_node_comp, ctx, multiple=multiple)
+            profiler = SamplingProfiler(ctx.sample) if ctx.sample else None
+            if profiler:
+                logger.info("Sampling execution profile to: %s" % ctx.sample)
+                profiler.start()
 
-            logger.debug("%s items resulted from the process" % processed)
+            try:
+                if ctx.profile:
+                    logger.warning("Profiling execution (WARNING this is SLOW) and saving results to: %s" % ctx.profile)
+                    cProfile.runctx("(result, processed) = self._do_process(start_node_comp, ctx, multiple=multiple)", globals(), locals(), ctx.profile)
+                else:
+                    (result, processed) = self._do_process(start_node_comp, ctx, multiple=multiple)
+            finally:
+                if profiler:
+                    profiler.stop()
 
-            logger.debug("Finalizing components")
-            ctx.comp.finalize(start_node_comp)
+            logger.debug("%s items resulted from the process" % processed)
 
-            ctx.comp.cleanup()
+            ctx._finish([start_node_comp])
 
         except KeyboardInterrupt as e:
             logger.error("User interrupted")
@@ -324,10 +451,14 @@ class Context():
 
             if hasattr(ctx, "eval_error_message"):
                 pp = pprint.PrettyPrinter(indent=4, depth=2)
-                print(pp.pformat(ctx._eval_error_message))
+                message = ctx._eval_error_message
+                print(pp.pformat(to_plain(message)))
 
             traceback.print_exception(exc_type, exc_value, exc_traceback)
             '''
+            if ctx.memory_tracker:
+                ctx.memory_tracker.stop()
+                ctx.memory_tracker = None
             raise
 
         return result
@@ -26,3 +26,18 @@ class ETLException(Exception):
 
 class ETLConfigurationException(ETLException):
     pass
+
+
+class ETLCancelException(Exception):
+    """
+    Raised by a node to signal that it will not process any more messages
+    (ie. a `Limit` node once the limit has been reached).
+
+    If all the steps that feed messages to the cancelled node are
+    `cancellable` (they have no side effects, see :class:`cubetl.core.Node`),
+    chains stop (close) them, so sources release their resources, and
+    propagate the cancellation to their caller (see :class:`cubetl.flow.Chain`).
+    Otherwise, these steps go on processing all messages, and the messages
+    that reach the cancelled node are discarded. A cancelled flow ends normally.
+    """
+    pass
@@ -0,0 +1,450 @@
+# CubETL
+# Copyright (c) 2013-2019 Jose Juan Montes
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import ast
+import builtins
+import inspect
+import logging
+import types
+import weakref
+
+import cubetl
+from cubetl.core.exceptions import ETLConfigurationException
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+# Resolved callables (function -> adapter called as adapter(ctx, m))
+_callables = weakref.WeakKeyDictionary()
+
+
+def resolve_callable(function):
+    """
+    Returns an adapter for a function or lambda used as a value, which is
+    always called as `adapter(ctx, m)` regardless of the function signature.
+    Acceptable signatures are: (ctx), (m), (ctx, m).
+
+    Adapters are cached by function, so signatures are inspected only once.
+    """
+
+    try:
+        adapter = _callables.get(function, None)
+    except TypeError:
+        # Not weak-referenceable (cannot be cached)
+        adapter = None
+
+    if adapter is not None:
+        return adapter
+
+    sig = inspect.signature(function)
+    paramnames = list(sig.parameters.keys())
+    if len(paramnames) == 1 and paramnames[0] == 'ctx':
+        adapter = lambda ctx, m: function(ctx)
+    elif len(paramnames) == 1 and paramnames[0] == 'm':
+        adapter = lambda ctx, m: function(m)
+    elif len(paramnames) == 2 and paramnames[0] == 'ctx' and paramnames[1] == 'm':
+        adapter = function
+    else:
+        raise ETLConfigurationException("Invalid lambda expression signature: %s" % sig)
+
+    try:
+        _callables[function] = adapter
+    except TypeError:
+        pass
+
+    return adapter
+
+
+class Expression():
+    """
+    Base class for compiled values.
+
+    An expression is obtained from a configured value (usually a string
+    template containing `${ ... }` expressions) through `ctx.compile(value)`,
+    and is called as `expression(ctx, m)` to obtain the same result that
+    `ctx.interpolate(value, m)` would return, without parsing the template
+    again for every message.
+
+    Nodes compile their interpolated attributes on `initialize`.
+
+    Expressions whose value does not depend on the message (see
+    :class:`CodeExpression`) are flagged as `constant`. These are evaluated
+    once and their value reused until context properties change.
+
+    The `fields` attribute is the set of message fields that the expression
+    reads, or None if these cannot be known (ie. the whole message is used).
+    It is used by the field liveness analysis of chains (see :mod:`cubetl.core.liveness`).
+    """
+
+    constant = False
+    fields = None
+
+    def __init__(self, source):
+        self.source = source
+
+        self._folded_ctx = None
+        self._folded_version = None
+        self._folded_value = None
+
+    def _fold(self, ctx, m, data, evaluate=None):
+        """
+        Returns the value of a constant expression, evaluating it (with the
+        given function, or :meth:`evaluate`) only if it hasn't been evaluated
+        yet for the current context properties.
+        """
+        if self._folded_ctx is not ctx or self._folded_version != ctx.props.version:
+            version = ctx.props.version
+            self._folded_value = (evaluate or self.evaluate)(ctx, m, data)
+            self._folded_ctx = ctx
+            self._folded_version = version
+        return self._folded_value
+
+    def evaluate(self, ctx, m=None, data=None):
+        raise NotImplementedError()
+
+    def __call__(self, ctx, m=None, data=None):
+        if self.constant and not data:
+            return self._fold(ctx, m, data)
+        return self.evaluate(ctx, m, data)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.source)
+
+
+class ConstantExpression(Expression):
+    """
+    A value that contains no expressions (including strings with no `${ }` blocks).
+    """
+
+    constant = True
+    fields = frozenset()
+
+    def __init__(self, source, value):
+        super().__init__(source)
+        self.value = value
+
+    def __call__(self, ctx, m=None, data=None):
+        return self.value
+
+    def evaluate(self, ctx, m=None, data=None):
+        return self.value
+
+
+class CallableExpression(Expression):
+    """
+    A function or lambda. Its signature is resolved on compilation (see
+    :func:`resolve_callable`). String results are interpolated.
+    """
+
+    def __init__(self, source):
+        super().__init__(source)
+        self._adapter = resolve_callable(source)
+
+    def evaluate(self, ctx, m=None, data=None):
+        value = self._adapter(ctx, m)
+        if isinstance(value, str):
+            return ctx.interpolate(value, m, data)
+        return value
+
+
+class CodeExpression(Expression):
+    """
+    A single `${ ... }` expression. The type of the evaluated value is kept.
+
+    The expression is compiled as the body of a function whose arguments are
+    the names available to expressions (`m`, `ctx`, `f`, `props`, `var` and `cubetl`),
+    so evaluation is a plain function call. The function is bound to the
+    context globals on first use.
+
+    Expressions are analyzed on compilation. Those built only from literals,
+    reads of context properties (`props['name']`, `ctx.props.get('name')`...),
+    operators and a few pure functions and string methods are considered
+    constant for given context properties (see :attr:`PURE_FUNCTIONS`).
+    Any other name or call (the message, `ctx`, `f`, user functions...) may
+    return a different value each time, so the expression is evaluated on
+    every call. Values of context properties are not expected to be
+    modified in place.
+
+    Message fields are considered read only if accessed with a literal name
+    (`m['name']`, `m.get('name')` or `'name' in m`). Any other use of the
+    message means that any field may be read.
+    """
+
+    ARGS = ("m", "ctx", "f", "props", "var", "cubetl")
+
+    PURE_FUNCTIONS = frozenset(["str", "int", "float", "bool", "len", "min", "max", "abs",
+                                "round", "tuple", "sorted"])
+
+    PURE_METHODS = frozenset(["get", "upper", "lower", "strip", "lstrip", "rstrip", "split",
+                              "replace", "format", "join", "startswith", "endswith", "title"])
+
+    PURE_NODES = (ast.Expression, ast.Constant, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare,
+                  ast.IfExp, ast.Tuple, ast.List, ast.Dict, ast.Set, ast.JoinedStr, ast.FormattedValue,
+                  ast.Subscript, ast.Slice, ast.keyword, ast.Load, ast.operator, ast.unaryop,
+                  ast.boolop, ast.cmpop, ast.expr_context)
+
+    def __init__(self, source, expr):
+        super().__init__(source)
+        self.expr = expr
+
+        try:
+            self._code = compile(expr, '', 'eval')
+            function_code = compile("lambda %s: (\n%s\n)" % (", ".join(CodeExpression.ARGS), expr), '', 'eval')
+        except SyntaxError as e:
+            raise ETLConfigurationException("Invalid expression '%s': %s" % (expr, e))
+
+        self._function_code = [c for c in function_code.co_consts if isinstance(c, types.CodeType)][0]
+        self._function = None
+        self._ctx = None
+
+        self._fields = False
+
+        self.constant = CodeExpression._pure(ast.parse(expr, mode='eval'))
+
+    @property
+    def fields(self):
+        if self._fields is False:
+            self._fields = CodeExpression._message_fields(ast.parse(self.expr, mode='eval'))
+        return self._fields
+
+    @staticmethod
+    def _message_fields(tree):
+        fields = set()
+        accessed = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Subscript):
+                target, key = node.value, node.slice
+                if isinstance(key, ast.Index):
+                    key = key.value
+            elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and
+                  node.func.attr == "get" and node.args):
+                target, key = node.func.value, node.args[0]
+            elif (isinstance(node, ast.Compare) and len(node.ops) == 1 and
+                  isinstance(node.ops[0], (ast.In, ast.NotIn))):
+                target, key = node.comparators[0], node.left
+            else:
+                continue
+            if (isinstance(target, ast.Name) and target.id == "m" and
+                    isinstance(key, ast.Constant) and isinstance(key.value, str)):
+                fields.add(key.value)
+                accessed.add(id(target))
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node.id in ("m", "locals", "vars", "eval") and id(node) not in accessed:
+                return None
+
+        return frozenset(fields)
+
+    @staticmethod
+    def _pure(tree):
+        """
+        Returns True if the expression only uses literals, context properties,
+        operators and pure functions (so its value can be folded).
+        """
+        called = set([id(node.func) for node in ast.walk(tree) if isinstance(node, ast.Call)])
+        props = set([id(node.value) for node in ast.walk(tree)
+                     if isinstance(node, ast.Attribute) and node.attr == "props"])
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                if node.id == "props":
+                    continue
+                if node.id == "ctx" and id(node) in props:
+                    continue
+                if node.id in CodeExpression.PURE_FUNCTIONS and id(node) in called:
+                    continue
+                return False
+            elif isinstance(node, ast.Attribute):
+                if node.attr == "props" and isinstance(node.value, ast.Name) and node.value.id == "ctx":
+                    continue
+                if node.attr in CodeExpression.PURE_METHODS and id(node) in called:
+                    continue
+                return False
+            elif not isinstance(node, CodeExpression.PURE_NODES + (ast.Call, )):
+                return False
+
+        return True
+
+    def _bind(self, ctx):
+        ctx._globals.setdefault("__builtins__", builtins.__dict__)
+        self._function = types.FunctionType(self._function_code, ctx._globals)
+        self._ctx = ctx
+
+    def evaluate(self, ctx, m=None, data=None):
+        try:
+            if data:
+                c_locals = {"m": m, "ctx": ctx, "f": ctx.f, "props": ctx.props, "var": ctx.var, "cubetl": cubetl}
+                c_locals.update(data)
+                res = eval(self._code, ctx._globals, c_locals)
+            else:
+                if self._ctx is not ctx:
+                    self._bind(ctx)
+                res = self._function(m, ctx, ctx.f, ctx.props, ctx.var, cubetl)
+        except Exception:
+            ctx._log_eval_error(self.expr, m)
+            raise
+
+        if (ctx.debug2):
+            if (isinstance(res, str)):
+                logger.debug('Evaluated: %s = %r' % (self.expr, res if (len(res) < 100) else res[:100] + ".."))
+            else:
+                logger.debug('Evaluated: %s = %r' % (self.expr, res))
+
+        return res
+
+
+class TemplateExpression(Expression):
+    """
+    A string template with text and one or more `${ ... }` expressions.
+    The result is always a string.
+
+    Fields read by evaluated values that are in turn templates are not
+    accounted for in `fields`.
+    """
+
+    def __init__(self, source, parts):
+        super().__init__(source)
+        self.parts = parts
+        self.constant = all([(isinstance(part, str) or part.constant) for part in parts])
+
+    @property
+    def fields(self):
+        fields = set()
+        for part in self.parts:
+            if not isinstance(part, str):
+                if part.fields is None:
+                    return None
+                fields |= part.fields
+        return frozenset(fields)
+
+    def _join(self, ctx, m=None, data=None):
+        return "".join([(part if isinstance(part, str) else str(part(ctx, m, data))) for part in self.parts])
+
+    def _resolve(self, ctx, result, m, data):
+        # Evaluated values that contain expressions are resolved again
+        # (the result may depend on the message, so only the parts are folded)
+        if '${' in result:
+            return ctx.interpolate(result, m, data)
+        return result
+
+    def evaluate(self, ctx, m=None, data=None):
+        return self._resolve(ctx, self._join(ctx, m, data), m, data)
+
+    def __call__(self, ctx, m=None, data=None):
+        if self.constant and not data:
+            return self._resolve(ctx, self._fold(ctx, m, data, self._join), m, data)
+        return self.evaluate(ctx, m, data)
+
+
+class DynamicExpression(Expression):
+    """
+    A template using `${| ... |}` blocks, whose results are in turn templates
+    which are resolved afterwards. These cannot be compiled in advance, so the
+    template is scanned on every call (only the expressions are cached).
+    """
+
+    def __init__(self, source):
+        super().__init__(source)
+        self._expressions = {}
+
+    def _expression(self, expr):
+        expression = self._expressions.get(expr, None)
+        if expression is None:
+            expression = CodeExpression(self.source, expr)
+            self._expressions[expr] = expression
+        return expression
+
+    def evaluate(self, ctx, m=None, data=None):
+
+        pos = -1
+        result = self.source
+
+        for dstart, dend in (('${|', '|}'), ('${', '}')):
+            if (pos >= -1):
+                pos = result.find(dstart)
+            while (pos >= 0):
+                pos_end = result.find(dend)
+                expr = result[pos + len(dstart):pos_end].strip()
+
+                res = self._expression(expr)(ctx, m, data)
+
+                if (pos > 0) or (pos_end < len(result) - (len(dend))):
+                    result = result[0:pos] + str(res) + result[pos_end + (len(dend)):]
+                    pos = result.find(dstart)
+                else:
+                    # Keep type of non-string types
+                    result = res
+                    pos = -2
+
+        return result
+
+
+def compile_expression(value):
+    """
+    Compiles a configuration value into an :class:`Expression`.
+
+    Strings are stripped and parsed for `${ ... }` blocks. Callables are
+    resolved by `ctx.interpolate`. Any other value is returned unchanged
+    when the expression is called.
+    """
+
+    if isinstance(value, Expression):
+        return value
+
+    if callable(value):
+        return CallableExpression(value)
+
+    if not isinstance(value, str):
+        return ConstantExpression(value, value)
+
+    template = value.strip()
+    if '${|' in template:
+        return DynamicExpression(template)
+
+    parts = []
+    pos = 0
+    while True:
+        pos_start = template.find('${', pos)
+        if pos_start < 0:
+            break
+        pos_end = template.find('}', pos_start)
+        if pos_end < 0:
+            # Unterminated expression, keep the original (dynamic) behaviour
+            return DynamicExpression(template)
+
+        if pos_start > pos:
+            parts.append(template[pos:pos_start])
+        parts.append(CodeExpression(value, template[pos_start + 2:pos_end].strip()))
+        pos = pos_end + 1
+
+    if pos < len(template):
+        parts.append(template[pos:])
+
+    if not [part for part in parts if isinstance(part, CodeExpression)]:
+        return ConstantExpression(value, template)
+    if len(parts) == 1:
+        return parts[0]
+
+    return TemplateExpression(value, parts)
+
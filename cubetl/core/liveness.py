@@ -0,0 +1,123 @@
+# CubETL
+# Copyright (c) 2013-2019 Jose Juan Montes
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""
+Field liveness analysis for chains.
+
+A chain can declare which fields of its output messages are used after it
+(see the `fields` attribute of :class:`~cubetl.flow.Chain`). The fields needed
+before each step are then computed backwards from the end of the chain, and
+the chain drops any other fields as early as possible (see :class:`~cubetl.flow.Project`),
+so they are not carried, copied or serialized through the rest of the flow.
+
+Nodes declare the fields they use through the `live_fields(ctx, live)` method,
+which receives the set of fields needed after the node and returns the set
+of fields needed before it. Nodes that may read any field (like nodes running
+functions or printing whole messages) return None, which is the default, and
+no fields are dropped before them.
+"""
+
+import logging
+
+from cubetl.core import Node
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+def expression_fields(ctx, *values):
+    """
+    Returns the set of message fields read by the given values (which are
+    compiled as expressions), or None if any field may be read.
+    """
+    fields = set()
+    for value in values:
+        if value is None:
+            continue
+        value_fields = ctx.compile(value).fields
+        if value_fields is None:
+            return None
+        fields |= value_fields
+    return fields
+
+
+def needed_fields(ctx, live, *values, written=()):
+    """
+    Helper for `live_fields` implementations. Returns the fields needed before
+    a node that reads the given values (expressions) and assigns the `written`
+    fields, given the fields needed after it (`live`).
+    """
+    if live is None:
+        return None
+    fields = expression_fields(ctx, *values)
+    if fields is None:
+        return None
+    return (set(live) - set(written)) | fields
+
+
+def steps_fields(ctx, steps, live):
+    """
+    Returns the fields needed before running a sequence of steps,
+    given the fields needed after them.
+    """
+    for step in reversed(steps):
+        if live is None:
+            break
+        live = step.live_fields(ctx, live)
+    return live
+
+
+def projections(ctx, steps, fields):
+    """
+    Returns the points where fields can be dropped from the messages that
+    run through the given steps, as a list of `(index, fields)` tuples,
+    where `fields` are the fields to keep before the step at `index`
+    (an index equal to the number of steps refers to the output messages).
+
+    Fields are dropped at the first point where the needed fields are known,
+    after steps that produce several messages (which usually add new fields),
+    and after steps that are the last to read some field.
+    """
+
+    # Fields needed before each step (and at the end)
+    lives = [None] * (len(steps) + 1)
+    live = set(fields)
+    lives[len(steps)] = live
+    for idx in reversed(range(len(steps))):
+        if live is not None:
+            live = steps[idx].live_fields(ctx, live)
+        lives[idx] = live
+
+    result = []
+    previous = None
+    for idx, live in enumerate(lives):
+        if live is not None:
+            if (previous is None or (previous - live) or
+                    steps[idx - 1].cardinality == Node.CARDINALITY_MANY):
+                result.append((idx, sorted(live)))
+        previous = live
+
+    logger.debug("Field liveness for steps %s: %s" % ([str(step) for step in steps], lives))
+
+    return result
@@ -0,0 +1,123 @@
+# CubETL
+# Copyright (c) 2013-2019 Jose Juan Montes
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from collections import Counter
+import dis
+import logging
+import tracemalloc
+
+from cubetl.core import Component, Node
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+class MemoryTracker():
+    """
+    Accounts memory by component, using `tracemalloc` snapshots.
+
+    Memory blocks still allocated when a snapshot is taken are attributed to the
+    innermost component method found on the stack that allocated them (ie. rows
+    read by a CSV reader but kept by a memory table are attributed to the reader).
+    As tracemalloc keeps only code locations, memory is grouped by component class
+    (the class defining the method), and not by component instance.
+
+    Reports show the top consumers and their growth since the previous report.
+    These are logged by :class:`~cubetl.util.log.LogPerformance` nodes and when
+    the process finishes. Note that tracing memory allocations slows down
+    execution noticeably.
+    """
+
+    def __init__(self, ctx, frames=30):
+        self.ctx = ctx
+        self.frames = frames
+
+        self._index = None
+        self._previous = Counter()
+
+    def start(self):
+        tracemalloc.start(self.frames)
+        self._previous = Counter()
+
+    def stop(self):
+        tracemalloc.stop()
+
+    def _code_index(self):
+        """
+        Returns a dictionary of filename to a list of `(first line, last line, class name)`
+        for the methods of the classes of the components in use.
+        """
+        index = {}
+        classes = set()
+        for comp in list(self.ctx.comp.components.keys()):
+            classes.update([cls for cls in type(comp).__mro__
+                            if issubclass(cls, Component) and cls not in (Component, Node)])
+
+        for cls in classes:
+            for value in vars(cls).values():
+                code = getattr(value, "__code__", None)
+                if code is None:
+                    continue
+                lines = [line for (offset, line) in dis.findlinestarts(code) if line is not None]
+                last = max(lines) if lines else code.co_firstlineno
+                index.setdefault(code.co_filename, []).append((code.co_firstlineno, last, cls.__name__))
+
+        return index
+
+    def _component(self, traceback):
+        # Frames are sorted from the oldest to the most recent
+        for frame in reversed(traceback):
+            for (first, last, name) in self._index.get(frame.filename, ()):
+                if first <= frame.lineno <= last:
+                    return name
+        return "(other)"
+
+    def usage(self):
+        """
+        Takes a snapshot and returns a Counter of the size of the memory
+        allocated by each component class.
+        """
+        self._index = self._code_index()
+
+        snapshot = tracemalloc.take_snapshot()
+
+        result = Counter()
+        for stat in snapshot.statistics('traceback'):
+            result[self._component(stat.traceback)] += stat.size
+        return result
+
+    def report(self, top=10):
+        """
+        Returns a text report of the top memory consumers (in MB), with their
+        growth since the previous report.
+        """
+        usage = self.usage()
+        (current, peak) = tracemalloc.get_traced_memory()
+
+        lines = ["%-40s %12s %12s" % ("Component", "Memory (MB)", "Growth (MB)")]
+        for name, size in usage.most_common(top):
+            lines.append("%-40s %12.3f %+12.3f" % (name[:40], size / 2 ** 20, (size - self._previous[name]) / 2 ** 20))
+        lines.append("Traced memory: %.3f MB (peak %.3f MB)" % (current / 2 ** 20, peak / 2 ** 20))
+
+        self._previous = usage
+        return "\n".join(lines)
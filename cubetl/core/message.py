@@ -0,0 +1,272 @@
+# CubETL
+# Copyright (c) 2013-2019 Jose Juan Montes
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from collections.abc import Mapping, MutableMapping
+
+
+# Marks a key deleted from a message while still present in a shared layer
+_DELETED = object()
+
+_MISSING = object()
+
+
+class Message(MutableMapping):
+    """
+    A dict-compatible, copy-on-write message.
+
+    A message is formed by a tuple of shared layers (dictionaries which are
+    never modified) and a local dictionary which receives all writes.
+    Copying a message (see :meth:`Context.copy_message`) freezes the local
+    dictionary as a new layer, which becomes shared by both the original
+    message and the copy, so fields are not copied until a message is
+    flattened. Deleted keys are marked in the local dictionary.
+
+    When the number of layers exceeds `MAX_LAYERS`, layers are flattened into
+    a single dictionary on the next copy, which bounds the cost of lookups.
+
+    Sources which produce many messages with the same fields can add them as
+    a compact :class:`Record` layer (see :meth:`copy`).
+
+    Iterating a message (or getting its length, items or comparing it)
+    requires merging its layers. The merged fields are kept until the
+    message is modified, so further calls don't merge the layers again.
+
+    Messages are pickled as plain dictionaries (with their layers flattened).
+    Use :meth:`to_dict` (or :func:`to_plain`) to obtain a plain dictionary
+    (ie. for serialization).
+    """
+
+    __slots__ = ('_layers', '_local', '_view')
+
+    MAX_LAYERS = 6
+
+    def __init__(self, *args, **kwargs):
+        self._layers = ()
+        self._local = dict(*args, **kwargs)
+        self._view = None
+
+    @staticmethod
+    def _merge(layers):
+        result = {}
+        for layer in layers:
+            result.update(layer)
+        return {key: value for key, value in result.items() if value is not _DELETED}
+
+    @classmethod
+    def _limit(cls, layers):
+        if len(layers) > cls.MAX_LAYERS:
+            layers = (Message._merge(layers), )
+        return layers
+
+    def _flatten(self):
+        """
+        Returns a dictionary with the merged message fields, which must not
+        be modified (it is kept until the message is modified).
+        """
+        if not self._layers:
+            return self._local
+        if self._view is None:
+            self._view = Message._merge(self._layers + (self._local, ))
+        return self._view
+
+    def to_dict(self):
+        """
+        Returns a new plain dictionary with the message fields.
+        """
+        return dict(self._flatten())
+
+    def copy(self, layer=None):
+        """
+        Returns a copy of this message. The copy shares all fields with
+        this message until any of them is modified.
+
+        If a `layer` mapping is given (usually a :class:`Record`), its fields
+        are added to the copy (overriding existing fields). The layer is
+        shared by reference and must not be modified afterwards.
+        """
+        if self._local:
+            self._layers = self._limit(self._layers + (self._local, ))
+            self._local = {}
+
+        m2 = self.__class__.__new__(self.__class__)
+        m2._layers = self._layers if layer is None else self._limit(self._layers + (layer, ))
+        m2._local = {}
+        m2._view = self._view if layer is None else None
+        return m2
+
+    __copy__ = copy
+
+    def _lookup(self, key):
+        value = self._local.get(key, _MISSING)
+        if value is _MISSING:
+            for layer in reversed(self._layers):
+                value = layer.get(key, _MISSING)
+                if value is not _MISSING:
+                    break
+        return value
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _MISSING or value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is _MISSING or value is _DELETED:
+            return default
+        return value
+
+    def __contains__(self, key):
+        value = self._lookup(key)
+        return not (value is _MISSING or value is _DELETED)
+
+    def __setitem__(self, key, value):
+        self._local[key] = value
+        self._view = None
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if self._layers:
+            self._local[key] = _DELETED
+        else:
+            del self._local[key]
+        self._view = None
+
+    def update(self, *args, **kwargs):
+        self._local.update(*args, **kwargs)
+        self._view = None
+
+    def clear(self):
+        self._layers = ()
+        self._local = {}
+        self._view = None
+
+    def __iter__(self):
+        return iter(self._flatten())
+
+    def __len__(self):
+        return len(self._flatten())
+
+    def keys(self):
+        return self._flatten().keys()
+
+    def items(self):
+        return self._flatten().items()
+
+    def values(self):
+        return self._flatten().values()
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            other = other._flatten()
+        elif not isinstance(other, dict):
+            return super().__eq__(other)
+        return self._flatten() == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (self.__class__, (self._flatten(), ))
+
+    def __repr__(self):
+        return repr(self._flatten())
+
+
+def to_plain(value):
+    """
+    Returns a plain dictionary if the value is a :class:`Message` (ie. for
+    serializers that require dictionaries), or the value itself otherwise.
+    """
+    if isinstance(value, Message):
+        return value.to_dict()
+    return value
+
+
+
+class Schema():
+    """
+    An ordered set of field names, shared by all the records produced by a
+    source (ie. the header of a CSV file or the columns of a query result).
+    """
+
+    __slots__ = ('names', 'index')
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        # Repeated names resolve to the last value, as when assigning to a dict
+        self.index = {name: idx for idx, name in enumerate(self.names)}
+
+    def record(self, values):
+        return Record(self, tuple(values))
+
+    def __repr__(self):
+        return "Schema(%r)" % (self.names, )
+
+
+class Record(Mapping):
+    """
+    A read-only mapping of the fields in a :class:`Schema` to a tuple of values.
+
+    Records are used as message layers (see :meth:`Message.copy`), so nodes
+    see a normal message. Fields added or modified by nodes are stored by
+    the message, and the record is left unchanged.
+
+    Records may hold fewer values than schema fields (missing fields are
+    not present in the record).
+    """
+
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema, values):
+        self.schema = schema
+        self.values = values
+
+    def get(self, key, default=None):
+        idx = self.schema.index.get(key, None)
+        if idx is None or idx >= len(self.values):
+            return default
+        return self.values[idx]
+
+    def __getitem__(self, key):
+        idx = self.schema.index.get(key, None)
+        if idx is None or idx >= len(self.values):
+            raise KeyError(key)
+        return self.values[idx]
+
+    def __contains__(self, key):
+        idx = self.schema.index.get(key, None)
+        return idx is not None and idx < len(self.values)
+
+    def __iter__(self):
+        count = len(self.values)
+        return (name for name, idx in self.schema.index.items() if idx < count)
+
+    def __len__(self):
+        count = len(self.values)
+        if count >= len(self.schema.names):
+            return len(self.schema.index)
+        return len([idx for idx in self.schema.index.values() if idx < count])
+
+    def __repr__(self):
+        return repr(dict(self))
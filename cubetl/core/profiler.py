@@ -0,0 +1,130 @@
+# CubETL
+# Copyright (c) 2013-2019 Jose Juan Montes
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from collections import Counter
+from inspect import isclass
+import logging
+import signal
+import threading
+
+from cubetl.core import Component
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler():
+    """
+    Statistical profiler which samples the stack of the main thread at a given
+    interval of CPU time (using `signal.setitimer`). Each sample walks the
+    stack, so the overhead grows with the sampling rate and the depth of the
+    flow, and should be measured before leaving it enabled on production runs.
+
+    Each sample is attributed to the CubETL components found on the stack (the
+    same frame walk used for error reporting, see :meth:`Context._class_from_frame`),
+    from the outermost to the innermost, followed by the function running when
+    the sample was taken. Samples are saved to a file in "folded stacks" format
+    (one `frame;frame;... count` line per distinct stack), which can be rendered
+    as a flame graph (ie. with `flamegraph.pl` or speedscope).
+
+    Only the main thread is sampled, so time spent in other threads (ie. in
+    :class:`~cubetl.flow.Concurrent` workers) is not accounted for. Signal
+    handlers can only be set from the main thread, so the profiler is disabled
+    (with a warning) if started from another thread.
+    """
+
+    def __init__(self, path, interval=0.01):
+        self.path = path
+        self.interval = interval
+
+        self.samples = Counter()
+        self._started = False
+        self._handler = None
+        self._class_from_frame = None
+
+    @staticmethod
+    def _label(comp):
+        return str(comp).replace(";", ",").replace(" ", "_").replace("\n", "_")
+
+    def _sample(self, signum, frame):
+
+        stack = []
+        code = frame.f_code if frame else None
+        while frame is not None:
+            fc = self._class_from_frame(frame)
+            if isclass(fc) and issubclass(fc, Component):
+                comp = frame.f_locals['self']
+                if not stack or stack[-1] is not comp:
+                    stack.append(comp)
+            frame = frame.f_back
+
+        if not stack:
+            return
+
+        labels = [self._label(comp) for comp in reversed(stack)]
+        labels.append("%s:%s" % (code.co_filename.rsplit("/", 1)[-1], code.co_name))
+        self.samples[";".join(labels)] += 1
+
+    def start(self):
+        from cubetl.core.context import Context
+        self._class_from_frame = Context._class_from_frame
+
+        self.samples.clear()
+        if threading.current_thread() is not threading.main_thread():
+            logger.warning("Not sampling execution profile to %s (can only be sampled from the main thread)" % self.path)
+            return
+
+        self._handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self._started = True
+
+    def stop(self):
+        if not self._started:
+            return
+        self._started = False
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._handler or signal.SIG_DFL)
+        self._handler = None
+        self.save()
+
+    def component_samples(self):
+        """
+        Returns a Counter of the samples taken while each component was the
+        innermost component on the stack.
+        """
+        result = Counter()
+        for stack, count in self.samples.items():
+            labels = stack.split(";")
+            result[labels[-2]] += count
+        return result
+
+    def save(self):
+        total = sum(self.samples.values())
+        with open(self.path, "w") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write("%s %d\n" % (stack, count))
+
+        lines = ["%-60s %10d %6.1f%%" % (label[:60], count, count * 100.0 / total)
+                 for label, count in self.component_samples().most_common(10)]
+        logger.info("Saved %d profiling samples to %s (%d stacks). Top components:\n%s" % (
+                    total, self.path, len(self.samples), "\n".join(lines)))
@@ -0,0 +1,142 @@
+# CubETL
+# Copyright (c) 2013-2019 Jose Juan Montes
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import logging
+import multiprocessing
+import time
+
+from cubetl.core.exceptions import ETLConfigurationException, ETLException
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+def _run_start_node(argv, node_name):
+    """
+    Runs a start node on a new context, built from the command line arguments
+    (and config files) of the parent process.
+    """
+    from cubetl.core.bootstrap import Bootstrap
+
+    bootstrap = Bootstrap()
+    ctx = bootstrap.init(argv, cli=True)
+
+    # Each process saves its own checkpoint state and profile
+    if ctx.checkpoint:
+        ctx.checkpoint.path = "%s.%s" % (ctx.checkpoint.path, node_name)
+    if ctx.sample:
+        ctx.sample = "%s.%s" % (ctx.sample, node_name)
+
+    for configfile in ctx.config_files:
+        ctx.include(configfile)
+
+    ctx.run(ctx.get(node_name))
+
+
+class Scheduler():
+    """
+    Runs several start nodes, each on its own process with its own context,
+    running up to `jobs` nodes at the same time.
+
+    Nodes are started in the given order once all their dependencies
+    (a dictionary of node name to a list of node names) have finished.
+    If a node fails, running nodes are terminated and no further nodes
+    are started.
+
+    When checkpointing, each node saves its state to its own file (named after
+    the checkpoint file and the node name).
+    """
+
+    def __init__(self, ctx, nodes, dependencies=None, jobs=1):
+        self.ctx = ctx
+        self.nodes = nodes
+        self.dependencies = dependencies or {}
+        self.jobs = jobs
+
+        self.timings = {}
+
+    def order(self):
+        """
+        Returns the list of nodes sorted so each node comes after its dependencies.
+        """
+        for node, deps in self.dependencies.items():
+            for dep in [node] + list(deps):
+                if dep not in self.nodes:
+                    raise ETLConfigurationException("Node '%s' in dependencies is not a start node" % dep)
+
+        result = []
+        pending = list(self.nodes)
+        while pending:
+            ready = [node for node in pending if all([dep in result for dep in self.dependencies.get(node, [])])]
+            if not ready:
+                raise ETLConfigurationException("Circular dependencies between start nodes: %s" % ", ".join(pending))
+            result.append(ready[0])
+            pending.remove(ready[0])
+
+        return result
+
+    def run(self):
+
+        from multiprocessing.connection import wait
+
+        pending = self.order()
+        mp = multiprocessing.get_context("fork")
+
+        start = time.time()
+        running = {}
+        finished = []
+
+        try:
+            while pending or running:
+
+                # Start nodes whose dependencies have finished
+                for node in list(pending):
+                    if len(running) >= self.jobs:
+                        break
+                    if all([dep in finished for dep in self.dependencies.get(node, [])]):
+                        logger.info("Starting node %s" % node)
+                        process = mp.Process(target=_run_start_node, args=(self.ctx.argv, node),
+                                             name="cubetl-%s" % node)
+                        process.start()
+                        running[process.sentinel] = (node, process, time.time())
+                        pending.remove(node)
+
+                for sentinel in wait(list(running.keys())):
+                    (node, process, node_start) = running.pop(sentinel)
+                    process.join()
+                    self.timings[node] = time.time() - node_start
+                    if process.exitcode != 0:
+                        raise ETLException("Node %s failed (exit code %s) after %.3f s" % (node, process.exitcode, self.timings[node]))
+                    logger.info("Node %s finished in %.3f s" % (node, self.timings[node]))
+                    finished.append(node)
+
+        finally:
+            for (node, process, node_start) in running.values():
+                logger.warning("Terminating node %s" % node)
+                process.terminate()
+                process.join()
+
+        logger.info("Finished %d nodes in %.3f s (%s)" % (
+                    len(finished), time.time() - start,
+                    ", ".join(["%s: %.3f s" % (node, self.timings[node]) for node in finished])))
+
@@ -0,0 +1,204 @@
+# CubETL
+# Copyright (c) 2013-2019 Jose Juan Montes
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import signal
+import socketserver
+import stat
+import sys
+import time
+
+from cubetl.core.memory import MemoryTracker
+from cubetl.core.profiler import SamplingProfiler
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+class Service():
+    """
+    Runs jobs against a context whose components are initialized once and kept
+    initialized until the service stops, so configuration loading, database
+    connections, table reflection and caches (like :class:`~cubetl.sql.cache.CachedSQLTable`)
+    are reused by all jobs.
+
+    Jobs are JSON objects, one per line, read from the standard input or from
+    the connections to a UNIX socket. When reading from the standard input,
+    results are written to the standard output, and anything else written to
+    it by the process (ie. by :class:`~cubetl.util.Print` nodes) is redirected
+    to the standard error. The attributes of each job are set on the
+    start item (in addition to those given in the command line), and the start
+    nodes are run in order. A JSON line with the result is written back for
+    each job: `{"job": n, "status": "ok", "messages": n, "time": seconds}` or
+    `{"job": n, "status": "error", "error": message}`.
+
+    Before each job, components reset their per-run state (see :meth:`Component.before_job`).
+    Components are finalized (and any pending output written) when the service stops,
+    either at the end of the input, or when interrupted or terminated.
+    """
+
+    def __init__(self, ctx, start_nodes):
+        self.ctx = ctx
+        self.start_nodes = start_nodes
+        self.jobs = 0
+
+        self._profiler = None
+
+    def open(self):
+        if self.ctx.memory:
+            logger.warning("Tracing memory allocations by component (WARNING this is SLOW)")
+            self.ctx.memory_tracker = MemoryTracker(self.ctx)
+            self.ctx.memory_tracker.start()
+
+        logger.debug("Initializing components")
+        for node in self.start_nodes:
+            self.ctx.comp.initialize(node)
+
+        if self.ctx.sample:
+            logger.info("Sampling execution profile to: %s" % self.ctx.sample)
+            self._profiler = SamplingProfiler(self.ctx.sample)
+            self._profiler.start()
+
+    def close(self):
+        if self._profiler:
+            self._profiler.stop()
+            self._profiler = None
+
+        self.ctx._finish(self.start_nodes)
+        logger.info("Service finished after %d jobs" % self.jobs)
+
+    def run_job(self, attributes):
+        """
+        Runs the start nodes for a job, with the given start item attributes.
+        Returns the job result as a dictionary.
+        """
+        ctx = self.ctx
+
+        self.jobs += 1
+        start = time.time()
+
+        start_item = OrderedDict(ctx.start_item)
+        start_item.update(attributes)
+
+        for desc in list(ctx.comp.components.values()):
+            if desc.initialized and not desc.finalized:
+                desc.comp.before_job(ctx)
+
+        processed = 0
+        try:
+            for node in self.start_nodes:
+                logger.info("Processing %s (job %d)" % (node, self.jobs))
+                (result, count) = ctx._do_process(node, ctx, multiple=False, start_item=start_item)
+                processed += count
+        except Exception as e:
+            logger.error("Error running job %d: %s" % (self.jobs, e))
+            return {"job": self.jobs, "status": "error", "error": str(e)}
+
+        return {"job": self.jobs, "status": "ok", "messages": processed, "time": round(time.time() - start, 3)}
+
+    def _handle(self, line):
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            attributes = json.loads(line)
+            if not isinstance(attributes, dict):
+                raise ValueError("jobs must be JSON objects")
+        except ValueError as e:
+            logger.error("Invalid job (%s): %s" % (e, line))
+            return {"status": "error", "error": "Invalid job: %s" % e}
+        return self.run_job(attributes)
+
+    def serve_stream(self, input, output):
+        """
+        Runs jobs read as JSON lines from a text stream, until the end of the stream.
+        """
+        for line in input:
+            result = self._handle(line)
+            if result is not None:
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+
+    def serve_socket(self, path):
+        """
+        Listens on a UNIX socket at the given path, running jobs read as JSON
+        lines from each connection. Connections are served one at a time.
+        """
+        service = self
+
+        class JobHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    result = service._handle(line.decode("utf-8"))
+                    if result is not None:
+                        self.wfile.write((json.dumps(result) + "\n").encode("utf-8"))
+
+        # Remove a stale socket from a previous run (but never other files)
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+
+        server = socketserver.UnixStreamServer(path, JobHandler)
+        logger.info("Listening for jobs on %s" % path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(path)
+
+    def _redirect_stdout(self):
+        """
+        Redirects the standard output to the standard error, at the file
+        descriptor level, and returns a stream writing to the original
+        standard output, which is kept for job results only.
+        """
+        sys.stdout.flush()
+        output = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        return output
+
+    def serve(self, path="-"):
+        """
+        Initializes components and runs jobs from the standard input (if path is `-`)
+        or from a UNIX socket at the given path, finalizing components when done.
+        """
+
+        def terminate(signum, frame):
+            raise KeyboardInterrupt()
+
+        signal.signal(signal.SIGTERM, terminate)
+
+        output = self._redirect_stdout() if path == "-" else None
+
+        self.open()
+        try:
+            if path == "-":
+                self.serve_stream(sys.stdin, output)
+            else:
+                self.serve_socket(path)
+        except KeyboardInterrupt:
+            logger.info("Service stopped")
+
+        self.close()
@@ -28,6 +28,8 @@ import logging
 
 from cubetl.core import Node
 from cubetl.core.exceptions import ETLException
+from cubetl.core.liveness import needed_fields
+from cubetl.core.message import Schema
 from cubetl.fs import FileReader, FileWriter
 import chardet
 import re
@@ -38,6 +40,22 @@ logger = logging.getLogger(__name__)
 
 
 class CsvReader(Node):
+    """
+    Parses CSV data, producing a message for each row. Messages are copies of
+    the input message with a field for each column.
+
+    If `compact` is True, the fields of each row are kept as a :class:`Record`
+    (a tuple of values bound to the header, which is shared by all rows),
+    instead of being copied to each message. This reduces memory usage
+    when many rows are kept (ie. in a MemoryTable), and is transparent
+    for other nodes.
+
+    When checkpointing, the number of rows processed from each file (as
+    given by the `_file_path` message attribute set by file readers) is saved,
+    and these rows are skipped when the same file is resumed.
+    """
+
+    cancellable = True
 
     def __init__(self):
         super().__init__()
@@ -51,10 +69,13 @@ class CsvReader(Node):
         self.row_delimiter = "\n"
         self.ignore_missing = False
         self.strip = False
+        self.compact = False
 
         self.count = 0
         self._linenumber = 0
 
+    def before_job(self, ctx):
+        self.count = 0
 
     '''
     def _utf_8_encoder(self, unicode_csv_data):
@@ -83,6 +104,17 @@ class CsvReader(Node):
         #    rows = [r.strip() for r in rows]
 
         reader = csv.reader(rows, delimiter=self.delimiter, skipinitialspace=self.strip, doublequote=True, quotechar='"')
+        base = ctx.copy_message(m)
+        schema = Schema(header) if (self.compact and header is not None) else None
+
+        path = m.get('_file_path', None) if m is not None else None
+        skip = 0
+        if ctx.checkpoint and path:
+            position = ctx.checkpoint.resume_position(self)
+            if position and position["path"] == path:
+                skip = position["rows"]
+                logger.info("Resuming CSV data from %s after row %d" % (path, skip))
+
         for row in reader:
 
             # Skip empty lines
@@ -97,16 +129,30 @@ class CsvReader(Node):
             if header is None:
                 header = [v for v in row]
                 logger.debug("CSV header is: %s" % header)
+                if self.compact:
+                    schema = Schema(header)
                 continue
 
             #if (self._linenumber == 0) and (self.header): continue
 
             self._linenumber = self._linenumber + 1
+            if self._linenumber <= skip:
+                continue
 
             #arow = {}
-            if (len(row) > 0):
+            if (len(row) > 0) and schema is not None:
+                if len(row) < len(header) and not self.ignore_missing:
+                    logger.error("Could not process CSV data (%r) at %s: missing columns" % (row, self))
+                    raise ETLException("Could not process CSV data (%r) at %s: missing columns" % (row, self))
+                values = row[:len(header)]
+                if self.strip:
+                    values = [value.strip() for value in values]
+                yield base.copy(schema.record(values))
+                self._update_checkpoint(ctx, path)
+
+            elif (len(row) > 0):
                 try:
-                    arow = ctx.copy_message(m)
+                    arow = base.copy()
                     for header_index in range(0, len(header)):
                         if header_index < len(row) or not self.ignore_missing:
                             # arow[(header[header_index])] = str(row[header_index], "utf-8")
@@ -123,6 +169,21 @@ class CsvReader(Node):
                     arow['_csv_linenumber'] = self._linenumber
 
                 yield arow
+                self._update_checkpoint(ctx, path)
+
+    def live_fields(self, ctx, live):
+        header = self.headers
+        if isinstance(header, str):
+            header = [h.strip() for h in header.split(",")]
+        fields = needed_fields(ctx, live, self.data, written=header or [])
+        if fields is not None:
+            # Used for checkpointing
+            fields.add('_file_path')
+        return fields
+
+    def _update_checkpoint(self, ctx, path):
+        if ctx.checkpoint and path:
+            ctx.checkpoint.update(self, {"path": path, "rows": self._linenumber})
 
 
 class CsvFileReader (CsvReader):
@@ -163,6 +224,10 @@ class CsvFileReader (CsvReader):
             for csv_row in csv_rows:
                 yield csv_row
 
+    def live_fields(self, ctx, live):
+        fields = super(CsvFileReader, self).live_fields(ctx, live)
+        return needed_fields(ctx, fields, self.path, self.encoding, written=["data", "_file_path", "_encoding"])
+
 
 class CsvFileWriter(Node):
     """
@@ -196,6 +261,7 @@ class CsvFileWriter(Node):
         self._row = 0
         self._output = None
         self._csvwriter = None
+        self._values = None
 
     def initialize(self, ctx):
 
@@ -210,7 +276,7 @@ class CsvFileWriter(Node):
 
         ctx.comp.initialize(self._fileWriter)
 
-    def initialize_columns(self):
+    def initialize_columns(self, ctx):
 
         for c in self.columns:
             if "label" not in c:
@@ -218,6 +284,8 @@ class CsvFileWriter(Node):
             if "value" not in c:
                 c["value"] = '${ m["' + c["name"] + '"] }'
 
+        self._values = [ctx.compile(c["value"]) for c in self.columns]
+
     def columns_from_message(self, ctx, m):
         self.columns = []
         for k, v in m.items():
@@ -227,6 +295,12 @@ class CsvFileWriter(Node):
         # Sort by name for repeatable results
         self.columns.sort(key=lambda c: c['name'])
 
+    def live_fields(self, ctx, live):
+        if self.columns is None:
+            return None
+        values = [c.get("value", '${ m["' + c["name"] + '"] }') for c in self.columns]
+        return needed_fields(ctx, live, self.path, *values)
+
     def finalize(self, ctx):
         ctx.comp.finalize(self._fileWriter)
         super(CsvFileWriter, self).finalize(ctx)
@@ -242,7 +316,7 @@ class CsvFileWriter(Node):
         self._output.seek(0)
         return result
 
-    def process(self, ctx, m):
+    def _prepare(self, ctx, m):
 
         if not self._csvwriter:
             self._output = io.StringIO()
@@ -255,22 +329,39 @@ class CsvFileWriter(Node):
             if self.columns is None and self.auto_columns and m:
                 self.columns_from_message(ctx, m)
 
-            self.initialize_columns()
+            self.initialize_columns(ctx)
 
             # Write headers
             if (self.write_headers):
                 row = [c["label"] for c in self.columns]
                 m['_csvdata'] = self._csv_row(ctx, row)
                 self._fileWriter.process(ctx, m)
+                del (m['_csvdata'])
 
         self._row = self._row + 1
 
-        row = [ctx.interpolate(c["value"], m) for c in self.columns]
+    def process(self, ctx, m):
+
+        self._prepare(ctx, m)
+
+        row = [value(ctx, m) for value in self._values]
         m['_csvdata'] = self._csv_row(ctx, row)
         self._fileWriter.process(ctx, m)
         del (m['_csvdata'])
 
         yield m
 
+    def process_batch(self, ctx, messages):
+
+        data = []
+        for m in messages:
+            self._prepare(ctx, m)
+            row = [value(ctx, m) for value in self._values]
+            data.append(self._csv_row(ctx, row))
+
+        self._fileWriter.write_batch(ctx, messages, data)
+
+        return messages
+
 
 
@@ -23,6 +23,7 @@
 import logging
 
 from cubetl.core import Component, Node
+from cubetl.core.message import to_plain
 from elasticsearch import Elasticsearch, helpers
 import elasticsearch
 import datetime
@@ -62,14 +63,23 @@ class ElasticsearchConnection(Component):
         #    'text': 'Elasticsearch: cool. bonsai cool.',
         #    'timestamp': datetime.datetime.now(),
         #}
+        data = to_plain(data)
         res = self.conn().index(index=index, doc_type=doc_type, id=data_id, body=data)
         #print(res['result'])  # created, updated
 
     def index_bulk(self, index, doc_type, data_id, data):
-        bulk_obj = {'_index': index,
-                    '_id': data_id,
-                    '_source': data}
-        self._index_bulk_buffer.append(bulk_obj)
+        self.index_bulk_many([(index, doc_type, data_id, data)])
+
+    def index_bulk_many(self, items):
+        """
+        Adds several (index, doc_type, data_id, data) items to the bulk index buffer.
+        """
+        for index, doc_type, data_id, data in items:
+            data = to_plain(data)
+            bulk_obj = {'_index': index,
+                        '_id': data_id,
+                        '_source': data}
+            self._index_bulk_buffer.append(bulk_obj)
         if len(self._index_bulk_buffer) > 500:
             helpers.bulk(self.conn(), (bulk_obj for bulk_obj in self._index_bulk_buffer))
             self._index_bulk_buffer = []
@@ -141,18 +151,41 @@ class Index(Node):
         self.doc_type = doc_type
         self.data_id = data_id
 
+        self._index = None
+        self._doc_type = None
+        self._data_id = None
+
+    def initialize(self, ctx):
+        super().initialize(ctx)
+        self._index = ctx.compile(self.index)
+        self._doc_type = ctx.compile(self.doc_type)
+        self._data_id = ctx.compile(self.data_id)
 
     def process(self, ctx, m):
 
-        index = ctx.interpolate(self.index, m)
-        doc_type = ctx.interpolate(self.doc_type, m)
-        data_id = int(ctx.interpolate(self.data_id, m))
+        index = self._index(ctx, m)
+        doc_type = self._doc_type(ctx, m)
+        data_id = int(self._data_id(ctx, m))
         #self.es.index(index, doc_type, data_id, m)
         del(m['id'])
         self.es.index_bulk(index, doc_type, data_id, m)
 
         yield m
 
+    def process_batch(self, ctx, messages):
+
+        items = []
+        for m in messages:
+            index = self._index(ctx, m)
+            doc_type = self._doc_type(ctx, m)
+            data_id = int(self._data_id(ctx, m))
+            del(m['id'])
+            items.append((index, doc_type, data_id, m))
+
+        self.es.index_bulk_many(items)
+
+        return messages
+
 
 class Search(Node):
 
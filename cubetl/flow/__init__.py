@@ -20,11 +20,21 @@
 # SOFTWARE.
 
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import logging
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
 
 from cubetl.core import Node
-from cubetl.core.exceptions import ETLConfigurationException
+from cubetl.core.exceptions import ETLCancelException, ETLConfigurationException, ETLException
+from cubetl.core.message import Message
+from cubetl.flow.fusion import FusedSteps, fuse_steps
+from cubetl.core.liveness import needed_fields, projections, steps_fields
 from cubetl.script import Eval
 from cubetl.text.functions import parsebool
 
@@ -33,59 +43,373 @@ from cubetl.text.functions import parsebool
 logger = logging.getLogger(__name__)
 
 
+class FlowBranch(threading.Thread):
+    """
+    Runs a branch of a flow (a forked chain or a union step) on its own
+    thread, fed through a bounded queue (see :class:`Chain` and :class:`Union`).
+
+    Tasks are `(seq, messages)` tuples. If a `results` queue is given, a
+    `(seq, branch, output_messages)` tuple is put on it for each task, otherwise
+    output messages are discarded. If the branch fails, the exception is kept
+    in `error` and further tasks are ignored. Tasks are also ignored once the
+    branch has been cancelled (see :class:`ETLCancelException`).
+    """
+
+    def __init__(self, ctx, name, process, queue_size, results=None):
+        super().__init__(name=name, daemon=True)
+        self.ctx = ctx
+        self.process = process
+        self.input = queue.Queue(maxsize=queue_size)
+        self.results = results
+        self.error = None
+        self.cancelled = False
+        self.count = 0
+
+    def run(self):
+        while True:
+            task = self.input.get()
+            if task is None:
+                break
+
+            (seq, msgs) = task
+            output = None
+            if self.error is None and not self.cancelled:
+                try:
+                    output = []
+                    for m in msgs:
+                        for m2 in self.process(self.ctx, m):
+                            self.count = self.count + 1
+                            if self.results is not None:
+                                output.append(m2)
+                except ETLCancelException:
+                    logger.debug("Flow branch %s cancelled" % self.name)
+                    self.cancelled = True
+                except Exception as e:
+                    logger.error("Error in flow branch %s: %s" % (self.name, e))
+                    self.error = e
+
+            if self.results is not None:
+                self.results.put((seq, self, output))
+
+    def stop(self):
+        self.input.put(None)
+        self.join()
+
+
 class Chain(Node):
+    """
+    Runs messages through a sequence of steps. Each message yielded by a step
+    is processed by the next step, and messages yielded by the last step
+    are yielded by the chain.
+
+    Steps are flattened on initialization (steps of nested chains that are
+    not forked or conditional are run as steps of this chain), and runs of
+    nodes that produce at most one message are fused into a single function
+    (see :mod:`cubetl.flow.fusion`). Messages are then driven through the
+    steps iteratively, using a stack of the generators of each step.
+
+    :param steps: The list of nodes to run.
+    :param fork: If True, the steps are run on a copy of the message, their
+                 output is discarded and the original message is yielded.
+    :param condition: If defined, steps are only run for messages for which
+                      the condition evaluates to True.
+    :param batch_size: If defined, the chain runs in batch mode: messages
+                       produced by each step are grouped in lists of up to
+                       `batch_size` messages, which are passed to the
+                       `process_batch` method of the next step.
+    :param parallel: If True, a forked chain runs its steps on its own thread,
+                     fed through a queue of up to `queue_size` messages,
+                     while the original message continues through the flow.
+                     Errors in the forked steps are raised on the next message
+                     or when the chain is finalized. Steps must be safe to
+                     run concurrently with the rest of the flow (see :class:`Concurrent`).
+    :param fields: If defined, the list of fields of the output messages that
+                   are used after the chain (an empty list for a forked chain).
+                   Message fields are then dropped as soon as no following step
+                   needs them (see :mod:`cubetl.core.liveness`).
+
+    If a step is cancelled (see :class:`ETLCancelException`) and the steps
+    before it are all `cancellable`, these are closed, and the cancellation is
+    propagated to the caller of the chain, unless the chain is forked or
+    conditional, in which case its steps are not run anymore. Otherwise, the
+    steps before it go on processing messages, and messages are discarded
+    when they reach the cancelled step.
+    """
 
-    def __init__(self, steps, fork=False, condition=None):
+    def __init__(self, steps, fork=False, condition=None, batch_size=None, parallel=False, queue_size=100, fields=None):
         super().__init__()
         self.steps = steps or []
         self.fork = fork
         self.condition = condition
+        self.batch_size = batch_size
+        self.parallel = parallel
+        self.queue_size = queue_size
+        self.fields = fields
+
+        self._condition = None
+        self._steps = None
+        self._projections = []
+        self._branch = None
+        self._cancelled = False
 
     def initialize(self, ctx):
         super().initialize(ctx)
+        self._cancelled = False
+        self._condition = ctx.compile(self.condition)
         for p in self.steps:
             if p is None:
                 raise ETLConfigurationException("Component %s steps contain a None reference." % self)
             ctx.comp.initialize(p)
 
+        steps = self._flatten_steps()
+        if self.fields is not None:
+            steps = self._project_steps(ctx, steps)
+        self._steps = tuple(fuse_steps(ctx, steps))
+
+        self.parallel = parsebool(self.parallel)
+        if self.parallel and not self.fork:
+            raise ETLConfigurationException("Only forked chains can run in parallel: %s" % self)
+
+    def before_job(self, ctx):
+        self._cancelled = False
+
+    @property
+    def cancellable(self):
+        return all([step.cancellable for step in self.steps])
+
+    def _project_steps(self, ctx, steps):
+        """
+        Inserts :class:`Project` steps where message fields can be dropped.
+        """
+        self._projections = []
+        result = list(steps)
+        for idx, fields in reversed(projections(ctx, steps, self.fields)):
+            if idx < len(steps) and isinstance(steps[idx], Project):
+                continue
+            project = Project(fields)
+            ctx.comp.initialize(project)
+            self._projections.append(project)
+            result.insert(idx, project)
+
+        logger.debug("Chain %s drops unused fields at %d points" % (self, len(self._projections)))
+        return result
+
+    def live_fields(self, ctx, live):
+        if live is None:
+            return None
+        steps_live = steps_fields(ctx, self._flatten_steps(), set() if self.fork else live)
+        if steps_live is None:
+            return None
+        return needed_fields(ctx, set(live) | steps_live, self.condition)
+
+    def _flatten_steps(self):
+        steps = []
+        for p in self.steps:
+            # Chains with their own batch mode or field projections keep them
+            if (type(p) is Chain and not p.fork and not p.condition and not p.batch_size and
+                    p.fields is None):
+                steps.extend(p._flatten_steps())
+            else:
+                steps.append(p)
+        return steps
+
     def finalize(self, ctx):
+        error = None
+        if self._branch:
+            self._branch.stop()
+            logger.debug("Forked flow end - discarded %d messages" % self._branch.count)
+            error = self._branch.error
+            self._branch = None
+
         for p in self.steps:
             ctx.comp.finalize(p)
+        for p in self._projections:
+            ctx.comp.finalize(p)
         super().finalize(ctx)
 
+        if error:
+            raise ETLException("Error in forked flow %s: %s" % (self, error)) from error
+
     def _process(self, steps, ctx, m):
 
-        if (len(steps) <= 0):
-            yield m
-            return
+        count = len(steps)
+
+        # Stack of (iterator over the messages produced by a step, index of the next step)
+        stack = []
+        index = 0
+
+        # Messages are discarded once they reach this step (see ETLCancelException)
+        cancelled = count
+
+        while True:
+            current = index
+            try:
+
+                # Run the message through the steps, until a node yields
+                while index < count:
+                    if index >= cancelled:
+                        break
+                    step = steps[index]
+                    current = index
+                    if step.__class__ is FusedSteps:
+                        m = step.function(ctx, m)
+                        if m is None:
+                            break
+                        index += 1
+                    else:
+                        if ctx.debug2:
+                            logger.debug("Processing step: %s" % (step))
+                        stack.append((iter(ctx.comp.process(step, m)), index + 1))
+                        break
+                else:
+                    yield m
+
+                # Get the next message from the innermost step
+                while stack:
+                    iterator, index = stack[-1]
+                    current = index - 1
+                    try:
+                        m = next(iterator)
+                        break
+                    except StopIteration:
+                        stack.pop()
+                else:
+                    return
+
+            except ETLCancelException:
+                if all([step.cancellable for step in steps[:current]]):
+                    # Close upstream steps, so sources release their resources
+                    logger.debug("Flow cancelled at %s, closing %d upstream steps" % (self, len(stack)))
+                    for iterator, index in reversed(stack):
+                        if hasattr(iterator, "close"):
+                            iterator.close()
+                    raise
+
+                # Upstream steps have side effects, so they must process all messages
+                if current < cancelled:
+                    logger.debug("Flow cancelled at %s step %s, discarding messages that reach it" % (self, steps[current]))
+                    cancelled = current
+                while stack and stack[-1][1] > cancelled:
+                    stack.pop()
+                index = cancelled
+
+    def _process_batch_step(self, step, ctx, msgs, cancellable=True):
+        """
+        Runs a step over batches of the given messages. If the step is cancelled
+        and the steps before it are not `cancellable`, the rest of the messages
+        are consumed and discarded.
+        """
+
+        batch = []
+        cancelled = None
+        discard = False
+        msgs = iter(msgs)
+        while True:
+            try:
+                m = next(msgs)
+            except StopIteration:
+                break
+            except ETLCancelException as e:
+                # Upstream steps were cancelled, process the messages already received
+                cancelled = e
+                break
+
+            if discard:
+                continue
+
+            batch.append(m)
+            if len(batch) >= self.batch_size:
+                try:
+                    for m2 in self._run_batch_step(step, ctx, batch):
+                        yield m2
+                except ETLCancelException:
+                    if cancellable:
+                        raise
+                    logger.debug("Flow cancelled at %s step %s, discarding messages that reach it" % (self, step))
+                    discard = True
+                batch = []
+
+        if batch:
+            try:
+                for m2 in self._run_batch_step(step, ctx, batch):
+                    yield m2
+            except ETLCancelException:
+                if cancellable:
+                    raise
+
+        if cancelled:
+            raise cancelled
+
+    def _run_batch_step(self, step, ctx, batch):
 
         if ctx.debug2:
-            logger.debug("Processing step: %s" % (steps[0]))
+            logger.debug("Processing step: %s (batch of %d messages)" % (step, len(batch)))
 
-        result_msgs = ctx.comp.process(steps[0], m)
-        for m in result_msgs:
-            result_msgs2 = self._process(steps[1:], ctx, m)
-            for m2 in result_msgs2:
-                yield m2
+        if step.__class__ is FusedSteps:
+            return [m for m in (step.function(ctx, m) for m in batch) if m is not None]
+        else:
+            return ctx.comp.process_batch(step, batch)
+
+    def _process_batched(self, steps, ctx, m):
+
+        msgs = iter([m])
+        for idx, step in enumerate(steps):
+            cancellable = all([upstream.cancellable for upstream in steps[:idx]])
+            msgs = self._process_batch_step(step, ctx, msgs, cancellable)
+
+        for m in msgs:
+            yield m
+
+    def _run(self, ctx, m):
+        if self.batch_size:
+            return self._process_batched(self._steps, ctx, m)
+        else:
+            return self._process(self._steps, ctx, m)
 
     def process(self, ctx, m):
 
         cond = True
         if self.condition:
-            cond = parsebool(ctx.interpolate(self.condition, m))
+            cond = parsebool(self._condition(ctx, m))
 
-        if cond:
+        if cond and self._cancelled:
+            # Steps were cancelled: forked chains pass messages through,
+            # conditional chains drop the messages that match the condition
+            if self.fork:
+                yield m
+        elif cond:
             if (not self.fork):
-                result_msgs = self._process(self.steps, ctx, m)
-                for m in result_msgs:
-                    yield m
+                try:
+                    result_msgs = self._run(ctx, m)
+                    for m in result_msgs:
+                        yield m
+                except ETLCancelException:
+                    if not self.condition:
+                        raise
+                    logger.debug("Conditional flow %s cancelled" % self)
+                    self._cancelled = True
+            elif self.parallel:
+                if self._branch is None:
+                    self._branch = FlowBranch(ctx, "cubetl-fork-%s" % self.urn, self._run, self.queue_size)
+                    self._branch.start()
+                if self._branch.error:
+                    raise ETLException("Error in forked flow %s: %s" % (self, self._branch.error)) from self._branch.error
+                if self._branch.cancelled:
+                    self._cancelled = True
+                else:
+                    self._branch.input.put((None, [ctx.copy_message(m)]))
+                yield m
             else:
                 logger.debug("Forking flow (copying message).")
                 m2 = ctx.copy_message(m)
-                result_msgs = self._process(self.steps, ctx, m2)
                 count = 0
-                for mdis in result_msgs:
-                    count = count + 1
+                try:
+                    result_msgs = self._run(ctx, m2)
+                    for mdis in result_msgs:
+                        count = count + 1
+                except ETLCancelException:
+                    logger.debug("Forked flow %s cancelled" % self)
+                    self._cancelled = True
 
                 logger.debug("Forked flow end - discarded %d messages" % count)
                 yield m
@@ -95,34 +419,103 @@ class Chain(Node):
 
 class Filter(Node):
 
+    cardinality = Node.CARDINALITY_FILTER
+
+    cancellable = True
+
     def __init__(self, condition, message=None):
         super().__init__()
         self.condition = condition
         self.message = message
 
-    def process(self, ctx, m):
+        self._condition = None
+        self._message = None
 
-        if (parsebool(ctx.interpolate(self.condition, m))):
-            yield m
+    def initialize(self, ctx):
+        super().initialize(ctx)
+        self._condition = ctx.compile(self.condition)
+        self._message = ctx.compile(self.message)
+
+    def process_message(self, ctx, m):
+
+        if (parsebool(self._condition(ctx, m))):
+            return m
         else:
             if (self.message):
-                logger.info(ctx.interpolate(self.message, m))
+                logger.info(self._message(ctx, m))
             elif (ctx.debug2):
                 logger.debug("Filtering out message")
-            return
+            return None
+
+    def live_fields(self, ctx, live):
+        return needed_fields(ctx, live, self.condition, self.message)
+
+
+class Project(Node):
+    """
+    Keeps only the given fields of messages. Each resulting message is a new
+    message with the fields of the input message that are listed (the input
+    message is not modified).
+
+    Chains can also insert these steps themselves, by analyzing which fields
+    are needed by their steps (see the `fields` attribute of :class:`Chain`).
+
+    :param fields: The list (or comma-separated string) of fields to keep.
+    """
+
+    cardinality = Node.CARDINALITY_MAP
+
+    cancellable = True
+
+    def __init__(self, fields):
+        super().__init__()
+        self.fields = fields
+
+        self._fields = None
+
+    def initialize(self, ctx):
+        super().initialize(ctx)
+        if isinstance(self.fields, str):
+            self._fields = [field.strip() for field in self.fields.split(",") if field.strip()]
+        else:
+            self._fields = list(self.fields)
+
+    def process_message(self, ctx, m):
+        result = Message()
+        for field in self._fields:
+            if field in m:
+                result[field] = m[field]
+        return result
+
+    def live_fields(self, ctx, live):
+        if live is None:
+            return set(self._fields)
+        return set(live) & set(self._fields)
 
 
 class Skip(Node):
 
+    cancellable = True
+
     def __init__(self, skip):
         super().__init__()
         self.skip = skip
         self._next_skip = 0
 
+        self._skip = None
+        self._skip_value = None
+
     def initialize(self, ctx):
         super().initialize(ctx)
         self.counter = 0
         self._next_skip = 0
+        self._skip = ctx.compile(self.skip)
+        self._skip_value = None
+
+    def before_job(self, ctx):
+        self.counter = 0
+        self._next_skip = 0
+        self._skip_value = None
 
     def process(self, ctx, m):
 
@@ -131,35 +524,70 @@ class Skip(Node):
             # Skip message
             return
 
-        self._next_skip = int(ctx.interpolate(self.skip, m))
+        if self._skip_value is not None:
+            self._next_skip = self._skip_value
+        else:
+            self._next_skip = int(self._skip(ctx, m))
+            if self._skip.constant:
+                # Not message dependent, evaluated once per run
+                self._skip_value = self._next_skip
         self.counter = 0
 
         yield m
 
+    def live_fields(self, ctx, live):
+        return needed_fields(ctx, live, self.skip)
+
 
 class Limit(Node):
 
+    cancellable = True
+
     def __init__(self, limit):
         super().__init__()
         self.limit = limit
         self.counter = 0
 
+        self._limit = None
+        self._limit_value = None
+
     def initialize(self, ctx):
         super().initialize(ctx)
         self.counter = 0
+        self._limit = ctx.compile(self.limit)
+        self._limit_value = None
+
+    def before_job(self, ctx):
+        self.counter = 0
+        self._limit_value = None
 
     def process(self, ctx, m):
 
         self.counter += 1
-        limit = int(ctx.interpolate(self.limit, m))
+
+        limit = self._limit_value
+        if limit is None:
+            limit = int(self._limit(ctx, m))
+            if self._limit.constant:
+                # Not message dependent, evaluated once per run
+                self._limit_value = limit
 
         if self.counter > limit:
+            if self._limit.constant:
+                raise ETLCancelException()
             # Skip message
-            # TODO: We shall actually break the process flow, signalling backwards (return or yield some constant?)
             return
 
         yield m
 
+        # Once the last message has been processed, cancel upstream
+        # steps instead of waiting for the next message
+        if self.counter >= limit and self._limit.constant:
+            raise ETLCancelException()
+
+    def live_fields(self, ctx, live):
+        return needed_fields(ctx, live, self.limit)
+
 
 class Multiplier(Node):
     """
@@ -171,6 +599,8 @@ class Multiplier(Node):
     | values | A list or comma-separated-string of values to be assigned.
     """
 
+    cancellable = True
+
     name = None
     values = None
 
@@ -198,10 +628,15 @@ class Multiplier(Node):
             m2[self.name] = val
             yield m2
 
+    def live_fields(self, ctx, live):
+        return needed_fields(ctx, live, self.values, written=[self.name])
+
 
 """
 class Iterator(Node):
 
+    cancellable = True
+
     name = None
     values = None
     node = None
@@ -251,16 +686,35 @@ class Union(Node):
 
     This node copies the input message before passing it to each of the
     steps in the union.
+
+    If `parallel` is True, each step runs on its own thread (fed through
+    a queue of up to `queue_size` messages), so messages are processed by all
+    steps at the same time. Output messages are yielded, ordered by step, as
+    soon as all steps have processed each input message, while steps go on
+    with the following messages. Since flows pull messages one at a time,
+    steps only run ahead of the rest of the flow when messages are received
+    as a batch (see :class:`Chain`). Steps must be safe to run concurrently
+    (see :class:`Concurrent`).
     """
 
     steps = None
 
-    def __init__(self, steps):
+    def __init__(self, steps, parallel=False, queue_size=10):
         super(Union, self).__init__()
         self.steps = steps
+        self.parallel = parallel
+        self.queue_size = queue_size
+
+        self._branches = None
+        self._results = None
+        self._seq = 0
+        self._in_flight = deque()
+        self._outputs = {}
+        self._cancelled = []
 
     def initialize(self, ctx):
         super().initialize(ctx)
+        self._cancelled = []
 
         if len(self.steps) <= 0:
             raise ETLConfigurationException("Union with no steps.")
@@ -268,16 +722,342 @@ class Union(Node):
         for p in self.steps:
             ctx.comp.initialize(p)
 
+        self.parallel = parsebool(self.parallel)
+
+    def before_job(self, ctx):
+        self._cancelled = []
+
+    @property
+    def cancellable(self):
+        return all([step.cancellable for step in self.steps])
+
     def finalize(self, ctx):
+        if self._branches:
+            for branch in self._branches:
+                branch.stop()
+            self._branches = None
+
         for p in self.steps:
             ctx.comp.finalize(p)
         super().finalize(ctx)
 
+    def _start(self, ctx):
+        self._results = queue.Queue()
+        self._branches = []
+        for idx, step in enumerate(self.steps):
+            process = (lambda ctx, m, step=step: ctx.comp.process(step, m))
+            branch = FlowBranch(ctx, "cubetl-union-%s-%d" % (self.urn, idx), process, self.queue_size, self._results)
+            branch.start()
+            self._branches.append(branch)
+
+    def process_batch(self, ctx, messages):
+
+        if not self.parallel:
+            for m in super().process_batch(ctx, messages):
+                yield m
+            return
+
+        if self._branches is None:
+            self._start(ctx)
+
+        self._in_flight = deque()
+        self._outputs = {}
+        for m in messages:
+            if all([branch.cancelled for branch in self._branches]):
+                break
+
+            self._seq += 1
+            for branch in self._branches:
+                branch.input.put((self._seq, [ctx.copy_message(m)]))
+            self._in_flight.append(self._seq)
+
+            if len(self._in_flight) >= self.queue_size:
+                for m2 in self._collect(ctx, self._in_flight.popleft()):
+                    yield m2
+
+        while self._in_flight:
+            for m2 in self._collect(ctx, self._in_flight.popleft()):
+                yield m2
+
+        if all([branch.cancelled for branch in self._branches]):
+            raise ETLCancelException()
+
+    def _collect(self, ctx, seq):
+        """
+        Waits until all steps have processed the given task, and returns
+        their output messages, ordered by step.
+        """
+        while len(self._outputs.get(seq, ())) < len(self._branches):
+            (result_seq, branch, output) = self._results.get()
+            if branch.error:
+                raise ETLException("Error in %s step %s: %s" % (self, branch.name, branch.error)) from branch.error
+            if result_seq != seq and result_seq not in self._in_flight:
+                # Result from a task that failed or was abandoned
+                continue
+            self._outputs.setdefault(result_seq, {})[branch] = output
+
+        outputs = self._outputs.pop(seq)
+        return [m for branch in self._branches for m in (outputs[branch] or [])]
+
     def process(self, ctx, m):
+
+        if self.parallel:
+            for m2 in self.process_batch(ctx, [m]):
+                yield m2
+            return
+
         for step in self.steps:
+            if step in self._cancelled:
+                continue
             m2 = ctx.copy_message(m)
-            result_msgs = ctx.comp.process(step, m2)
-            for m3 in result_msgs:
-                yield m3
+            try:
+                result_msgs = ctx.comp.process(step, m2)
+                for m3 in result_msgs:
+                    yield m3
+            except ETLCancelException:
+                logger.debug("Union step %s cancelled" % step)
+                self._cancelled.append(step)
+
+        # Cancel the union once all its steps are cancelled
+        if len(self._cancelled) == len(self.steps):
+            raise ETLCancelException()
+
+
+class Parallel(Node):
+    """
+    Runs a sequence of steps on a pool of worker processes.
+
+    Messages are sent to the workers in chunks of `chunk_size` messages.
+    Since flows pull messages one at a time, messages are only run in
+    parallel when they are received as a batch, so this node must be used
+    in a chain running in batch mode (see :class:`Chain`), with a batch size
+    of at least `workers * chunk_size` messages. Receiving a single message
+    (outside of a batch) raises an error. Output messages are
+    yielded as chunks are completed: in the input order if `ordered` is True,
+    or as soon as they are available otherwise.
+
+    Rules for the steps run by workers:
+
+    - Worker processes are forked when the first batch is received, and
+      each of them initializes and finalizes its own copy of the steps.
+      Component state (counters, caches, memory tables...) is therefore per
+      worker, and is not seen by the parent process nor by the other workers.
+    - Components that were already initialized by the parent process when
+      the workers were started are inherited in that state. Components
+      holding resources that cannot be shared across processes reset them
+      in `after_fork` (SQL connections open a new connection in each worker).
+    - Messages are pickled to be sent to and from workers, and changes to
+      context properties or variables done by workers are not seen by the parent.
+    - The `fork` process start method is required.
+
+    :param steps: The list of nodes to run in the worker processes.
+    :param workers: Number of worker processes (defaults to the number of CPUs).
+    :param ordered: If True, output messages are yielded in the input order.
+    :param chunk_size: Number of messages sent to a worker at once.
+    """
+
+    def __init__(self, steps, workers=None, ordered=True, chunk_size=100):
+        super().__init__()
+        self.steps = steps
+        self.workers = workers
+        self.ordered = ordered
+        self.chunk_size = chunk_size
+
+        self._chain = None
+        self._mp = None
+        self._processes = None
+        self._input = None
+        self._output = None
+        self._chunk_seq = 0
+
+    def initialize(self, ctx):
+        super().initialize(ctx)
+
+        if not self.steps:
+            raise ETLConfigurationException("Parallel with no steps.")
+
+        try:
+            self._mp = multiprocessing.get_context("fork")
+        except ValueError as e:
+            raise ETLConfigurationException("%s requires the 'fork' process start method: %s" % (self, e))
+
+        self.workers = int(self.workers or os.cpu_count())
+        self.chunk_size = int(self.chunk_size)
+
+        # Steps are initialized by each worker process
+        self._chain = Chain(steps=self.steps)
 
+    def before_job(self, ctx):
+        # Workers keep the state of their steps, so they are started again for each job
+        self._stop()
+        self._chunk_seq = 0
+
+    def finalize(self, ctx):
+        self._stop()
+        super().finalize(ctx)
+
+    def _stop(self):
+        if self._processes:
+            logger.debug("Stopping %d parallel worker processes" % len(self._processes))
+            for p in self._processes:
+                self._input.put(None)
+            for p in self._processes:
+                p.join()
+            self._processes = None
+
+    def _start(self, ctx):
+        logger.debug("Starting %d parallel worker processes for %s" % (self.workers, self))
+        self._input = self._mp.Queue()
+        self._output = self._mp.Queue()
+        self._processes = []
+        for idx in range(self.workers):
+            p = self._mp.Process(target=self._worker, args=(ctx, ), daemon=True)
+            p.start()
+            self._processes.append(p)
+
+    def _worker(self, ctx):
+
+        for comp in list(ctx.comp.components.keys()):
+            comp.after_fork(ctx)
+
+        ctx.comp.initialize(self._chain)
+        try:
+            while True:
+                task = self._input.get()
+                if task is None:
+                    break
+                (seq, msgs) = task
+                try:
+                    result = []
+                    for m in msgs:
+                        result.extend(ctx.comp.process(self._chain, m))
+                except Exception:
+                    self._output.put((seq, None, traceback.format_exc()))
+                    break
+                self._output.put((seq, result, None))
+        finally:
+            ctx.comp.finalize(self._chain)
+
+    def _receive(self):
+        while True:
+            try:
+                return self._output.get(timeout=1.0)
+            except queue.Empty:
+                if not all([p.is_alive() for p in self._processes]):
+                    raise ETLException("A parallel worker process of %s terminated unexpectedly." % self)
+
+    def process_batch(self, ctx, messages):
+
+        if self._processes is None:
+            self._start(ctx)
+
+        messages = list(messages)
+        first_seq = self._chunk_seq
+        for idx in range(0, len(messages), self.chunk_size):
+            self._input.put((self._chunk_seq, messages[idx:idx + self.chunk_size]))
+            self._chunk_seq += 1
+
+        pending = self._chunk_seq - first_seq
+        next_seq = first_seq
+        received = {}
+        while pending > 0:
+            (seq, result, error) = self._receive()
+            if seq < first_seq:
+                # Result from a batch that was not consumed
+                continue
+            if error:
+                raise ETLException("Error in parallel worker process of %s:\n%s" % (self, error))
+
+            pending -= 1
+            if not self.ordered:
+                for m in result:
+                    yield m
+            else:
+                received[seq] = result
+                while next_seq in received:
+                    for m in received.pop(next_seq):
+                        yield m
+                    next_seq += 1
+
+    def process(self, ctx, m):
+        # Each message would be sent to a worker and waited for, with no parallelism
+        raise ETLConfigurationException("%s can only be used in a chain running in batch mode (see Chain batch_size)" % self)
+
+
+class Concurrent(Node):
+    """
+    Runs a node for several messages at once on a pool of threads, which
+    is useful for nodes that wait on I/O (HTTP requests, database or
+    Elasticsearch queries...).
+
+    At most `max_in_flight` messages are processed at a time: new messages
+    are not taken until the oldest one in flight has been completed. Output
+    messages are yielded in the input order.
+
+    Since flows pull messages one at a time, messages are only processed
+    concurrently when they are received as a batch, so this node must be
+    used in a chain running in batch mode (see :class:`Chain`). Receiving a
+    single message (outside of a batch) raises an error.
+
+    The step is initialized once and shared by all threads, so it must be
+    safe to use concurrently:
+
+    - SQL connections open one connection per thread (see :class:`cubetl.sql.sql.Connection`).
+    - Counters, caches and other state kept by components is shared by
+      all threads and is not protected by locks.
+
+    :param step: The node to run.
+    :param max_in_flight: Maximum number of messages processed at once.
+    """
+
+    def __init__(self, step, max_in_flight=8):
+        super().__init__()
+        self.step = step
+        self.max_in_flight = max_in_flight
+
+        self._executor = None
+
+    def initialize(self, ctx):
+        super().initialize(ctx)
+        self.max_in_flight = int(self.max_in_flight)
+        if self.max_in_flight < 1:
+            raise ETLConfigurationException("Invalid max_in_flight value for %s: %s" % (self, self.max_in_flight))
+        ctx.comp.initialize(self.step)
+
+    def before_job(self, ctx):
+        # Wait for messages left in flight by the previous job
+        self._shutdown()
+
+    def finalize(self, ctx):
+        self._shutdown()
+        ctx.comp.finalize(self.step)
+        super().finalize(ctx)
+
+    def _shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _run(self, ctx, m):
+        return list(ctx.comp.process(self.step, m))
+
+    def process_batch(self, ctx, messages):
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="cubetl-concurrent")
+
+        in_flight = deque()
+        for m in messages:
+            in_flight.append(self._executor.submit(self._run, ctx, m))
+            if len(in_flight) >= self.max_in_flight:
+                for m2 in in_flight.popleft().result():
+                    yield m2
+
+        while in_flight:
+            for m2 in in_flight.popleft().result():
+                yield m2
+
+    def process(self, ctx, m):
+        # Each message would be submitted and waited for, with no concurrency
+        raise ETLConfigurationException("%s can only be used in a chain running in batch mode (see Chain batch_size)" % self)
 
@@ -0,0 +1,116 @@
+# CubETL
+# Copyright (c) 2013-2019 Jose Juan Montes
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import logging
+
+from cubetl.core import Node
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+class FusedSteps():
+    """
+    A run of consecutive chain steps which produce at most one message for
+    each input message, compiled into a single function that calls the
+    `process_message` method of each node in turn.
+
+    The function is called as `function(ctx, m)` and returns the resulting
+    message, or None if the message was filtered out by any of the steps.
+    """
+
+    def __init__(self, steps, function, source):
+        self.steps = steps
+        self.function = function
+        self.source = source
+        self.cancellable = all([step.cancellable for step in steps])
+
+    def __str__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join([str(step) for step in self.steps]))
+
+
+def is_fusable(node):
+    """
+    Returns True if the node declares a map or filter cardinality and
+    relies on `process_message` (that is, it doesn't override `process`).
+    """
+    return (node.cardinality in (Node.CARDINALITY_MAP, Node.CARDINALITY_FILTER) and
+            type(node).process is Node.process)
+
+
+def fuse(ctx, steps):
+    """
+    Generates and compiles the function for a run of fusable steps.
+
+    The generated source is logged when running with extra debug (-dd).
+    When collecting execution statistics (`ctx.stats`), each step is called
+    through a wrapper that records its statistics (see `Components.instrument`).
+    """
+
+    namespace = {}
+    lines = ["def fused_steps(ctx, m):"]
+    for idx, step in enumerate(steps):
+        name = "step_%d" % idx
+        namespace[name] = step.process_message
+        if ctx.stats:
+            namespace[name] = ctx.comp.instrument(step, step.process_message)
+        lines.append("    # %s" % str(step).replace("\n", " "))
+        lines.append("    m = %s(ctx, m)" % name)
+        if step.cardinality == Node.CARDINALITY_FILTER:
+            lines.append("    if m is None:")
+            lines.append("        return None")
+    lines.append("    return m")
+    source = "\n".join(lines) + "\n"
+
+    if ctx.debug2:
+        logger.debug("Fused %d chain steps into function:\n%s" % (len(steps), source))
+
+    exec(compile(source, "<fused_steps>", "exec"), namespace)
+
+    return FusedSteps(steps, namespace["fused_steps"], source)
+
+
+def fuse_steps(ctx, steps):
+    """
+    Fusion pass: returns a copy of the list of steps where each maximal run
+    of fusable nodes (see :func:`is_fusable`) is replaced by a :class:`FusedSteps`
+    object.
+    """
+
+    result = []
+    run = []
+    for step in steps:
+        if is_fusable(step):
+            run.append(step)
+            continue
+
+        if run:
+            result.append(fuse(ctx, run))
+            run = []
+        result.append(step)
+
+    if run:
+        result.append(fuse(ctx, run))
+
+    return result
+
@@ -31,6 +31,7 @@ import re
 
 from cubetl.core import Node
 from cubetl.core.exceptions import ETLConfigurationException
+from cubetl.core.liveness import needed_fields
 import sys
 
 
@@ -49,8 +50,12 @@ class DirectoryList(Node):
 
     Note that the input message is copied by default. You can choose to
     ignore the input message using `copy=False`.
+
+    When checkpointing, the list of processed files is saved, and these files
+    are skipped when resuming.
     """
 
+    cancellable = True
 
     def __init__(self, path="${ ctx.props.get('path', '.') }", filter_re=None, name="path", maxdepth=0, copy=True):
         super().__init__()
@@ -89,6 +94,14 @@ class DirectoryList(Node):
             files = (ma[0] for ma in (regex.match(f) for f in files) if ma)
         files = (str(join(f[0], f[1])) for f in files)
 
+        processed = None
+        if ctx.checkpoint:
+            processed = ctx.checkpoint.resume_position(self) or []
+            if processed:
+                logger.info("Resuming directory listing, skipping %d processed files" % len(processed))
+                skip = set(processed)
+                files = (f for f in files if f not in skip)
+
         for f in files:
             fields = {self.name: f}
             if self.copy:
@@ -98,21 +111,34 @@ class DirectoryList(Node):
                 m2 = fields
             yield m2
 
+            if processed is not None:
+                processed.append(f)
+                ctx.checkpoint.update(self, processed)
+
 
 class FileInfo(Node):
     """
     This node adds data to the input message, altering it.
     """
 
+    cardinality = Node.CARDINALITY_MAP
+
+    cancellable = True
 
     def __init__(self, path="${m['path']}", prefix=''):
         super().__init__()
         self.path = path
         self.prefix = ''
 
-    def process(self, ctx, m):
+        self._path = None
+
+    def initialize(self, ctx):
+        super().initialize(ctx)
+        self._path = ctx.compile(self.path)
+
+    def process_message(self, ctx, m):
         # Resolve path
-        path = ctx.interpolate(self.path, m)
+        path = self._path(ctx, m)
         try:
             stat = os.stat(path)
 
@@ -127,7 +153,10 @@ class FileInfo(Node):
 
         # TODO: resolve user names optionally
 
-        yield m
+        return m
+
+    def live_fields(self, ctx, live):
+        return needed_fields(ctx, live, self.path, written=[self.prefix + 'size', self.prefix + 'mtime'])
 
 
 class FileReader(Node):
@@ -136,6 +165,8 @@ class FileReader(Node):
     * encoding_errors can be one of "strict, ignore, replace"
     """
 
+    cancellable = True
+
     def __init__(self, path, encoding="detect", encoding_errors="strict", encoding_abort=True):
         super().__init__()
 
@@ -199,6 +230,9 @@ class FileReader(Node):
 
         yield m
 
+    def live_fields(self, ctx, live):
+        return needed_fields(ctx, live, self.path, self.encoding, written=[self.name, "_file_path", "_encoding"])
+
 
 class FileWriter(Node):
     """
@@ -220,8 +254,13 @@ class FileWriter(Node):
         self._open_file = None
         self._open_path = None
 
+        self._path = None
+        self._data = None
+
     def initialize(self, ctx):
         super(FileWriter, self).initialize(ctx)
+        self._path = ctx.compile(self.path)
+        self._data = ctx.compile(self.data)
 
     def finalize(self, ctx):
 
@@ -241,9 +280,10 @@ class FileWriter(Node):
             self._open_records = 0
             self._open_path = None
 
-    def _close_reopen_file(self, ctx, m):
+    def _close_reopen_file(self, ctx, m, path=None):
 
-        path = ctx.interpolate(self.path, m)
+        if path is None:
+            path = self._path(ctx, m)
 
         if (not self._open_file or path != self._open_path):
 
@@ -274,14 +314,52 @@ class FileWriter(Node):
         self._open_records = self._open_records + 1
 
         if not value:
-            value = ctx.interpolate(self.data, m)
+            value = self._data(ctx, m)
 
         self._open_file.write(value)
         if self.newline:
             self._open_file.write(self.newline)
 
+    def write_batch(self, ctx, messages, values=None):
+        """
+        Writes the data for several messages (or the given values, if any).
+        Consecutive values that go to the same file are written at once.
+        """
+
+        pending = []
+        for idx, m in enumerate(messages):
+
+            path = self._path(ctx, m)
+            if (not self._open_file or path != self._open_path):
+                self._write_pending(pending)
+                pending = []
+                self._close_reopen_file(ctx, m, path)
+
+            self._open_records = self._open_records + 1
+
+            value = values[idx] if values else None
+            if not value:
+                value = self._data(ctx, m)
+
+            pending.append(value)
+            if self.newline:
+                pending.append(self.newline)
+
+        self._write_pending(pending)
+
+    def _write_pending(self, pending):
+        if pending:
+            self._open_file.write("".join(pending))
+
 
 class FileLineReader(FileReader):
+    """
+    Reads a file line by line, producing a message for each line.
+
+    When checkpointing, the path, the number of lines processed and the
+    position in the file after them are saved, and reading continues from
+    that position when the same file is resumed.
+    """
 
     _line = 0
 
@@ -289,15 +367,40 @@ class FileLineReader(FileReader):
 
         super(FileReader, self).initialize(ctx)
 
+    def before_job(self, ctx):
+        self._line = 0
+
     def process(self, ctx, m):
 
         # Resolve path
         msg_path = ctx.interpolate(self.path, m)
 
+        position = None
+        if ctx.checkpoint:
+            position = ctx.checkpoint.resume_position(self)
+            if position and position["path"] == msg_path:
+                logger.info("Resuming file %s after line %d" % (msg_path, position["lines"]))
+            else:
+                position = None
+
         logger.debug("Reading file %s lines" % msg_path)
         with open(msg_path, "r") as myfile:
 
-            for line in myfile:
+            lines = 0
+            skip = 0
+            if position and "offset" in position:
+                myfile.seek(position["offset"])
+                lines = position["lines"]
+            elif position:
+                # Positions saved by previous versions have no offset
+                skip = position["lines"]
+
+            # Lines are read with readline, as iterating the file disables tell()
+            for line in iter(myfile.readline, ""):
+
+                lines = lines + 1
+                if lines <= skip:
+                    continue
 
                 self._line = self._line + 1
 
@@ -311,12 +414,20 @@ class FileLineReader(FileReader):
 
                 yield m2
 
+                if ctx.checkpoint:
+                    ctx.checkpoint.update(self, {"path": msg_path, "lines": lines, "offset": myfile.tell()})
+
+    def live_fields(self, ctx, live):
+        return needed_fields(ctx, live, self.path, self.encoding, written=[self.name, "_encoding"])
+
 
 class DirectoryFileReader(Node):
     """
     This class is a shortcut to a DirectoryLister and a FileReader
     """
 
+    cancellable = True
+
     def __init__(self, path, filter_re=None, encoding="detect", encoding_errors="strict"):
         super().__init__()
         self.path = path
@@ -34,6 +34,8 @@ class UserAgentParse(Node):
     Returns platform, os and browser information from common HTTP user agent strings.
     """
 
+    cardinality = Node.CARDINALITY_MAP
+
     def __init__(self, data='${ m["user_agent_string"] }', result_prefix='ua_'):
         super().__init__()
 
@@ -43,14 +45,16 @@ class UserAgentParse(Node):
 
         self._extract_error = False
 
+        self._data = None
+
     def initialize(self, ctx):
 
         super(UserAgentParse, self).initialize(ctx)
+        self._data = ctx.compile(self.data)
 
+    def process_message(self, ctx, m):
 
-    def process(self, ctx, m):
-
-        ua_string = ctx.interpolate(self.data, m)
+        ua_string = self._data(ctx, m)
         user_agent = parse(ua_string)
 
         if (self.result_obj):
@@ -67,5 +71,5 @@ class UserAgentParse(Node):
             m[self.result_prefix + 'is_pc'] = user_agent.is_pc
             m[self.result_prefix + 'is_bot'] = user_agent.is_bot
 
-        yield m
+        return m
 
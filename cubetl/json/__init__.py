@@ -29,6 +29,7 @@ import logging
 import re
 
 from cubetl.core import Node
+from cubetl.core.message import to_plain
 from cubetl.fs import FileReader, FileWriter
 
 
@@ -54,6 +55,8 @@ class JsonReader(Node):
 
     """
 
+    cancellable = True
+
     name = None
     data = '${ m["data"] }'
     iterate = True  # only if is an array
@@ -158,7 +161,7 @@ class JsonFileWriter(FileWriter):
         if (self.multiple):
             self._open_file.write("]")
 
-    def process(self, ctx, m):
+    def _json_value(self, ctx, m):
 
         self._count = self._count + 1
 
@@ -169,14 +172,26 @@ class JsonFileWriter(FileWriter):
             for f in self.fields:
                 o[f] = data[f]
         else:
-            o = data
+            o = to_plain(data)
 
         value = json.dumps(o, sort_keys = self.sort_keys, indent = self.indent) # ensure_ascii, check_circular, allow_nan, cls, separators, encoding, default, )
         if (self.multiple and self._count > 1):
             value = ", " + value
+        return value
+
+    def process(self, ctx, m):
+
+        value = self._json_value(ctx, m)
         super(JsonFileWriter, self).process(ctx, m, value)
 
         yield m
 
+    def process_batch(self, ctx, messages):
+
+        values = [self._json_value(ctx, m) for m in messages]
+        self.write_batch(ctx, messages, values)
+
+        return messages
+
 
 
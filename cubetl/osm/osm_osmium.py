@@ -33,6 +33,10 @@ from threading import Thread
 logger = logging.getLogger(__name__)
 
 
+class OsmiumCancelled(Exception):
+    pass
+
+
 class OsmiumHandler(osmium.SimpleHandler):
 
     def __init__(self, filename, queue):
@@ -43,8 +47,14 @@ class OsmiumHandler(osmium.SimpleHandler):
 
         self._buffer = []
 
+        self.cancelled = False
+
     def process_object(self, o):
 
+        if o and self.cancelled:
+            # Abort reading the file (the consumer has been closed)
+            raise OsmiumCancelled()
+
         if o:
             d = {
                 'id': int(o.positive_id()),
@@ -71,7 +81,10 @@ class OsmiumHandler(osmium.SimpleHandler):
 
     def thread_run(self):
         logger.info("Processing OSM file: %s", self._filename)
-        self.apply_file(self._filename)
+        try:
+            self.apply_file(self._filename)
+        except OsmiumCancelled:
+            logger.debug("Cancelled processing OSM file: %s", self._filename)
         logger.debug("Finishing processing OSM file: %s", self._filename)
         self.process_object(None)  # This signal the consumer that the node is finished
 
@@ -86,6 +99,8 @@ class OsmiumHandler(osmium.SimpleHandler):
 
 class OsmiumNode(Node):
 
+    cancellable = True
+
     def __init__(self, filename):
         super().__init__()
         self.filename = filename
@@ -99,6 +114,21 @@ class OsmiumNode(Node):
         self._osmium_thread = Thread(target=self._osmium_handler.thread_run)
         self._osmium_thread.start()
 
+        finished = False
+        try:
+            yield from self._process_queue()
+            finished = True
+        finally:
+            if not finished:
+                # Flow closed or cancelled: stop the reader thread, draining
+                # the queue so it is not blocked
+                self._osmium_handler.cancelled = True
+                while self._queue.get() is not None:
+                    pass
+            self._osmium_thread.join()
+
+    def _process_queue(self):
+
         finished = False
         while not finished:
             buffer = self._queue.get()
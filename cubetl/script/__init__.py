@@ -28,6 +28,7 @@ import traceback
 
 from cubetl.core import Node, ContextProperties
 from cubetl.core.context import Context
+from cubetl.core.liveness import needed_fields
 import cubetl
 
 
@@ -64,15 +65,17 @@ class Script(Node):
 
 class Function(Node):
 
+    cardinality = Node.CARDINALITY_MAP
+
     def __init__(self, function):
         super().__init__()
         self.function = function
 
-    def process(self, ctx, m):
+    def process_message(self, ctx, m):
 
         # TODO: Cache code?
         self.function(ctx, m)
-        yield m
+        return m
 
 
 class ContextScript(ContextProperties):
@@ -99,6 +102,10 @@ class Eval(Node):
     requires expressions to be delimited by ${}.
     """
 
+    cardinality = Node.CARDINALITY_MAP
+
+    cancellable = True
+
     def __init__(self, eval=None):
 
         super().__init__()
@@ -153,29 +160,45 @@ class Eval(Node):
                         m[evalitem["name"]] = ctx.interpolate(evalitem["default"], data)
 
 
-    def process(self, ctx, m):
+    def process_message(self, ctx, m):
 
         Eval.process_evals(ctx, m, self.eval)
 
-        yield m
+        return m
+
+    def live_fields(self, ctx, live):
+        evals = [self.eval] if isinstance(self.eval, dict) else self.eval
+        if len(evals) == 0:
+            return needed_fields(ctx, live)
+        if isinstance(evals[0], dict):
+            # Dictionaries are copied to the message as they are
+            return needed_fields(ctx, live, written=evals[0].keys())
+        return None
 
 
 class Delete(Node):
     """
     """
 
+    cardinality = Node.CARDINALITY_MAP
+
+    cancellable = True
+
     def __init__(self, fields):
 
         super().__init__()
 
         self.fields = fields
 
-    def process(self, ctx, m):
+    def process_message(self, ctx, m):
         for field in self.fields:
             try:
                 m.pop(field)
             except:
                 pass
 
-        yield m
+        return m
+
+    def live_fields(self, ctx, live):
+        return needed_fields(ctx, live, written=self.fields)
 
@@ -20,17 +20,24 @@
 # SOFTWARE.
 
 
+import heapq
+import json
 import logging
+import queue
 import sys
+import threading
+import time
 
 from cubetl.core import Node, Component
-from cubetl.core.exceptions import ETLConfigurationException
+from cubetl.core.exceptions import ETLConfigurationException, ETLException
+from cubetl.core.message import Schema
 from cubetl.text.functions import parsebool
+from sqlalchemy import event, func
 from sqlalchemy.engine import create_engine
 from sqlalchemy.exc import ResourceClosedError
 from sqlalchemy.schema import Table, MetaData, Column, ForeignKey
-from sqlalchemy.sql.expression import and_
-from sqlalchemy.types import Integer, String, Float, Boolean, Unicode, Date, Time, DateTime, Binary
+from sqlalchemy.sql.expression import and_, bindparam, column as sa_column, select, text
+from sqlalchemy.types import Integer, String, Float, Boolean, Unicode, Date, Time, DateTime, Binary, Text
 
 
 # Get an instance of a logger
@@ -38,6 +45,21 @@ logger = logging.getLogger(__name__)
 
 
 class Connection(Component):
+    """
+    A database connection.
+
+    SQLAlchemy connections cannot be used concurrently, so each thread gets
+    its own connection (see :class:`cubetl.flow.Concurrent`). The thread
+    that connects first (usually the main thread) uses the main connection,
+    while other threads open their own connection, which is closed when the
+    component is finalized. Note that transactions (see :class:`Transaction`)
+    only apply to the connection of the thread that started them.
+
+    The connection also keeps track of the tables with rows pending to be
+    inserted (see the `batch_size` attribute of :class:`SQLTable`), which are
+    written by :meth:`flush`, and notifies the open :class:`Transaction` of
+    the rows written (see :meth:`written`).
+    """
 
     def __init__(self, url, connect_args=None):
         super().__init__()
@@ -45,21 +67,127 @@ class Connection(Component):
         self.connect_args = connect_args or {}  # {'sslmode':'require'}
 
         self._engine = None
+        self._connection = None
+        self._connection_thread = None
+        self._thread_local = threading.local()
+        self._thread_connections = []
+        self._lock = threading.Lock()
+        self._pending_tables = []
+        self._transaction_node = None
 
     #def __repr__(self):
     #    return "%s(url='%s')" % (self.__class__.__name__, self._url)
 
     def lazy_init(self):
         if self._engine is None:
-            url = self.url
-            #url = self.ctx.interpolate(self.url)
-            logger.info("Connecting to database: %s (%s)", url, self.connect_args)
-            self._engine = create_engine(url, connect_args=self.connect_args)
-            self._connection = self._engine.connect()
+            with self._lock:
+                if self._engine is None:
+                    url = self.url
+                    #url = self.ctx.interpolate(self.url)
+                    logger.info("Connecting to database: %s (%s)", url, self.connect_args)
+                    engine = create_engine(url, connect_args=self.connect_args)
+                    if engine.dialect.name == "sqlite":
+                        self._sqlite_transactions(engine)
+                    self._connection = engine.connect()
+                    self._connection_thread = threading.current_thread()
+                    self._engine = engine
+
+    def _sqlite_transactions(self, engine):
+        # The pysqlite driver does not begin transactions until rows are modified,
+        # so savepoints (see Transaction) would commit on release. Transactions
+        # are instead begun explicitly (as per SQLAlchemy documentation).
+        @event.listens_for(engine, "connect")
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def begin(connection):
+            connection.execute("BEGIN")
+
+    def finalize(self, ctx):
+        for connection in self._thread_connections:
+            connection.close()
+        self._thread_connections = []
+        self._thread_local = threading.local()
+        super().finalize(ctx)
+
+    def after_fork(self, ctx):
+        # Connections cannot be shared across processes: references to the
+        # parent connection are kept (so it's not closed from this process)
+        # and a new one is created on demand
+        if self._engine is not None:
+            self._inherited = (self._engine, self._connection, self._thread_connections)
+            self._engine = None
+            self._connection = None
+            self._thread_local = threading.local()
+            self._thread_connections = []
+        self._pending_tables = []
+        self._transaction_node = None
+
+    def is_main_thread(self):
+        """
+        Returns True if the current thread uses the main connection.
+        """
+        self.lazy_init()
+        return threading.current_thread() is self._connection_thread
+
+    def add_pending(self, sqltable):
+        if sqltable not in self._pending_tables:
+            self._pending_tables.append(sqltable)
+
+    def flush(self, ctx):
+        """
+        Writes the rows pending to be inserted in all tables using this connection.
+        Tables referenced by foreign keys of other pending tables are written first.
+        Pending rows belong to the main connection, so this does nothing when
+        called from other threads.
+        """
+        if not self._pending_tables or not self.is_main_thread():
+            return
+
+        pending = self._pending_tables
+        self._pending_tables = []
+        while pending:
+            sqltable = pending[0]
+            for candidate in pending:
+                if not [t for t in candidate.referenced_tables() if t in pending and t is not candidate]:
+                    sqltable = candidate
+                    break
+            pending.remove(sqltable)
+            sqltable.write_pending(ctx)
+
+    def written(self, ctx, count):
+        """
+        Called by tables when rows are written (or buffered to be written).
+        Rows written from other threads are not part of the transaction
+        and are ignored.
+        """
+        if self._transaction_node is not None and self.is_main_thread():
+            self._transaction_node.written(ctx, count)
+
+    def discard(self, ctx):
+        """
+        Discards the rows pending to be inserted in all tables using this connection.
+        """
+        pending = self._pending_tables
+        self._pending_tables = []
+        for sqltable in pending:
+            sqltable.discard_pending(ctx)
 
     def connection(self):
         self.lazy_init()
-        return self._connection
+
+        if threading.current_thread() is self._connection_thread:
+            return self._connection
+
+        connection = getattr(self._thread_local, "connection", None)
+        if connection is None:
+            logger.debug("Opening database connection for thread %s: %s", threading.current_thread().name, self.url)
+            connection = self._engine.connect()
+            self._thread_local.connection = connection
+            with self._lock:
+                self._thread_connections.append(connection)
+        return connection
 
     def engine(self):
         self.lazy_init()
@@ -92,6 +220,22 @@ class SQLColumnFK(SQLColumn):
 
 
 class SQLTable(Component):
+    """
+    A database table.
+
+    If `batch_size` is defined, inserted rows are kept in a buffer and written
+    with a single `executemany` call for every `batch_size` rows. Buffered rows
+    are also written when the table is looked up or updated, when a query or a
+    transaction commit is run on the connection (see :meth:`Connection.flush`),
+    and when the table is finalized. As primary keys generated by the database
+    cannot be retrieved this way, inserts into tables with an `AutoIncrement`
+    primary key are never buffered. Only inserts from the thread that uses the
+    main connection are buffered.
+
+    On SQLite and PostgreSQL, upserts by primary key are run as a single
+    `INSERT ... ON CONFLICT ... DO UPDATE` statement (see :meth:`upsert`),
+    unless `native_upsert` is False.
+    """
 
     _selects = 0
     _inserts = 0
@@ -111,7 +255,7 @@ class SQLTable(Component):
     _unicode_errors = 0
     _lookup_changed_fields = None
 
-    def __init__(self, name, connection, columns, label=None):
+    def __init__(self, name, connection, columns, label=None, batch_size=None, native_upsert=True):
 
         super(SQLTable, self).__init__()
 
@@ -120,6 +264,14 @@ class SQLTable(Component):
 
         self.name = name
         self.connection = connection
+        self.batch_size = batch_size
+        self.native_upsert = native_upsert
+
+        self._insert = None
+        self._upsert = None
+        self._upsert_native = False
+        self._buffered = False
+        self._pending = []
 
         self.label = label if label else name
 
@@ -153,6 +305,9 @@ class SQLTable(Component):
 
     def finalize(self, ctx):
 
+        if self._pending:
+            self.connection.flush(ctx)
+
         if (not SQLTable._finalized):
             SQLTable._finalized = True
             if (SQLTable._inserts + SQLTable._selects > 0):
@@ -230,9 +385,22 @@ class SQLTable(Component):
             logger.info("Creating table %s" % self.name)
             self.sa_table.create(self.connection.connection())
 
+        self._insert = self.sa_table.insert()
+        self._upsert = None
+
+        pk = self.pk(ctx)
+        self._upsert_native = parsebool(self.native_upsert) and bool(pk) and pk.type != "AutoIncrement"
+        self.batch_size = int(self.batch_size) if self.batch_size else None
+        self._buffered = bool(self.batch_size and self.batch_size > 1 and not (pk and pk.type == "AutoIncrement"))
+        self._pending = []
+
         # TODO:? Extend?  (unsafe, allow read-only connections and make them default?)
         # TODO:? Delete columns (unsafe, allow read-only connections and make them default?)
 
+    def after_fork(self, ctx):
+        # Pending rows are written by the parent process
+        self._pending = []
+
     def pk(self, ctx):
         """
         Returns the primary key column definitToClauion, or None if none defined.
@@ -273,8 +441,29 @@ class SQLTable(Component):
 
         return d
 
+    def referenced_tables(self):
+        """
+        Returns the tables referenced by foreign keys of this table.
+        """
+        return [column.fk_sqlcolumn.sqltable for column in self.columns if isinstance(column, SQLColumnFK)]
+
+    def _flush_referenced(self, ctx):
+        """
+        Writes the rows pending to be inserted in this table and in the tables
+        it references, before rows are written directly, so foreign keys
+        never point to rows not yet written.
+        """
+        for sqltable in self.referenced_tables():
+            if sqltable._pending:
+                sqltable.connection.flush(ctx)
+        if self._pending:
+            self.connection.flush(ctx)
+
     def _find(self, ctx, attribs):
 
+        if self._pending:
+            self.connection.flush(ctx)
+
         self._selects = self._selects + 1
         SQLTable._selects = SQLTable._selects + 1
 
@@ -306,12 +495,73 @@ class SQLTable(Component):
         logger.debug("Lookup result on %s: %s = %s" % (self.name, attribs, row))
         return row
 
+    def _upsert_statement(self):
+        """
+        Returns an `INSERT ... ON CONFLICT (pk) DO UPDATE` statement for the
+        connection dialect, or None if the dialect doesn't support it.
+        """
+        if self._upsert is None:
+            dialect = self.connection.engine().dialect
+            pk = self.pk(self.ctx)
+            columns = [c.name for c in self.columns if c.type != "AutoIncrement"]
+            updated = [name for name in columns if name != pk.name]
+
+            if dialect.name == "postgresql":
+                from sqlalchemy.dialects.postgresql import insert
+            elif dialect.name == "sqlite" and dialect.dbapi.sqlite_version_info >= (3, 24, 0):
+                try:
+                    from sqlalchemy.dialects.sqlite import insert
+                except ImportError:
+                    # SQLAlchemy < 1.4 has no SQLite upsert construct (binds are typed
+                    # as the table columns, so values are stored as on insert)
+                    insert = None
+                    quote = dialect.identifier_preparer.quote
+                    self._upsert = text("INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO %s" % (
+                        quote(self.name),
+                        ", ".join([quote(name) for name in columns]),
+                        ", ".join([":" + name for name in columns]),
+                        quote(pk.name),
+                        ("UPDATE SET " + ", ".join(["%s = excluded.%s" % (quote(name), quote(name)) for name in updated])) if updated else "NOTHING")
+                    ).bindparams(*[bindparam(name, type_=self.sa_table.c[name].type) for name in columns])
+            else:
+                insert = None
+
+            if self._upsert is None and insert is not None:
+                statement = insert(self.sa_table)
+                if updated:
+                    self._upsert = statement.on_conflict_do_update(
+                        index_elements=[pk.name],
+                        set_={name: statement.excluded[name] for name in updated})
+                else:
+                    self._upsert = statement.on_conflict_do_nothing(index_elements=[pk.name])
+
+            if self._upsert is None:
+                logger.debug("Native upsert not available for %s on %s" % (self, dialect.name))
+                self._upsert_native = False
+
+        return self._upsert
+
+    def _native_upsert(self, keys):
+        if not self._upsert_native or (keys and list(keys) != [self.pk(self.ctx).name]):
+            return None
+        if not self.connection.is_main_thread():
+            return None
+        return self._upsert_statement()
+
     def upsert(self, ctx, data, keys = []):
         """
         Upsert checks if the row exists and has changed. It does a lookup
         followed by an update or insert as appropriate.
+
+        When upserting by primary key on a database that supports it, a single
+        `INSERT ... ON CONFLICT DO UPDATE` statement is used instead (in which
+        case changes to existing rows are not reported).
         """
 
+        statement = self._native_upsert(keys)
+        if statement is not None:
+            return self._execute_upsert(ctx, statement, [data])[0]
+
         # TODO: Check for AutoIncrement in keys, shall not be used
 
         # If keys
@@ -355,6 +605,34 @@ class SQLTable(Component):
         row_with_id = self.insert(ctx, data)
         return row_with_id
 
+    def upsert_many(self, ctx, data_list, keys = []):
+        """
+        Upserts several rows. When using native upserts (see :meth:`upsert`),
+        rows are sent using a single `executemany` call.
+        """
+        statement = self._native_upsert(keys)
+        if statement is not None:
+            return self._execute_upsert(ctx, statement, data_list)
+
+        return [self.upsert(ctx, data, keys) for data in data_list]
+
+    def _execute_upsert(self, ctx, statement, data_list):
+        rows = [self._prepare_row(ctx, data) for data in data_list]
+        if not rows:
+            return rows
+
+        self._flush_referenced(ctx)
+
+        logger.debug("Upserting in table '%s' %d rows" % (self.name, len(rows)))
+        self.connection.connection().execute(statement, rows if len(rows) > 1 else rows[0])
+
+        self._updates = self._updates + len(rows)
+        SQLTable._updates = SQLTable._updates + len(rows)
+
+        self.connection.written(ctx, len(rows))
+
+        return rows
+
     def _prepare_row(self, ctx, data):
 
         row = {}
@@ -378,23 +656,86 @@ class SQLTable(Component):
 
         row = self._prepare_row(ctx, data)
 
+        if self._buffered and self.connection.is_main_thread():
+            self._add_pending(ctx, [row])
+            self.connection.written(ctx, 1)
+            return row
+
+        self._flush_referenced(ctx)
+
         logger.debug("Inserting in table '%s' row: %s" % (self.name, row))
-        res = self.connection.connection().execute(self.sa_table.insert(row))
+        res = self.connection.connection().execute(self._insert, row)
 
-        pk = self.pk(ctx)
-        if pk:
+        # Only generated primary keys need to be retrieved
+        pk = self._pk
+        if pk and pk.type == "AutoIncrement":
             row[pk.name] = res.inserted_primary_key[0]
 
         self._inserts = self._inserts + 1
         SQLTable._inserts = SQLTable._inserts + 1
 
+        self.connection.written(ctx, 1)
+
         if pk is not None:
             return row
         else:
             return row  # None
 
+    def insert_many(self, ctx, data_list):
+        """
+        Inserts several rows using a single `executemany` call. Primary keys
+        generated by the database are not retrieved.
+        """
+
+        rows = [self._prepare_row(ctx, data) for data in data_list]
+        if not rows:
+            return rows
+
+        if self._buffered and self.connection.is_main_thread():
+            self._add_pending(ctx, rows)
+            self.connection.written(ctx, len(rows))
+            return rows
+
+        self._flush_referenced(ctx)
+
+        self._execute_many(ctx, rows)
+        self.connection.written(ctx, len(rows))
+
+        return rows
+
+    def _execute_many(self, ctx, rows):
+        logger.debug("Inserting in table '%s' %d rows" % (self.name, len(rows)))
+        self.connection.connection().execute(self._insert, rows)
+
+        self._inserts = self._inserts + len(rows)
+        SQLTable._inserts = SQLTable._inserts + len(rows)
+
+    def _add_pending(self, ctx, rows):
+        if not self._pending:
+            self.connection.add_pending(self)
+        self._pending.extend(rows)
+        if len(self._pending) >= self.batch_size:
+            self.connection.flush(ctx)
+
+    def write_pending(self, ctx):
+        """
+        Writes the rows pending to be inserted. Use :meth:`Connection.flush` instead,
+        which writes the pending rows of all tables in order.
+        """
+        rows = self._pending
+        self._pending = []
+        if rows:
+            self._execute_many(ctx, rows)
+
+    def discard_pending(self, ctx):
+        if self._pending:
+            logger.warning("Discarding %d rows pending to be inserted in table '%s'" % (len(self._pending), self.name))
+        self._pending = []
+
     def update(self, ctx, data, keys = []):
 
+        self._flush_referenced(ctx)
+
         row = self._prepare_row(ctx, data)
 
         # Automatically calculate lookup if necessary
@@ -415,6 +756,8 @@ class SQLTable(Component):
         self._updates = self._updates +1
         SQLTable._updates = SQLTable._updates + 1
 
+        self.connection.written(ctx, 1)
+
         if pk is not None:
             return row
         else:
@@ -422,23 +765,71 @@ class SQLTable(Component):
 
 
 class Transaction(Node):
+    """
+    Runs the rest of the flow within a database transaction, which is
+    committed when the flow finishes, or rolled back if it fails or is closed
+    before finishing.
+
+    Long running loads can commit periodically, every `commit_every` rows
+    written through the connection and/or every `commit_interval` seconds,
+    starting a new transaction after each commit. Alternatively (or
+    additionally), a savepoint can be set every `savepoint_every` rows: if
+    the flow fails, changes are rolled back to the last savepoint and the
+    work done until then is committed.
+
+    Rows pending to be inserted by tables (see :meth:`Connection.flush`)
+    are written before each commit and savepoint. When checkpointing,
+    commits and savepoints happen when a source updates its position (once
+    the messages it produced have been processed), so the positions saved
+    correspond to the data committed. Until a source has updated its
+    position (or if no source does), they happen as without checkpointing,
+    and a warning is logged. Without checkpointing, they happen as soon as
+    the given number of rows or time is reached, which may be in the middle
+    of a message (so the rows written for a message may be split across
+    transactions).
+
+    When checkpointing, positions are also stored in the `checkpoint_table`
+    table of the database (created if needed) as part of each commit, and
+    are restored from it when resuming (see :meth:`Checkpoint.restore`).
+    Set `checkpoint_table` to None to disable this.
+    """
 
-
-    def __init__(self, connection, enabled=True):
+    def __init__(self, connection, enabled=True, commit_every=None, commit_interval=None, savepoint_every=None,
+                 checkpoint_table="cubetl_checkpoint"):
         super().__init__()
         self.connection = connection
         self.enabled = enabled
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.savepoint_every = savepoint_every
+        self.checkpoint_table = checkpoint_table
+
+        self._checkpoint_sa_table = None
         self._transaction = None
+        self._savepoint = None
+        self._savepoint_positions = None
+        self._written = 0
+        self._savepoint_written = 0
+        self._started = None
+        self._committing = False
+        self._listened = False
+        self._warned = False
 
     def initialize(self, ctx):
         super(Transaction, self).initialize(ctx)
         ctx.comp.initialize(self.connection)
         self.enabled = parsebool(self.enabled)
+        self.commit_every = int(self.commit_every) if self.commit_every else None
+        self.commit_interval = float(self.commit_interval) if self.commit_interval else None
+        self.savepoint_every = int(self.savepoint_every) if self.savepoint_every else None
 
     def finalize(self, ctx):
         ctx.comp.finalize(self.connection)
         #super(Transaction, self).finalize(ctx)
 
+    def _periodic(self):
+        return bool(self.commit_every or self.commit_interval or self.savepoint_every)
+
     def process(self, ctx, m):
 
         # Store
@@ -446,17 +837,194 @@ class Transaction(Node):
             raise Exception("Trying to start transaction while one already exists is not supported")
 
         if (self.enabled):
+            if ctx.checkpoint and self.checkpoint_table:
+                self._restore_positions(ctx)
+            self._listened = False
             logger.info("Starting database transaction")
-            self._transaction = self.connection.connection().begin()
+            self._begin(ctx)
+            if ctx.checkpoint:
+                ctx.checkpoint.transactions += 1
+            if self._periodic():
+                self.connection._transaction_node = self
+                if ctx.checkpoint:
+                    ctx.checkpoint.listeners.append(self._checkpoint_listener)
         else:
             logger.debug("Not starting database transaction (Transaction node is disabled)")
 
-        yield m
+        try:
+            yield m
+        except BaseException:
+            # Roll back if the flow fails or is closed before finishing (failures of
+            # following steps may only reach this node as a close, ie. from within
+            # conditional or forked chains), so the node can be run again
+            if (self.enabled):
+                self._end(ctx)
+                if self._savepoint is not None:
+                    self._rollback_savepoint(ctx)
+                else:
+                    self._rollback(ctx)
+            raise
 
         if (self.enabled):
-            logger.info("Commiting database transaction")
+            self._finish(ctx)
+
+    def _finish(self, ctx):
+        self._end(ctx)
+        logger.info("Commiting database transaction")
+        self._commit(ctx)
+        self._transaction = None
+        self._savepoint = None
+        if ctx.checkpoint:
+            ctx.checkpoint.transactions -= 1
+
+    def _begin(self, ctx):
+        self._transaction = self.connection.connection().begin()
+        self._savepoint = None
+        self._savepoint_positions = None
+        self._written = 0
+        self._savepoint_written = 0
+        self._started = time.monotonic()
+        if self.savepoint_every:
+            self._set_savepoint(ctx)
+
+    def _end(self, ctx):
+        if self.connection._transaction_node is self:
+            self.connection._transaction_node = None
+        if ctx.checkpoint and self._checkpoint_listener in ctx.checkpoint.listeners:
+            ctx.checkpoint.listeners.remove(self._checkpoint_listener)
+
+    def _checkpoint_listener(self):
+        self._listened = True
+        self._check(self.ctx)
+
+    def written(self, ctx, count):
+        """
+        Called by the connection when rows are written within this transaction.
+        """
+        self._written += count
+        self._savepoint_written += count
+        if not ctx.checkpoint:
+            self._check(ctx)
+        elif not self._listened and self._check(ctx) and not self._warned:
+            # No source has updated its position yet
+            logger.warning("Database transaction committed (or savepoint set) by %s before any source updated its "
+                           "checkpoint position: positions saved may not correspond to the data committed" % self)
+            self._warned = True
+
+    def _check(self, ctx):
+        """
+        Commits, or sets a savepoint, if due. Returns True if it did.
+        """
+        if self._transaction is None or self._committing:
+            return False
+
+        self._committing = True
+        try:
+            if ((self.commit_every and self._written >= self.commit_every) or
+                    (self.commit_interval and time.monotonic() - self._started >= self.commit_interval)):
+                logger.info("Commiting database transaction (%d rows written)" % self._written)
+                self._commit(ctx)
+                self._begin(ctx)
+                return True
+            elif self.savepoint_every and self._savepoint_written >= self.savepoint_every:
+                self._set_savepoint(ctx)
+                return True
+            return False
+        finally:
+            self._committing = False
+
+    def _set_savepoint(self, ctx):
+        self.connection.flush(ctx)
+        if self._savepoint is not None:
+            self._savepoint.commit()
+        self._savepoint = self.connection.connection().begin_nested()
+        self._savepoint_written = 0
+        if ctx.checkpoint:
+            self._savepoint_positions = dict(ctx.checkpoint.positions)
+        logger.debug("Set database transaction savepoint")
+
+    def _positions_table(self):
+        if self._checkpoint_sa_table is None:
+            self._checkpoint_sa_table = Table(self.checkpoint_table, MetaData(),
+                                              Column("checkpoint", String(255), primary_key=True),
+                                              Column("positions", Text))
+        return self._checkpoint_sa_table
+
+    def _restore_positions(self, ctx):
+        table = self._positions_table()
+        connection = self.connection.connection()
+        table.create(connection, checkfirst=True)
+        if ctx.checkpoint.resume:
+            row = connection.execute(table.select(table.c.checkpoint == ctx.checkpoint.path)).first()
+            if row is not None:
+                ctx.checkpoint.restore(json.loads(row.positions))
+
+    def _store_positions(self, ctx, positions=None):
+        """
+        Stores the checkpoint positions in the database, within the current transaction.
+        """
+        if not (ctx.checkpoint and self.checkpoint_table):
+            return
+        positions = ctx.checkpoint.positions if positions is None else positions
+        table = self._positions_table()
+        connection = self.connection.connection()
+        connection.execute(table.delete(table.c.checkpoint == ctx.checkpoint.path))
+        connection.execute(table.insert(), {"checkpoint": ctx.checkpoint.path,
+                                            "positions": json.dumps(positions, default=str)})
+
+    def _rollback_savepoint(self, ctx):
+        """
+        Rolls back to the last savepoint and commits the transaction.
+        """
+        logger.warning("Rolling back database transaction to last savepoint")
+        self.connection.discard(ctx)
+        try:
+            self._savepoint.rollback()
+            self._store_positions(ctx, self._savepoint_positions)
+            if ctx.checkpoint:
+                ctx.checkpoint.prepare(self._savepoint_positions)
             self._transaction.commit()
-            self._transaction = None
+            if ctx.checkpoint:
+                ctx.checkpoint.commit()
+        except Exception as e:
+            logger.warning("Could not roll back database transaction to last savepoint: %s" % e)
+            try:
+                self._transaction.rollback()
+            except Exception as e:
+                logger.warning("Could not roll back database transaction: %s" % e)
+        self._transaction = None
+        self._savepoint = None
+        if ctx.checkpoint:
+            ctx.checkpoint.transactions -= 1
+
+    def _rollback(self, ctx):
+        logger.warning("Rolling back database transaction")
+        self.connection.discard(ctx)
+        try:
+            self._transaction.rollback()
+        except Exception as e:
+            logger.warning("Could not roll back database transaction: %s" % e)
+        self._transaction = None
+        if ctx.checkpoint:
+            ctx.checkpoint.transactions -= 1
+
+    def _commit(self, ctx):
+        """
+        Commits the current transaction, after writing any rows pending to be
+        inserted (see :meth:`Connection.flush`). Checkpoint positions are written
+        before the commit and take effect after it, so positions saved
+        always correspond to committed data.
+        """
+        self.connection.flush(ctx)
+        if self._savepoint is not None:
+            self._savepoint.commit()
+            self._savepoint = None
+        self._store_positions(ctx)
+        if ctx.checkpoint:
+            ctx.checkpoint.prepare()
+        self._transaction.commit()
+        if ctx.checkpoint:
+            ctx.checkpoint.commit()
 
 
 class StoreRow(Node):
@@ -486,9 +1054,24 @@ class StoreRow(Node):
 
         yield m
 
+    def process_batch(self, ctx, messages):
+
+        if self.store_mode == SQLTable.STORE_MODE_INSERT:
+            self.sqltable.insert_many(ctx, messages)
+        elif self.store_mode == SQLTable.STORE_MODE_UPSERT:
+            self.sqltable.upsert_many(ctx, messages)
+        else:
+            for m in messages:
+                for m2 in self.process(ctx, m):
+                    pass
+
+        return messages
+
 
 class QueryLookup(Node):
 
+    cancellable = True
+
     connection = None
     query = None
 
@@ -511,6 +1094,8 @@ class QueryLookup(Node):
 
     def _do_query(self, query):
 
+        self.connection.flush(self.ctx)
+
         logger.debug ("Running query: %s" % query.strip())
         rows = self.connection.connection().execute(query)
 
@@ -552,20 +1137,83 @@ class Query(Node):
                   the value of the `embed` parameter (m[embed]=query_result_array).
     :param single: If True, the process will fail if the query returns more than one row.
     :param failifempty: if True, the process will fail if the query returns no row.
+    :param compact: If True, the columns of each row are kept as a compact
+                    :class:`Record` bound to the result columns, instead of
+                    being copied to each message (not used with `embed`).
+    :param checkpoint_key: When checkpointing, the value of this column for the
+                    last row processed is saved, and the same query is resumed
+                    after that value (the condition is added to the query as a
+                    subquery). The query must be sorted by this column, and
+                    the node must be named (not used with `embed`).
+    :param stream: If True, rows are fetched from a server side cursor (if
+                    supported by the driver) in blocks of `fetch_size` rows,
+                    instead of reading the whole result first. Note that some
+                    drivers (ie. MySQL) cannot run other statements on the same
+                    connection while reading, and that server side cursors may
+                    be closed by transaction commits (see :class:`Transaction`).
+    :param fetch_size: The number of rows fetched at a time when streaming or
+                    paginating (1000 by default).
+    :param page_key: If defined, the query is run in pages of `fetch_size` rows,
+                    sorted by this (unique) column, each page starting after the
+                    last value of the previous page (keyset pagination). This
+                    keeps memory usage bounded with drivers that don't support
+                    server side cursors.
+    :param partitions: If greater than 1, the query is split in this number of
+                    partitions by the values of the `partition_key` column, which
+                    are read at the same time, each on its own thread and
+                    database connection (outside of any :class:`Transaction`).
+    :param partition_key: The column used to split the query in partitions.
+    :param partition_mode: How partitions are computed: "range" splits the
+                    interval between the minimum and maximum values of the
+                    column (which must be numbers or dates) in equal ranges,
+                    while "modulo" uses the remainder of dividing the (integer)
+                    column by the number of partitions.
+    :param ordered: If True, partitions are sorted by the partition key and
+                    rows are returned in that order. Otherwise, rows are
+                    returned as they are read.
     """
 
-    def __init__(self, connection, query, embed=False, single=False, failifempty=True):
+    cancellable = True
+
+    def __init__(self, connection, query, embed=False, single=False, failifempty=True, compact=False, checkpoint_key=None,
+                 stream=False, fetch_size=1000, page_key=None,
+                 partitions=1, partition_key=None, partition_mode="range", ordered=False):
         super().__init__()
         self.connection = connection
         self.query = query
         self.embed = embed
         self.single = single
         self.failifempty = failifempty
+        self.compact = compact
+        self.checkpoint_key = checkpoint_key
+        self.stream = stream
+        self.fetch_size = fetch_size
+        self.page_key = page_key
+        self.partitions = partitions
+        self.partition_key = partition_key
+        self.partition_mode = partition_mode
+        self.ordered = ordered
 
     def initialize(self, ctx):
 
         super(Query, self).initialize(ctx)
         ctx.comp.initialize(self.connection)
+        self.stream = parsebool(self.stream)
+        self.fetch_size = int(self.fetch_size)
+        if self.fetch_size < 1:
+            raise ETLConfigurationException("Invalid fetch_size for %s (must be at least 1): %s" % (self, self.fetch_size))
+
+        self.partitions = int(self.partitions)
+        self.ordered = parsebool(self.ordered)
+        if self.partitions > 1:
+            if not self.partition_key:
+                raise ETLConfigurationException("Query %s with partitions requires a partition_key" % self)
+            if self.partition_mode not in ("range", "modulo"):
+                raise ETLConfigurationException("Invalid partition_mode for %s (must be 'range' or 'modulo'): %s" % (self, self.partition_mode))
+            if self.page_key:
+                raise ETLConfigurationException("Query %s cannot use both page_key and partitions" % self)
+            if self.checkpoint_key and not (self.ordered and self.checkpoint_key == self.partition_key):
+                raise ETLConfigurationException("Query %s with partitions can only be checkpointed if ordered by the partition_key" % self)
 
     def finalize(self, ctx):
         ctx.comp.finalize(self.connection)
@@ -579,12 +1227,202 @@ class Query(Node):
 
         return d
 
+    def _subquery(self, query):
+        """
+        Returns the query as a subquery, with the key columns used by this node.
+        """
+        keys = []
+        for key in (self.page_key, self.partition_key, self.checkpoint_key):
+            if key and key not in keys:
+                keys.append(key)
+        return text(query).columns(*[sa_column(key) for key in keys]).alias("query_rows")
+
+    def _resumed(self, subquery, statement, last_key):
+        """
+        Adds the condition to resume after the given checkpoint key value to a statement.
+        """
+        if last_key is None:
+            return statement
+        return statement.where(subquery.c[self.checkpoint_key] > bindparam("resume_key", value=last_key))
+
+    def _rows(self, ctx, query, last_key=None):
+        """
+        Runs the query and yields the resulting rows, reading them from a
+        server side cursor or in pages if so configured. If a checkpoint
+        key value is given, only rows after it are read.
+        """
+        if self.page_key:
+            yield from self._pages(ctx, query, last_key)
+            return
+        if self.partitions > 1:
+            yield from self._partitioned(ctx, query, last_key)
+            return
+
+        logger.debug("Running query: %s" % query.strip())
+        connection = self.connection.connection()
+        if self.stream:
+            connection = connection.execution_options(stream_results=True)
+        if last_key is None:
+            result = connection.execute(query)
+        else:
+            subquery = self._subquery(query)
+            statement = select([text("*")]).select_from(subquery).order_by(subquery.c[self.checkpoint_key])
+            result = connection.execute(self._resumed(subquery, statement, last_key))
+
+        try:
+            if self.stream:
+                rows = result.fetchmany(self.fetch_size)
+                while rows:
+                    yield from rows
+                    rows = result.fetchmany(self.fetch_size)
+            else:
+                yield from result
+        finally:
+            # Release the cursor if the flow is cancelled before reading all rows
+            result.close()
+
+    def _pages(self, ctx, query, resume_key=None):
+        page = self._subquery(query)
+        key = page.c[self.page_key]
+        first = select([text("*")]).select_from(page).order_by(key).limit(self.fetch_size)
+
+        # Resuming by the page key starts on the following page
+        last_key = None
+        if self.page_key == self.checkpoint_key:
+            last_key = resume_key
+        else:
+            first = self._resumed(page, first, resume_key)
+        following = first.where(key > bindparam("last_key"))
+
+        while True:
+            logger.debug("Running query page (%s > %r): %s" % (self.page_key, last_key, query.strip()))
+            if last_key is None:
+                rows = self.connection.connection().execute(first).fetchall()
+            else:
+                rows = self.connection.connection().execute(following, last_key=last_key).fetchall()
+
+            yield from rows
+
+            if len(rows) < self.fetch_size:
+                break
+            last_key = rows[-1][self.page_key]
+
+    def _partition_statements(self, ctx, query, last_key=None):
+        """
+        Returns the query for each partition.
+        """
+        subquery = self._subquery(query)
+        key = subquery.c[self.partition_key]
+        base = self._resumed(subquery, select([text("*")]).select_from(subquery), last_key)
+        if self.ordered:
+            base = base.order_by(key)
+
+        if self.partition_mode == "modulo":
+            return [base.where(key % self.partitions == idx) for idx in range(self.partitions)]
+
+        bounds = self._resumed(subquery, select([func.min(key), func.max(key)]).select_from(subquery), last_key)
+        (low, high) = self.connection.connection().execute(bounds).first()
+        if low is None:
+            return [base]
+
+        try:
+            step = (high - low) / self.partitions
+            limits = [low + step * idx for idx in range(1, self.partitions)]
+        except TypeError as e:
+            raise ETLException("Cannot compute ranges of partition_key '%s' for %s (use partition_mode='modulo'): %s" % (self.partition_key, self, e))
+
+        logger.debug("Partitioning query by %s ranges (from %r to %r, limits: %r)" % (self.partition_key, low, high, limits))
+        statements = [base.where(key < limits[0])]
+        for idx in range(1, len(limits)):
+            statements.append(base.where(and_(key >= limits[idx - 1], key < limits[idx])))
+        statements.append(base.where(key >= limits[-1]))
+        return statements
+
+    def _put(self, output, item, stop):
+        while not stop.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _read_partition(self, statement, output, stop):
+        """
+        Reads a partition (on its own thread and connection), putting blocks
+        of rows in the output queue, followed by None.
+        """
+        try:
+            with self.connection.engine().connect() as connection:
+                if self.stream:
+                    connection = connection.execution_options(stream_results=True)
+                result = connection.execute(statement)
+                try:
+                    rows = result.fetchmany(self.fetch_size)
+                    while rows and not stop.is_set():
+                        self._put(output, rows, stop)
+                        rows = result.fetchmany(self.fetch_size)
+                finally:
+                    result.close()
+        except Exception as e:
+            self._put(output, e, stop)
+        self._put(output, None, stop)
+
+    def _queued_rows(self, source, producers):
+        while producers:
+            rows = source.get()
+            if rows is None:
+                producers -= 1
+            elif isinstance(rows, Exception):
+                raise rows
+            else:
+                yield from rows
+
+    def _partitioned(self, ctx, query, last_key=None):
+        """
+        Reads the partitions of the query at the same time and merges the results.
+        """
+        statements = self._partition_statements(ctx, query, last_key)
+        logger.debug("Running query in %d partitions: %s" % (len(statements), query.strip()))
+
+        stop = threading.Event()
+        if self.ordered:
+            queues = [queue.Queue(maxsize=2) for statement in statements]
+        else:
+            queues = [queue.Queue(maxsize=2 * len(statements))] * len(statements)
+
+        threads = [threading.Thread(target=self._read_partition, args=(statement, output, stop),
+                                    name="cubetl-query-%s-%d" % (self.urn, idx), daemon=True)
+                   for idx, (statement, output) in enumerate(zip(statements, queues))]
+        for thread in threads:
+            thread.start()
+
+        try:
+            if self.ordered:
+                yield from heapq.merge(*[self._queued_rows(output, 1) for output in queues],
+                                       key=lambda row: row[self.partition_key])
+            else:
+                yield from self._queued_rows(queues[0], len(threads))
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
     def process(self, ctx, m):
 
         query = ctx.interpolate(self.query, m)
 
-        logger.debug("Running query: %s" % query.strip())
-        rows = self.connection.connection().execute(query)
+        # Rows pending to be inserted must be visible to the query
+        self.connection.flush(ctx)
+
+        checkpoint = ctx.checkpoint if self.checkpoint_key and not self.embed else None
+        last_key = None
+        if checkpoint:
+            position = checkpoint.resume_position(self)
+            if position and position["query"] == query:
+                last_key = position["key"]
+                logger.info("Resuming query after %s = %r" % (self.checkpoint_key, last_key))
+
+        rows = self._rows(ctx, query, last_key)
 
         try:
 
@@ -606,18 +1444,30 @@ class Query(Node):
 
             else:
                 result = None
+                schema = None
+                base = ctx.copy_message(m) if self.compact else None
+
                 for r in rows:
                     if self.single and result != None:
                         raise Exception("Error: %s query resulted in more than one row: %s" % (self, query))
 
-                    m2 = ctx.copy_message(m)
-                    result = self._rowtodict(r)
+                    if self.compact:
+                        if schema is None:
+                            schema = Schema(r.keys())
+                        result = schema.record(r)
+                        yield base.copy(result)
+                    else:
+                        m2 = ctx.copy_message(m)
+                        result = self._rowtodict(r)
 
-                    if result is not None:
-                        m2.update(result)
-                        yield m2
+                        if result is not None:
+                            m2.update(result)
+                            yield m2
 
-                if not result:
+                    if checkpoint:
+                        checkpoint.update(self, {"query": query, "key": r[self.checkpoint_key]})
+
+                if not result and last_key is None:
                     if self.failifempty:
                         raise Exception("Error: %s query returned no results: %s" % (self, query))
                     else:
@@ -626,3 +1476,6 @@ class Query(Node):
         except ResourceClosedError as e:
             yield m
 
+        finally:
+            rows.close()
+
@@ -32,6 +32,7 @@ import re
 
 from cubetl.core import Node, Component
 from cubetl.core.exceptions import ETLException
+from cubetl.core.message import Schema
 from cubetl.csv import CsvReader
 from cubetl.fs import FileReader
 from cubetl.script import Eval
@@ -257,6 +258,8 @@ class TableInsert(Node):
 
 class TableLookup(Node):
 
+    cancellable = True
+
     def __init__(self, table, lookup, default=None):
         super().__init__()
         self.table = table
@@ -264,6 +267,8 @@ class TableLookup(Node):
         self.default = default
         self.mappings = None
 
+        self._lookup = None
+
     def initialize(self, ctx):
 
         super(TableLookup, self).initialize(ctx)
@@ -271,6 +276,8 @@ class TableLookup(Node):
         if not self.default: self.default = { }
         if not self.mappings: self.mappings = []
 
+        self._lookup = {key: ctx.compile(expr) for (key, expr) in self.lookup.items()}
+
         ctx.comp.initialize(self.table)
 
     def finalize(self, ctx):
@@ -284,8 +291,8 @@ class TableLookup(Node):
             raise Exception("No lookup configuration defined for %s" % self)
 
         keys = {}
-        for (key, expr) in self.lookup.items():
-            keys[key] = ctx.interpolate(expr, m)
+        for (key, expr) in self._lookup.items():
+            keys[key] = expr(ctx, m)
 
         return keys
 
@@ -309,8 +316,19 @@ class TableLookup(Node):
 
 
 class TableList(Node):
+    """
+    Produces a message for each row in a table (a copy of the input message
+    updated with the row fields).
+
+    If `compact` is True, row fields are kept as compact :class:`Record`
+    objects (which share the list of field names when consecutive rows
+    have the same fields) instead of being copied to each message.
+    """
+
+    cancellable = True
 
     table = None
+    compact = False
 
     def initialize(self, ctx):
 
@@ -333,6 +351,17 @@ class TableList(Node):
 
         attribs = {}
         rows = self.table.find(ctx, attribs)
+
+        if self.compact:
+            base = ctx.copy_message(m)
+            schema = None
+            for r in rows:
+                names = tuple(r.keys())
+                if schema is None or schema.names != names:
+                    schema = Schema(names)
+                yield base.copy(schema.record(r.values()))
+            return
+
         for r in rows:
 
             m2 = ctx.copy_message(m)
@@ -20,20 +20,15 @@
 # SOFTWARE.
 
 
-from pygments import highlight
-from pygments.formatters.terminal import TerminalFormatter
-from pygments.formatters.terminal256 import Terminal256Formatter
-from pygments.lexers.agile import PythonLexer
-from pygments.lexers.web import JsonLexer
 import json
 import logging
 import pprint
 import re
-import simplejson
 import sys
 
 from cubetl.core import Node
 from cubetl.core.exceptions import ETLException
+from cubetl.core.liveness import needed_fields
 from cubetl.text.functions import *
 
 
@@ -48,6 +43,7 @@ class LineReader(Node):
     Splits text into lines.
     """
 
+    cancellable = True
 
     def process(self, ctx, m):
         # TODO: Implement
@@ -59,10 +55,14 @@ class RegExp(Node):
     Splits text into lines.
     """
 
+    cancellable = True
+
     ERRORS_IGNORE = 'ignore'
     ERRORS_WARN = 'warn'
     ERRORS_FAIL = 'fail'
 
+    cardinality = Node.CARDINALITY_FILTER
+
     def __init__(self, regexp, names=None, data='${ m["data"] }', errors=ERRORS_FAIL):
         super().__init__()
         self.regexp = regexp
@@ -71,16 +71,23 @@ class RegExp(Node):
         self.errors = errors
         self._error_count = 0
 
+        self._data = None
+        self._regexp = None
+        self._names = None
+
     def initialize(self, ctx):
         super(RegExp, self).initialize(ctx)
         self._error_count = 0
+        self._data = ctx.compile(self.data)
+        self._regexp = re.compile(self.regexp)
+        self._names = [name.strip() for name in self.names.split(",")] if self.names else None
 
-    def process(self, ctx, m):
+    def process_message(self, ctx, m):
 
-        data = ctx.interpolate(self.data, m)
+        data = self._data(ctx, m)
 
         #matches = re.search(self.regexp, data)
-        matches = re.findall(self.regexp, data)
+        matches = self._regexp.findall(data)
 
         if len(matches) == 0:
             if self.errors == RegExp.ERRORS_FAIL:
@@ -88,7 +95,7 @@ class RegExp(Node):
             else:
                 if self.errors == RegExp.ERRORS_WARN:
                     logger.warning("Failed to match regular expresion %s on value: %s", self.regexp, data)
-                return
+                return None
 
         matches = matches[0]
         if (ctx.debug2):
@@ -99,9 +106,12 @@ class RegExp(Node):
             matches = [ matches ]
         for i in range(0, len(matches)):
             match_name = "regexp_match_" + str(i + 1)
-            if (self.names):
-                match_name = self.names.split(",")[i].strip()
+            if (self._names):
+                match_name = self._names[i]
             m[match_name] = matches[i]
 
-        yield m
+        return m
+
+    def live_fields(self, ctx, live):
+        return needed_fields(ctx, live, self.data)
 
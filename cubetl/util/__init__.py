@@ -20,18 +20,13 @@
 # SOFTWARE.
 
 
-from pygments import highlight
-from pygments.formatters.terminal import TerminalFormatter
-from pygments.formatters.terminal256 import Terminal256Formatter
-from pygments.lexers.agile import PythonLexer
-from pygments.lexers.web import JsonLexer
 import json
 import logging
 import pprint
-import simplejson
 import sys
 
 from cubetl.core import Node
+from cubetl.core.message import to_plain
 
 
 #from bunch import Bunch
@@ -65,6 +60,8 @@ class Print(Node):
     A default instance can be found in CubETL default objects.
     """
 
+    cardinality = Node.CARDINALITY_MAP
+
     def __init__(self, eval=None, condition=None, truncate_line=120, style='friendly'):
         super().__init__()
 
@@ -77,11 +74,18 @@ class Print(Node):
 
         self._lexer = None
         self._formatter = None
+        self._highlight = None
 
     def initialize(self, ctx):
 
         super(Print, self).initialize(ctx)
 
+        # Imported here as pygments takes a while to load
+        from pygments import highlight
+        from pygments.formatters.terminal256 import Terminal256Formatter
+        from pygments.lexers.agile import PythonLexer
+
+        self._highlight = highlight
         self._lexer = PythonLexer()
         #self._formatter = TerminalFormatter()
         self._formatter = Terminal256Formatter(style=self.style)
@@ -91,7 +95,7 @@ class Print(Node):
     def _prepare_res(self, ctx, m, obj):
         return str(obj)
 
-    def process(self, ctx, m):
+    def process_message(self, ctx, m):
 
         if (not ctx.quiet):
 
@@ -120,12 +124,12 @@ class Print(Node):
                     res = "\n".join(truncated)
 
                 if sys.stdout.isatty():
-                    print(highlight(res, self._lexer, self._formatter)[:-1])
+                    print(self._highlight(res, self._lexer, self._formatter)[:-1])
                     #print(res)
                 else:
                     print(res)
 
-        yield m
+        return m
 
 
 class PrettyPrint(Print):
@@ -150,7 +154,7 @@ class PrettyPrint(Print):
         #res = str(obj)
         #if isinstance(obj, Bunch):
         #    obj = obj.toDict()
-        res = self._pp.pformat(obj)
+        res = self._pp.pformat(to_plain(obj))
 
         return res
 
@@ -54,6 +54,7 @@ class PrintConfig(Node):
         super().finalize(ctx)
 
     def write_config(self, ctx, m):
+        ctx.create_all()
         text = ""
         for k, e in ctx.components.items():
             #k = slugify.slugify(k, separator="_")
@@ -87,6 +88,7 @@ class ListConfig(Node):
     def list_config(self, ctx, m):
         text = "\n"
         text += "List of nodes in CubETL configuration:\n"
+        ctx.create_all()
         for k, e in ctx.components.items():
             if not isinstance(e, Node):
                 continue
@@ -34,6 +34,8 @@ logger = logging.getLogger(__name__)
 
 class Log(Node):
 
+    cardinality = Node.CARDINALITY_MAP
+
     LEVEL_DEBUG = logging.DEBUG
     LEVEL_INFO = logging.INFO
     LEVEL_WARN = logging.WARN
@@ -52,18 +54,29 @@ class Log(Node):
 
         self.count = 0
 
-    def process(self, ctx, m):
+        self._condition = None
+        self._message = None
+
+    def initialize(self, ctx):
+        super().initialize(ctx)
+        self._condition = ctx.compile(self.condition)
+        self._message = ctx.compile(self.message)
+
+    def before_job(self, ctx):
+        self.count = 0
+
+    def process_message(self, ctx, m):
 
         self.count = self.count + 1
 
         dolog = True
         if (self.condition):
-            dolog = parsebool(ctx.interpolate(self.condition, m))
+            dolog = parsebool(self._condition(ctx, m))
 
         if dolog and (not self.once or self.count == 1):
-            logger.log(self.level, ctx.interpolate(self.message, m))
+            logger.log(self.level, self._message(ctx, m))
 
-        yield m
+        return m
 
 
 class LogPerformance(Node):
@@ -122,6 +135,8 @@ class LogPerformance(Node):
              float(self._count) / (current - self._startTime),
              float(self._count - self._lastCount) / (current - self._lastTime)
              ))
+        if ctx.memory_tracker:
+            logger.info("%s - Memory usage by component:\n%s" % (self.name, ctx.memory_tracker.report()))
 
     def process(self, ctx, m):
 
@@ -37,6 +37,8 @@ logger = logging.getLogger(__name__)
 
 class XmlPullParser(Node):
 
+    cancellable = True
+
     path = None
     tagname = None
 
@@ -70,6 +72,8 @@ class XmlPullParser(Node):
 
 class XmlParser(Node):
 
+    cancellable = True
+
     encoding = 'utf-8'  #'${ m["encoding"] }'
 
     def process(self, ctx, m):
@@ -83,6 +87,8 @@ class XmlParser(Node):
 
 class XPathExtract(Node):
 
+    cancellable = True
+
     eval = []
     xml = "xml"
     encoding = "utf-8" #'${ m["encoding"] }'
@@ -0,0 +1,200 @@
+#
+from cubetl.core.exceptions import ETLConfigurationException
+from cubetl import csv, flow, fs, script
+from cubetl.util import log
+from cubetl.core.message import Message, Record, Schema
+from cubetl.core.scheduler import Scheduler
+from cubetl.core.service import Service
+import io
+import json
+import pickle
+import pytest
+import cubetl
+
+
+class TestContext(object):
+
+    @pytest.fixture(scope='function')
+    def ctx(self):
+        # Create Cubetl context
+        ctx = cubetl.cubetl(debug=True, quiet=False)
+        return ctx
+
+    def test_interpolate(self, ctx):
+        ctx.props['name'] = "World"
+        m = {'a': 1, 'b': 2}
+        assert ctx.interpolate("${ m['a'] + m['b'] }", m) == 3
+        assert ctx.interpolate(" Hello ${ props['name'] } ${ m['a'] }! ", m) == "Hello World 1!"
+        assert ctx.interpolate(" plain text ", m) == "plain text"
+        assert ctx.interpolate("${ [m[k] for k in sorted(m)] }", m) == [1, 2]
+        assert ctx.interpolate("${ text.slugu('Hello World') }") == "hello_world"
+        assert ctx.interpolate("${ x + m['a'] }", m, {'x': 10}) == 11
+        assert ctx.interpolate(42) == 42
+        assert ctx.interpolate(None) is None
+
+    def test_compile(self, ctx):
+        expr = ctx.compile("${ m['a'] * 2 }")
+        assert expr is ctx.compile("${ m['a'] * 2 }")
+        assert expr(ctx, {'a': 2}) == 4
+        assert ctx.interpolate(expr, {'a': 3}) == 6
+
+        with pytest.raises(ETLConfigurationException):
+            ctx.compile("${ m[ }")
+
+    def test_interpolate_callable(self, ctx):
+        ctx.props['x'] = 1
+        m = {'a': 2}
+        assert ctx.interpolate(lambda m: m['a'], m) == 2
+        assert ctx.interpolate(lambda ctx: ctx.props['x'], m) == 1
+        assert ctx.interpolate(lambda ctx, m: ctx.props['x'] + m['a'], m) == 3
+        assert ctx.compile(lambda m: "${ m['a'] * 2 }")(ctx, m) == 4
+
+        with pytest.raises(ETLConfigurationException):
+            ctx.compile(lambda a, b: None)
+
+    def test_compile_constant(self, ctx):
+        ctx.props['path'] = "a"
+        expr = ctx.compile("${ ctx.props['path'] }.txt")
+        assert expr.constant
+        assert expr(ctx, {}) == "a.txt"
+        ctx.props['path'] = "b"
+        assert expr(ctx, {}) == "b.txt"
+
+        assert not ctx.compile("${ m['path'] }").constant
+        assert not ctx.compile("${ datetime.datetime.now() }").constant
+        assert not ctx.compile("${ [m[k] for k in m] }").constant
+        assert not ctx.compile("${ ctx.get('counter').count }").constant
+        assert not ctx.compile("${ f.counter() }").constant
+        assert ctx.compile("${ props.get('path', 'x').upper() + str(1) }").constant
+
+        # Property values containing expressions are resolved for each message
+        ctx.props['path'] = "${ m['a'] }"
+        assert expr(ctx, {'a': 'x'}) == "x.txt"
+        assert expr(ctx, {'a': 'y'}) == "y.txt"
+        assert expr.constant
+
+    def test_compile_fields(self, ctx):
+        assert ctx.compile("${ m['a'] + m.get('b', '') }/${ ctx.props['c'] }").fields == {'a', 'b'}
+        assert ctx.compile("${ 'a' in m and m['a'] }").fields == {'a'}
+        assert ctx.compile("text").fields == set()
+        assert ctx.compile("${ m }").fields is None
+        assert ctx.compile("${ [m[k] for k in m] }").fields is None
+        assert ctx.compile(lambda m: m['a']).fields is None
+
+    def test_copy_message(self, ctx):
+        m = ctx.copy_message({'a': 1, 'b': 2})
+        m2 = ctx.copy_message(m)
+        m2['a'] = 3
+        del m2['b']
+        m['c'] = 4
+        assert m == {'a': 1, 'b': 2, 'c': 4}
+        assert m2 == {'a': 3}
+        assert list(m2.items()) == [('a', 3)]
+        assert 'b' not in m2 and m2.get('b') is None
+
+        m3 = pickle.loads(pickle.dumps(m2))
+        assert isinstance(m3, Message) and m3 == {'a': 3}
+
+        for i in range(Message.MAX_LAYERS * 2):
+            m2 = ctx.copy_message(m2)
+            m2[i] = i
+        assert len(m2._layers) <= Message.MAX_LAYERS
+        assert len(m2) == Message.MAX_LAYERS * 2 + 1
+
+        # Merged fields are kept until the message is modified
+        view = m2._view
+        assert view is not None and len(m2) == len(view) and m2._view is view
+        m2['z'] = 1
+        assert m2._view is None and len(m2) == Message.MAX_LAYERS * 2 + 2
+
+    def test_record(self, ctx):
+        schema = Schema(['a', 'b', 'c'])
+        base = ctx.copy_message({'a': 0, 'x': 1})
+        m = base.copy(schema.record(['1', '2']))
+        assert m == {'a': '1', 'b': '2', 'x': 1}
+        assert 'c' not in m
+
+        m['c'] = '3'
+        m['a'] = '4'
+        assert m == {'a': '4', 'b': '2', 'x': 1, 'c': '3'}
+        assert ctx.copy_message(m) == m
+        assert base == {'a': 0, 'x': 1}
+
+    def test_csv_compact(self, ctx):
+        reader = csv.CsvReader()
+        reader.compact = True
+        result = ctx.run(flow.Chain(steps=[
+            script.Eval({'data': "a,b\n1,2\n3,4"}),
+            reader,
+        ]), multiple=True)
+        assert result == [{'data': "a,b\n1,2\n3,4", 'a': '1', 'b': '2'},
+                          {'data': "a,b\n1,2\n3,4", 'a': '3', 'b': '4'}]
+        assert isinstance(result[0]._layers[-1], Record)
+
+    def test_scheduler_order(self, ctx):
+        scheduler = Scheduler(ctx, ['a', 'b', 'c'], {'a': ['c'], 'b': ['a']})
+        assert scheduler.order() == ['c', 'a', 'b']
+
+        with pytest.raises(ETLConfigurationException):
+            Scheduler(ctx, ['a', 'b'], {'a': ['b'], 'b': ['a']}).order()
+        with pytest.raises(ETLConfigurationException):
+            Scheduler(ctx, ['a'], {'a': ['x']}).order()
+
+    def test_add_factory(self, ctx):
+        created = []
+
+        def factory():
+            created.append(True)
+            return flow.Filter(condition="${ True }")
+
+        ctx.add('test.filter', factory, description="Test filter")
+        assert not created
+
+        node = ctx.get('test.filter')
+        assert created and isinstance(node, flow.Filter)
+        assert node.urn == 'test.filter' and node.description == "Test filter"
+        assert ctx.get('test.filter') is node
+        assert ctx.find(flow.Filter) == [node]
+
+    def test_service(self, ctx):
+        rows = []
+
+        def fail(ctx, m):
+            if m['a'] == 'fail':
+                raise ValueError("Test error")
+
+        multiplier = flow.Multiplier()
+        multiplier.name = 'b'
+        multiplier.values = '1, 2, 3'
+        process = flow.Chain(steps=[
+            script.Function(fail),
+            multiplier,
+            flow.Limit(limit=2),
+            script.Function(lambda ctx, m: rows.append((m['a'], m['b']))),
+        ])
+
+        service = Service(ctx, [process])
+        service.open()
+        output = io.StringIO()
+        service.serve_stream(io.StringIO('{"a": "x"}\n\n{"a": "fail"}\n[1]\n{"a": "y"}\n'), output)
+        service.close()
+
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert [r['status'] for r in results] == ['ok', 'error', 'error', 'ok']
+        assert results[0]['messages'] == 2
+        assert rows == [('x', '1'), ('x', '2'), ('y', '1'), ('y', '2')]
+        assert ctx.comp.is_finalized(process)
+
+    def test_service_reset(self, ctx, tmpdir):
+        path = tmpdir.join("lines.txt")
+        path.write("a\nb\n")
+        reader = fs.FileLineReader(path=str(path), encoding=None)
+        logger = log.Log(message="${ m['data'] }", once=True)
+
+        # Per-run state is reset before each job
+        service = Service(ctx, [flow.Chain(steps=[reader, logger])])
+        service.open()
+        for job in range(2):
+            assert service.run_job({})['status'] == 'ok'
+            assert reader._line == 2 and logger.count == 2
+        service.close()
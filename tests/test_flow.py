@@ -0,0 +1,640 @@
+#
+from cubetl import flow, fs, script, csv
+from cubetl.core import Node
+from cubetl.core.checkpoint import Checkpoint
+from cubetl.core.exceptions import ETLConfigurationException, ETLException
+from cubetl.sql import sql
+from cubetl.flow.fusion import FusedSteps
+import datetime
+import os
+import pytest
+import threading
+import time
+import cubetl
+
+
+class TestFlow(object):
+
+    @pytest.fixture(scope='function')
+    def ctx(self):
+        # Create Cubetl context
+        ctx = cubetl.cubetl(debug=True, quiet=False)
+        return ctx
+
+    def multiplier(self, name, values):
+        node = flow.Multiplier()
+        node.name = name
+        node.values = values
+        return node
+
+    def test_chain(self, ctx):
+        process = flow.Chain(steps=[
+            self.multiplier('a', '1, 2, 3'),
+            flow.Chain(steps=[
+                self.multiplier('b', 'x, y'),
+                flow.Filter(condition="${ m['a'] != '2' }"),
+            ]),
+            flow.Chain(fork=True, steps=[
+                script.Function(lambda ctx, m: m.update({'forked': True})),
+            ]),
+            flow.Chain(condition="${ m['b'] == 'y' }", steps=[
+                script.Function(lambda ctx, m: m.update({'c': m['a'] + m['b']})),
+            ]),
+            flow.Limit(limit=3),
+        ])
+
+        result = ctx.run(process, multiple=True)
+        assert result == [{'a': '1', 'b': 'x'},
+                          {'a': '1', 'b': 'y', 'c': '1y'},
+                          {'a': '3', 'b': 'x'}]
+
+    def test_chain_empty(self, ctx):
+        result = ctx.run(flow.Chain(steps=[]), multiple=True)
+        assert result == [{}]
+
+    def test_chain_fusion(self, ctx):
+        process = flow.Chain(steps=[
+            self.multiplier('a', '1, 2, 3'),
+            script.Eval(),
+            flow.Filter(condition="${ m['a'] != '2' }"),
+            script.Delete(['b']),
+        ])
+
+        result = ctx.run(process, multiple=True)
+        assert result == [{'a': '1'}, {'a': '3'}]
+        assert len(process._steps) == 2
+        assert isinstance(process._steps[1], FusedSteps)
+        assert process._steps[1].steps == process.steps[1:]
+
+    def test_chain_fields(self, ctx):
+        process = flow.Chain(fields=['a', 'c'], steps=[
+            self.multiplier('a', '1, 2'),
+            self.multiplier('b', 'x, y'),
+            flow.Filter(condition="${ m['b'] == 'y' }"),
+            script.Eval(eval={'c': 'z'}),
+        ])
+
+        result = ctx.run(process, multiple=True)
+        assert result == [{'a': '1', 'c': 'z'}, {'a': '2', 'c': 'z'}]
+        assert len(process._projections) == 4
+
+        # Fields are not dropped before steps which may read the whole message
+        seen = []
+        process = flow.Chain(fields=[], steps=[
+            self.multiplier('a', '1'),
+            script.Function(lambda ctx, m: seen.append(dict(m))),
+            flow.Project(fields="b"),
+            script.Function(lambda ctx, m: seen.append(dict(m))),
+        ])
+        ctx.run(process)
+        assert seen == [{'a': '1'}, {}]
+
+        # Nested chains apply their own projections
+        process = flow.Chain(steps=[
+            flow.Chain(fields=['a'], steps=[self.multiplier('a', '1'), self.multiplier('b', 'x')]),
+            script.Function(lambda ctx, m: seen.append(dict(m))),
+        ])
+        seen.clear()
+        ctx.run(process)
+        assert seen == [{'a': '1'}]
+
+    def test_chain_batch_nested(self, ctx):
+        batches = []
+
+        class BatchRecorder(Node):
+            def process_batch(self, ctx, messages):
+                batches.append(len(messages))
+                return messages
+
+        # Nested chains in batch mode are not flattened into the parent chain
+        process = flow.Chain(steps=[
+            script.Eval(eval={'x': '1'}),
+            flow.Chain(batch_size=5, steps=[self.multiplier('a', '1, 2, 3, 4, 5'), BatchRecorder()]),
+        ])
+        result = ctx.run(process, multiple=True)
+        assert [m['a'] for m in result] == ['1', '2', '3', '4', '5']
+        assert batches == [5]
+
+    def test_chain_batch(self, ctx, tmpdir):
+        path = str(tmpdir.join("test.csv"))
+        connection = sql.Connection(url="sqlite://")
+        sqltable = sql.SQLTable(name="test", connection=connection, columns=[
+            sql.SQLColumn(name="a", type="String"),
+            sql.SQLColumn(name="b", type="String")])
+
+        process = flow.Chain(batch_size=4, steps=[
+            self.multiplier('a', '1, 2, 3'),
+            self.multiplier('b', 'x, y, z'),
+            flow.Filter(condition="${ m['a'] != '2' }"),
+            sql.StoreRow(sqltable=sqltable),
+            csv.CsvFileWriter(path=path),
+        ])
+
+        result = ctx.run(process, multiple=True)
+        assert len(result) == 6
+        assert result[0] == {'a': '1', 'b': 'x'}
+
+        with open(path) as f:
+            assert f.read() == "a,b\n1,x\n1,y\n1,z\n3,x\n3,y\n3,z\n"
+
+        rows = connection.connection().execute("SELECT a, b FROM test").fetchall()
+        assert len(rows) == 6
+
+    def test_sqltable_buffered(self, ctx):
+        connection = sql.Connection(url="sqlite://")
+        connection.connection().execute("PRAGMA foreign_keys=ON")
+        dim = sql.SQLTable(name="dim", connection=connection, batch_size=10, columns=[
+            sql.SQLColumn(name="id", type="Integer", pk=True),
+            sql.SQLColumn(name="name", type="String")])
+        fact = sql.SQLTable(name="fact", connection=connection, batch_size=10, columns=[
+            sql.SQLColumnFK(name="dim_id", type="Integer", pk=False, fk_sqlcolumn=dim.columns[0]),
+            sql.SQLColumn(name="value", type="Integer")])
+        event = sql.SQLTable(name="event", connection=connection, batch_size=10, columns=[
+            sql.SQLColumn(name="id", type="AutoIncrement", pk=True),
+            sql.SQLColumnFK(name="dim_id", type="Integer", pk=False, fk_sqlcolumn=dim.columns[0])])
+
+        counts = []
+        lookups = []
+
+        def check(ctx, m):
+            counts.append(len(connection.connection().execute("SELECT * FROM dim").fetchall()))
+            lookups.append(dim.lookup(ctx, {'id': m['id']}))
+
+        process = flow.Chain(steps=[
+            sql.Transaction(connection=connection),
+            self.multiplier('a', '1, 2, 3'),
+            script.Function(lambda ctx, m: m.update({'id': int(m['a']), 'name': 'n' + m['a'], 'dim_id': int(m['a']), 'value': 10})),
+            sql.StoreRow(sqltable=fact),
+            sql.StoreRow(sqltable=dim),
+            script.Function(check),
+        ])
+
+        ctx.run(process)
+        assert counts == [0, 1, 2]
+        assert [row['name'] for row in lookups] == ['n1', 'n2', 'n3']
+        assert len(connection.connection().execute("SELECT * FROM fact").fetchall()) == 3
+
+        # Rows of tables with generated keys are written directly, after the pending rows they reference
+        ctx.run(flow.Chain(steps=[
+            sql.Transaction(connection=connection),
+            self.multiplier('a', '4, 5'),
+            script.Function(lambda ctx, m: m.update({'id': int(m['a']), 'name': 'n' + m['a'], 'dim_id': int(m['a'])})),
+            sql.StoreRow(sqltable=dim),
+            sql.StoreRow(sqltable=event),
+        ]))
+        assert len(connection.connection().execute("SELECT * FROM event").fetchall()) == 2
+
+    def test_sqltable_upsert(self, ctx):
+        connection = sql.Connection(url="sqlite://")
+        sqltable = sql.SQLTable(name="test", connection=connection, columns=[
+            sql.SQLColumn(name="id", type="Integer", pk=True),
+            sql.SQLColumn(name="name", type="String")])
+
+        def process(batch_size, name):
+            return flow.Chain(batch_size=batch_size, steps=[
+                self.multiplier('a', '1, 2, 3'),
+                script.Function(lambda ctx, m: m.update({'id': int(m['a']), 'name': name + m['a']})),
+                sql.StoreRow(sqltable=sqltable, store_mode=sql.SQLTable.STORE_MODE_UPSERT),
+            ])
+
+        ctx.run(process(None, 'x'))
+        assert sqltable._upsert is not None
+        sqltable.upsert(ctx, {'id': 4, 'name': 'z4'})
+        ctx.run(process(2, 'y'))
+
+        rows = connection.connection().execute("SELECT id, name FROM test ORDER BY id").fetchall()
+        assert [tuple(row) for row in rows] == [(1, 'y1'), (2, 'y2'), (3, 'y3'), (4, 'z4')]
+
+        # Dates are stored as on insert, so they can be looked up
+        dates = sql.SQLTable(name="dates", connection=connection, columns=[
+            sql.SQLColumn(name="id", type="Integer", pk=True),
+            sql.SQLColumn(name="day", type="Date"),
+            sql.SQLColumn(name="time", type="DateTime")])
+        ctx.comp.initialize(dates)
+        row = {'id': 1, 'day': datetime.date(2020, 1, 2), 'time': datetime.datetime(2020, 1, 2, 3, 4, 5)}
+        dates.upsert_many(ctx, [row])
+        assert dates._upsert is not None
+        assert dates.lookup(ctx, {'day': row['day'], 'time': row['time']})['id'] == 1
+
+    def test_query_stream(self, ctx):
+        connection = sql.Connection(url="sqlite://")
+        connection.connection().execute("CREATE TABLE test (id INTEGER PRIMARY KEY, name TEXT)")
+        connection.connection().execute("INSERT INTO test VALUES " + ", ".join(["(%d, 'n%d')" % (i, i) for i in range(25)]))
+
+        expected = [{'id': i, 'name': 'n%d' % i} for i in range(25)]
+        query = "SELECT id, name FROM test"
+
+        result = ctx.run(sql.Query(connection=connection, query=query, stream=True, fetch_size=10), multiple=True)
+        assert result == expected
+
+        for fetch_size in (10, 25):
+            node = sql.Query(connection=connection, query=query + " WHERE id != 3", page_key='id', fetch_size=fetch_size, compact=True)
+            result = ctx.run(node, multiple=True)
+            assert [dict(m) for m in result] == expected[:3] + expected[4:]
+
+    def test_query_partitions(self, ctx, tmpdir):
+        # Partitions are read on their own connections, so the database can't be in memory
+        connection = sql.Connection(url="sqlite:///" + str(tmpdir.join("test.db")))
+        connection.connection().execute("CREATE TABLE test (id INTEGER PRIMARY KEY, name TEXT)")
+        connection.connection().execute("INSERT INTO test VALUES " + ", ".join(["(%d, 'n%d')" % (i, i) for i in range(50)]))
+
+        expected = [{'id': i, 'name': 'n%d' % i} for i in range(50)]
+        query = "SELECT id, name FROM test"
+
+        node = sql.Query(connection=connection, query=query, partitions=4, partition_key='id', fetch_size=5)
+        result = ctx.run(node, multiple=True)
+        assert sorted(result, key=lambda m: m['id']) == expected
+
+        node = sql.Query(connection=connection, query=query, partitions=3, partition_key='id', partition_mode="modulo", ordered=True)
+        result = ctx.run(node, multiple=True)
+        assert result == expected
+
+        with pytest.raises(ETLException):
+            ctx.run(sql.Query(connection=connection, query="SELECT 'x' AS id", partitions=2, partition_key='id'))
+
+    def test_query_resume(self, ctx, tmpdir):
+        connection = sql.Connection(url="sqlite:///" + str(tmpdir.join("test.db")))
+        connection.connection().execute("CREATE TABLE test (id INTEGER PRIMARY KEY, name TEXT)")
+        connection.connection().execute("INSERT INTO test VALUES " + ", ".join(["(%d, 'n%d')" % (i, i) for i in range(30)]))
+        query = "SELECT id, name FROM test ORDER BY id"
+
+        # The query is resumed after the last key processed, in the query itself
+        options = [{}, {'stream': True}, {'page_key': 'id', 'fetch_size': 7}, {'page_key': 'name'},
+                   {'partitions': 3, 'partition_key': 'id', 'ordered': True}]
+        for i, kwargs in enumerate(options):
+            urn = 'test.query%d' % i
+            ctx.checkpoint = Checkpoint(str(tmpdir.join("state.json")))
+            ctx.checkpoint.resumed = {urn: {'query': query, 'key': 20}}
+            node = ctx.add(urn, sql.Query(connection=connection, query=query, checkpoint_key='id', **kwargs))
+            result = ctx.run(node, multiple=True)
+            assert sorted(m['id'] for m in result) == list(range(21, 30))
+            assert ctx.checkpoint.positions[urn] == {'query': query, 'key': 29}
+
+    def test_transaction_periodic(self, ctx, tmpdir):
+        url = "sqlite:///" + str(tmpdir.join("test.db"))
+        connection = sql.Connection(url=url)
+        sqltable = sql.SQLTable(name="test", connection=connection, batch_size=10, columns=[
+            sql.SQLColumn(name="id", type="Integer", pk=True)])
+        observer = sql.Connection(url=url)
+        counts = []
+
+        def check(ctx, m):
+            if m['a'] == '5':
+                raise ValueError("Test error")
+            counts.append(observer.connection().execute("SELECT COUNT(*) FROM test").scalar())
+
+        def process(offset, **kwargs):
+            return flow.Chain(steps=[
+                sql.Transaction(connection=connection, **kwargs),
+                self.multiplier('a', '1, 2, 3, 4, 5'),
+                script.Function(lambda ctx, m: m.update({'id': int(m['a']) + offset})),
+                sql.StoreRow(sqltable=sqltable),
+                script.Function(check),
+            ])
+
+        # Commit every 2 rows, the last message fails (5 rows written, 4 committed)
+        with pytest.raises(ValueError):
+            ctx.run(process(0, commit_every=2))
+        assert counts == [0, 2, 2, 4]
+
+        # Savepoint every 2 rows, work until the last savepoint is committed on failure
+        counts.clear()
+        with pytest.raises(ValueError):
+            ctx.run(process(10, savepoint_every=2))
+        assert counts == [4, 4, 4, 4]
+        assert observer.connection().execute("SELECT COUNT(*) FROM test").scalar() == 8
+
+        # When checkpointing, commits still happen if no source updates its position
+        counts.clear()
+        ctx.checkpoint = Checkpoint(str(tmpdir.join("state.json")))
+        with pytest.raises(ValueError):
+            ctx.run(process(20, commit_every=2))
+        assert counts == [8, 10, 10, 12]
+
+    def test_parallel(self, ctx):
+        process = flow.Chain(batch_size=20, steps=[
+            self.multiplier('a', ", ".join([str(i) for i in range(20)])),
+            flow.Parallel(workers=2, chunk_size=3, steps=[
+                flow.Filter(condition="${ int(m['a']) % 2 == 0 }"),
+                script.Function(lambda ctx, m: m.update({'pid': os.getpid()})),
+            ]),
+        ])
+
+        result = ctx.run(process, multiple=True)
+        assert [m['a'] for m in result] == [str(i) for i in range(0, 20, 2)]
+        assert os.getpid() not in [m['pid'] for m in result]
+
+        # Messages can only be run in parallel when received in batches
+        with pytest.raises(ETLConfigurationException):
+            ctx.run(flow.Chain(steps=[self.multiplier('a', '1, 2'), flow.Parallel(workers=2, steps=[flow.Filter(condition="${ True }")])]))
+
+    def test_concurrent(self, ctx):
+
+        def wait(ctx, m):
+            time.sleep(0.01 * (10 - int(m['a'])))
+            m['thread'] = threading.current_thread().name
+
+        process = flow.Chain(batch_size=10, steps=[
+            self.multiplier('a', ", ".join([str(i) for i in range(10)])),
+            flow.Concurrent(max_in_flight=4, step=script.Function(wait)),
+        ])
+
+        result = ctx.run(process, multiple=True)
+        assert [m['a'] for m in result] == [str(i) for i in range(10)]
+        assert len(set([m['thread'] for m in result])) > 1
+
+        # Messages can only be processed concurrently when received in batches
+        with pytest.raises(ETLConfigurationException):
+            ctx.run(flow.Chain(steps=[self.multiplier('a', '1, 2'), flow.Concurrent(step=script.Function(wait))]))
+
+    def test_union_parallel(self, ctx):
+        # Both steps must be processing each message at the same time
+        barrier = threading.Barrier(2, timeout=5)
+
+        def wait(ctx, m):
+            barrier.wait()
+            m['thread'] = threading.current_thread().name
+
+        process = flow.Chain(steps=[
+            self.multiplier('a', '1, 2'),
+            flow.Union(parallel=True, steps=[
+                script.Function(wait),
+                script.Function(wait),
+            ]),
+        ])
+
+        result = ctx.run(process, multiple=True)
+        assert [m['a'] for m in result] == ['1', '1', '2', '2']
+        assert result[0]['thread'] != result[1]['thread']
+
+        # Output is yielded while steps go on with the rest of the batch
+        received = threading.Event()
+
+        def wait_received(ctx, m):
+            if m['a'] == '2':
+                assert received.wait(timeout=5)
+
+        process = flow.Chain(batch_size=2, steps=[
+            self.multiplier('a', '1, 2'),
+            flow.Union(parallel=True, steps=[
+                script.Function(lambda ctx, m: None),
+                script.Function(wait_received),
+            ]),
+            script.Function(lambda ctx, m: received.set()),
+        ])
+
+        result = ctx.run(process, multiple=True)
+        assert [m['a'] for m in result] == ['1', '1', '2', '2']
+
+    def test_fork_parallel(self, ctx):
+        rows = []
+
+        def fail(ctx, m):
+            if m['a'] == '3':
+                raise ValueError("Test error")
+
+        process = flow.Chain(steps=[
+            self.multiplier('a', '1, 2, 3'),
+            flow.Chain(fork=True, parallel=True, steps=[
+                script.Function(lambda ctx, m: m.update({'b': 'x'})),
+                script.Function(lambda ctx, m: rows.append(m)),
+                script.Function(fail),
+            ]),
+        ])
+
+        with pytest.raises(ETLException):
+            ctx.run(process, multiple=True)
+        assert rows == [{'a': '1', 'b': 'x'}, {'a': '2', 'b': 'x'}, {'a': '3', 'b': 'x'}]
+
+    def test_stats(self, ctx):
+        ctx.stats = True
+        multiplier = self.multiplier('a', '1, 2, 3')
+        condition = flow.Filter(condition="${ m['a'] != '2' }")
+        process = flow.Chain(steps=[multiplier, script.Eval(), condition])
+
+        result = ctx.run(process, multiple=True)
+        assert len(result) == 2
+        assert ctx.comp.components[multiplier].stats.messages_out == 3
+        assert ctx.comp.components[condition].stats.messages_in == 3
+        assert ctx.comp.components[condition].stats.messages_out == 2
+
+        report = ctx.comp.stats_report(process).split("\n")
+        assert len(report) == 5
+        assert report[2].startswith("  " + str(multiplier))
+
+    def test_sample(self, ctx, tmpdir):
+        ctx.sample = str(tmpdir.join("profile.folded"))
+
+        def busy(ctx, m):
+            start = time.process_time()
+            while time.process_time() - start < 0.3:
+                pass
+
+        step = script.Function(busy)
+        process = flow.Chain(steps=[self.multiplier('a', '1'), step])
+        ctx.run(process)
+
+        with open(ctx.sample) as f:
+            stacks = [line.rsplit(" ", 1) for line in f.read().splitlines()]
+        assert sum([int(count) for stack, count in stacks]) >= 1
+        assert [stack for stack, count in stacks if stack.startswith("Chain(None);Function(None);test_flow.py:busy")]
+
+    def test_sample_thread(self, ctx, tmpdir):
+        ctx.sample = str(tmpdir.join("profile.folded"))
+        errors = []
+
+        def run():
+            try:
+                ctx.run(flow.Chain(steps=[self.multiplier('a', '1, 2')]), multiple=True)
+            except Exception as e:
+                errors.append(e)
+
+        # Profiling is skipped outside the main thread
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        assert not errors
+        assert not os.path.exists(ctx.sample)
+
+    def test_memory(self, ctx):
+        ctx.memory = True
+        rows = []
+        reports = []
+
+        def report(ctx, m):
+            reports.append(ctx.memory_tracker.report())
+
+        process = flow.Chain(steps=[
+            self.multiplier('a', '1, 2'),
+            script.Function(lambda ctx, m: rows.append([str(i) * 500 for i in range(2000)])),
+            script.Function(report),
+        ])
+        ctx.run(process)
+
+        assert ctx.memory_tracker is None
+        lines = reports[1].split("\n")
+        assert lines[1].startswith("Function ")
+        assert float(lines[1].split()[-1]) > 1.0
+
+    def test_limit_cancel(self, ctx, tmpdir):
+        path = tmpdir.join("lines.txt")
+        path.write("".join(["line %d\n" % i for i in range(1000)]))
+        reader = fs.FileLineReader(path=str(path), encoding=None)
+        forked = flow.Chain(fork=True, steps=[flow.Limit(limit=2)])
+
+        process = flow.Chain(steps=[
+            reader,
+            forked,
+            flow.Limit(limit=5),
+        ])
+
+        result = ctx.run(process, multiple=True)
+        assert [m['data'] for m in result] == ["line %d\n" % i for i in range(5)]
+        assert reader._line == 5
+        assert forked._cancelled
+
+    def test_limit_side_effects(self, ctx):
+        connection = sql.Connection(url="sqlite://")
+        sqltable = sql.SQLTable(name="test", connection=connection, columns=[
+            sql.SQLColumn(name="id", type="Integer", pk=True)])
+        values = ", ".join([str(i) for i in range(20)])
+
+        def process(steps, batch_size=None):
+            return flow.Chain(batch_size=batch_size, steps=[
+                sql.Transaction(connection=connection),
+                self.multiplier('a', values),
+                script.Function(lambda ctx, m: m.update({'id': int(m['a'])})),
+            ] + steps)
+
+        def count():
+            rows = connection.connection().execute("SELECT COUNT(*) FROM test").scalar()
+            connection.connection().execute("DELETE FROM test")
+            return rows
+
+        # Steps with side effects before the limit process all messages
+        for batch_size in (None, 3):
+            result = ctx.run(process([sql.StoreRow(sqltable=sqltable), flow.Limit(limit=5)], batch_size), multiple=True)
+            assert len(result) == 5
+            assert count() == 20
+
+        # The transaction is committed when following steps are cancelled
+        result = ctx.run(process([flow.Limit(limit=5), sql.StoreRow(sqltable=sqltable)]), multiple=True)
+        assert len(result) == 5
+        assert count() == 5
+
+    def test_osmium_limit(self, ctx, tmpdir):
+        pytest.importorskip("osmium")
+        from cubetl.osm.osm_osmium import OsmiumNode
+
+        path = tmpdir.join("test.osm")
+        path.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="test">\n' + "".join([
+            '<node id="%d" version="1" timestamp="2020-01-01T00:00:00Z" uid="1" user="test" changeset="1" '
+            'lat="0" lon="0"><tag k="name" v="n%d"/></node>\n' % (i, i) for i in range(1, 20001)]) + '</osm>\n')
+
+        # The reader thread is stopped when the following steps are cancelled
+        reader = OsmiumNode(filename=str(path))
+        result = ctx.run(flow.Chain(steps=[reader, flow.Limit(limit=2)]), multiple=True)
+        assert [m['name'] for m in result] == ['n1', 'n2']
+        assert reader._osmium_handler.cancelled
+        assert not reader._osmium_thread.is_alive()
+
+    def test_transaction_close(self, ctx, tmpdir):
+        connection = sql.Connection(url="sqlite:///" + str(tmpdir.join("test.db")))
+        sqltable = sql.SQLTable(name="test", connection=connection, columns=[
+            sql.SQLColumn(name="id", type="Integer", pk=True)])
+
+        def transaction(**kwargs):
+            return flow.Chain(steps=[
+                sql.Transaction(connection=connection),
+                self.multiplier('a', '1, 2, 3, 4, 5'),
+                script.Function(lambda ctx, m: m.update({'id': int(m['a'])})),
+                sql.StoreRow(sqltable=sqltable),
+            ], **kwargs)
+
+        def fail(ctx, m):
+            if m['a'] == '3':
+                raise ValueError("Test error")
+
+        # The transaction is rolled back if the flow is closed before finishing
+        process = transaction()
+        ctx.comp.initialize(process)
+        messages = ctx.comp.process(process, ctx.copy_message({}))
+        assert [next(messages)['id'], next(messages)['id']] == [1, 2]
+        messages.close()
+        assert connection.connection().execute("SELECT COUNT(*) FROM test").scalar() == 0
+        ctx.comp.finalize(process)
+
+        # Failures of steps after a nested chain reach the transaction as a close
+        process = flow.Chain(steps=[transaction(condition="${ True }"), script.Function(fail)])
+        with pytest.raises(ValueError):
+            ctx.run(process)
+        assert connection.connection().execute("SELECT COUNT(*) FROM test").scalar() == 0
+
+    def test_checkpoint_resume(self, ctx, tmpdir):
+        path = tmpdir.join("lines.txt")
+        path.write("".join(["line %d\n" % i for i in range(10)]))
+        statepath = str(tmpdir.join("state.json"))
+        rows = []
+        fail = ["line 5\n"]
+
+        def store(ctx, m):
+            if m['data'] in fail:
+                raise ValueError("Test error")
+            rows.append(m['data'])
+
+        def process(ctx):
+            return flow.Chain(steps=[
+                ctx.add("test.reader", fs.FileLineReader(path=str(path), encoding=None)),
+                script.Function(store),
+            ])
+
+        ctx.checkpoint = Checkpoint(statepath, interval=0)
+        with pytest.raises(ValueError):
+            ctx.run(process(ctx))
+        assert ctx.checkpoint.positions["test.reader"] == {"path": str(path), "lines": 5, "offset": 35}
+
+        fail.clear()
+        ctx2 = cubetl.cubetl()
+        ctx2.checkpoint = Checkpoint(statepath, resume=True)
+        ctx2.run(process(ctx2))
+        assert rows == ["line %d\n" % i for i in range(10)]
+
+        # Checkpointed sources must be named
+        ctx3 = cubetl.cubetl()
+        ctx3.checkpoint = Checkpoint(statepath)
+        with pytest.raises(ETLConfigurationException):
+            ctx3.run(fs.FileLineReader(path=str(path), encoding=None))
+
+    def test_checkpoint_transaction(self, ctx, tmpdir):
+        path = tmpdir.join("lines.txt")
+        path.write("".join(["%d\n" % i for i in range(10)]))
+        statepath = str(tmpdir.join("state.json"))
+        url = "sqlite:///" + str(tmpdir.join("test.db"))
+        observer = sql.Connection(url=url)
+
+        class InterruptedCheckpoint(Checkpoint):
+            def commit(self):
+                raise OSError("Interrupted")
+
+        def process(ctx):
+            connection = sql.Connection(url=url)
+            sqltable = sql.SQLTable(name="test", connection=connection, columns=[
+                sql.SQLColumn(name="id", type="Integer", pk=True)])
+            return flow.Chain(steps=[
+                sql.Transaction(connection=connection, commit_every=3),
+                ctx.add("test.reader", fs.FileLineReader(path=str(path), encoding=None)),
+                script.Function(lambda ctx, m: m.update({'id': int(m['data'])})),
+                sql.StoreRow(sqltable=sqltable),
+            ])
+
+        # Interrupted after the first database commit, before the state file is replaced
+        ctx.checkpoint = InterruptedCheckpoint(statepath)
+        with pytest.raises(OSError):
+            ctx.run(process(ctx))
+        assert observer.connection().execute("SELECT COUNT(*) FROM test").scalar() == 3
+
+        # Positions committed to the database are resumed (no duplicate keys)
+        ctx2 = cubetl.cubetl()
+        ctx2.checkpoint = Checkpoint(statepath, resume=True)
+        ctx2.run(process(ctx2))
+        assert observer.connection().execute("SELECT COUNT(*) FROM test").scalar() == 10